@@ -5,22 +5,63 @@ author: Jan C. Brammer <jan.c.brammer@gmail.com>
 """
 
 import numpy as np
-from scipy.signal import bessel, sosfiltfilt
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import bessel, sosfilt, sosfilt_zi, sosfiltfilt
 from scipy.interpolate import interp1d
+from biofeedback_analyses.analysis_utils import cache_utils, quantile_utils, ragged_utils
+from biofeedback_analyses.config import REPLAY_WINDOW
 
 
-def biofeedback_filter(resp, sfreq):
-    """Filter respiration as during real-time biofeedback computation."""
+def biofeedback_filter_sos(sfreq):
+    """Design the respiration bandpass used during real-time biofeedback."""
     nyq = 0.5 * sfreq
     low = 4 / 60 / nyq
     high = 12 / 60 / nyq
     order = 2
     sos = bessel(order, [low, high], btype="bandpass", output="sos")
+
+    return sos
+
+
+@cache_utils.memoize(version=1)
+def biofeedback_filter(resp, sfreq):
+    """Filter respiration as during real-time biofeedback computation."""
+    sos = biofeedback_filter_sos(sfreq)
     resp_filt = sosfiltfilt(sos, resp)
 
     return resp_filt
 
 
+def filter_transient(sos, rtol=1e-9):
+    """Return the number of samples after which the impulse response of a
+    filter has decayed below `rtol` times its peak magnitude.
+
+    Parameters
+    ----------
+    sos : array
+        Second-order sections of the filter.
+    rtol : float, optional
+        Decay threshold relative to the peak of the impulse response.
+
+    Returns
+    -------
+    n_transient : int
+        Length of the filter transient in samples.
+    """
+    n_samples = 1024
+    while True:
+        impulse = np.zeros(n_samples)
+        impulse[0] = 1
+        response = np.abs(sosfilt(sos, impulse))
+        above_tol, = np.where(response > rtol * response.max())
+        n_transient = above_tol[-1] + 1
+        if n_transient < n_samples // 2:    # make sure the tail has been observed
+            break
+        n_samples *= 2
+
+    return int(n_transient)
+
+
 def interpolate_biofeedback(biofeedback_samples, biofeedback_values,
                             interpolation_samples):
     """Interpolate recorded biofeedback scores over a range of samples."""
@@ -60,10 +101,102 @@ def compute_biofeedback_score(signal, target):
     return biofeedback
 
 
+def estimate_biofeedback_target(envelope, biofeedback_values):
+    """Estimate the target of compute_biofeedback_score() from recorded scores
+    by inverting the Hill equation at every score in (0, 1).
+
+    Parameters
+    ----------
+    envelope : ndarray
+        Signal at the time of each recorded score.
+    biofeedback_values : ndarray
+        Recorded scores.
+
+    Returns
+    -------
+    target : float
+        Median of the targets implied by the individual scores.
+    """
+    valid = (biofeedback_values > 0) & (biofeedback_values < 1) & (envelope > 0)
+    ratio = (1 - biofeedback_values[valid]) / biofeedback_values[valid]
+    target = np.median(envelope[valid] * np.cbrt(ratio))
+
+    return target
+
+
+def biofeedback_envelope(resp, sfreq, window=REPLAY_WINDOW):
+    """Envelope that stream_biofeedback_scores() computes for a complete
+    recording at once. The trailing maximum approximates the envelope that
+    the game scored, which isn't recorded."""
+    sos = biofeedback_filter_sos(sfreq)
+    n_window = max(int(np.rint(window * sfreq)), 1)
+    resp_filt = sosfilt(sos, resp, zi=sosfilt_zi(sos) * resp[0])[0]
+    history = np.concatenate((np.zeros(n_window - 1), np.abs(resp_filt)))
+    envelope = sliding_window_view(history, n_window).max(axis=1)
+
+    return envelope
+
+
+def stream_biofeedback_scores(sfreq, target, window=REPLAY_WINDOW):
+    """Causal, stateful version of the biofeedback computation for streaming.
+
+    Samples are filtered with the biofeedback filter (forward only, as during
+    the real-time computation), the envelope is the maximum absolute filtered
+    respiration over the trailing `window`, and the envelope is scored with
+    compute_biofeedback_score().
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency of the respiration.
+    target : float
+        See compute_biofeedback_score(). In units of the respiration.
+    window : float, optional
+        Duration of the envelope window in seconds. Should span at least one
+        breathing cycle.
+
+    Yields
+    ------
+    scores : ndarray
+        Score of every sample of the most recently sent chunk. Send chunks of
+        raw respiration (of any length) with `generator.send(chunk)` after
+        priming the generator with `next(generator)`.
+    """
+    sos = biofeedback_filter_sos(sfreq)
+    n_window = max(int(np.rint(window * sfreq)), 1)
+    zi = None
+    history = np.zeros(n_window - 1)    # absolute filtered respiration preceding the chunk
+
+    chunk = yield
+    while True:
+        chunk = np.atleast_1d(np.asarray(chunk, dtype=float))
+        if zi is None:    # start in steady state with respect to the first sample
+            zi = sosfilt_zi(sos) * chunk[0]
+        resp_filt, zi = sosfilt(sos, chunk, zi=zi)
+
+        history = np.concatenate((history, np.abs(resp_filt)))
+        envelope = sliding_window_view(history, n_window).max(axis=1)
+        history = history[-(n_window - 1):] if n_window > 1 else history[:0]
+
+        chunk = yield compute_biofeedback_score(envelope, target)
+
+
 def compute_original_resp_biofeedback_stats(original_resp_biofeedback):
 
+    original_resp_biofeedback = np.asarray(original_resp_biofeedback, dtype=np.float64)
     stats = {}
-    stats["median_original_resp_biofeedback"] = np.median(original_resp_biofeedback)
+    stats["median_original_resp_biofeedback"] = quantile_utils.median(original_resp_biofeedback)
     stats["mean_original_resp_biofeedback"] = np.mean(original_resp_biofeedback)
 
-    return stats
\ No newline at end of file
+    return stats
+
+
+def compute_original_resp_biofeedback_stats_segmented(original_resp_biofeedback, offsets):
+    """compute_original_resp_biofeedback_stats() of each segment of a ragged
+    batch."""
+
+    stats = {}
+    stats["median_original_resp_biofeedback"] = ragged_utils.segment_median(original_resp_biofeedback, offsets)
+    stats["mean_original_resp_biofeedback"] = ragged_utils.segment_mean(original_resp_biofeedback, offsets)
+
+    return stats
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Opt-in memoization of pure analysis functions on disk. Memoization is enabled
+by setting config.MEMOIZE_DIR to a directory, e.g., at the top of a notebook:
+
+    from biofeedback_analyses import config
+    config.MEMOIZE_DIR = "/path/to/cache"
+
+Results are pickled to MEMOIZE_DIR. An SQLite index keeps track of their size
+and last access, such that the least recently used results are evicted once
+the cache exceeds config.MEMOIZE_MAX_BYTES, and counts hits and misses per
+function. The index serializes concurrent access from multiple processes and
+results are written atomically, so that processes can share a cache.
+"""
+
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from contextlib import closing
+from biofeedback_analyses import config
+
+
+SCALAR_TYPES = (type(None), bool, int, float, complex, str, bytes, range, Path, np.generic)
+
+
+def fingerprint(value, h=None):
+    """Hash the content of (nested) arrays, pandas objects, sequences,
+    mappings, and scalars.
+
+    Parameters
+    ----------
+    value : object
+        Arrays are hashed by dtype, shape, and raw bytes (object arrays
+        element by element). DataFrames, Series, and Indexes are hashed by
+        their values, index, columns, names, and dtypes. Sequences and
+        mappings are hashed element by element. Scalars (see SCALAR_TYPES)
+        are hashed by their repr.
+    h : hashlib hash object, optional
+        Hash object that is updated in place.
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal digest of `value`.
+
+    Raises
+    ------
+    TypeError
+        If `value` contains an object of any other type, whose repr might
+        not reflect its entire content.
+    """
+    if h is None:
+        h = hashlib.blake2b(digest_size=16)
+
+    if isinstance(value, np.ndarray):
+        h.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        if value.dtype.hasobject:    # raw bytes would be pointers
+            fingerprint(value.ravel().tolist(), h)
+        else:
+            h.update(np.ascontiguousarray(value).data)    # doesn't copy contiguous arrays
+    elif isinstance(value, pd.DataFrame):
+        h.update(f"DataFrame{value.shape}".encode())
+        fingerprint(value.columns, h)
+        fingerprint(value.index, h)
+        for i in range(value.shape[1]):
+            h.update(str(value.dtypes.iloc[i]).encode())
+            fingerprint(value.iloc[:, i].to_numpy(), h)
+    elif isinstance(value, pd.Series):
+        h.update(f"Series{value.dtype}{value.name!r}".encode())
+        fingerprint(value.index, h)
+        fingerprint(value.to_numpy(), h)
+    elif isinstance(value, pd.Index):
+        h.update(f"{type(value).__name__}{value.dtype}{list(value.names)!r}".encode())
+        fingerprint(value.to_numpy(), h)
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            fingerprint(item, h)
+    elif isinstance(value, dict):
+        h.update(f"dict{len(value)}".encode())
+        for key in sorted(value):
+            h.update(repr(key).encode())
+            fingerprint(value[key], h)
+    elif isinstance(value, SCALAR_TYPES):
+        h.update(repr(value).encode())
+    else:
+        raise TypeError(f"Can't fingerprint values of type {type(value).__name__}.")
+
+    return h.hexdigest()
+
+
+def connect(cache_dir):
+
+    con = sqlite3.connect(str(Path(cache_dir).joinpath("index.sqlite")),
+                          timeout=60, isolation_level=None)    # transactions are managed explicitly
+    con.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY,"
+                " size INTEGER, last_access REAL)")
+    con.execute("CREATE TABLE IF NOT EXISTS stats (func TEXT PRIMARY KEY,"
+                " hits INTEGER DEFAULT 0, misses INTEGER DEFAULT 0)")
+
+    return con
+
+
+def count(con, func, outcome):
+
+    con.execute("INSERT OR IGNORE INTO stats (func) VALUES (?)", (func,))
+    con.execute(f"UPDATE stats SET {outcome} = {outcome} + 1 WHERE func = ?", (func,))
+
+
+def load(cache_dir, key, func):
+    """Return (True, result) if key is cached and (False, None) otherwise."""
+    path = Path(cache_dir).joinpath(f"{key}.pkl")
+
+    with closing(connect(cache_dir)) as con:
+        try:
+            with open(path, "rb") as file:
+                result = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):    # not cached, or evicted by another process
+            count(con, func, "misses")
+            return False, None
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        count(con, func, "hits")
+        con.execute("COMMIT")
+
+    return True, result
+
+
+def store(cache_dir, key, result, max_bytes):
+    """Write result atomically and evict least recently used results until
+    the cache is smaller than max_bytes."""
+    path = Path(cache_dir).joinpath(f"{key}.pkl")
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as file:
+        pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)    # readers never see partially written results
+
+    with closing(connect(cache_dir)) as con:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                    (key, path.stat().st_size, time.time()))
+        total, = con.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        for evict_key, size in con.execute("SELECT key, size FROM entries"
+                                           " ORDER BY last_access").fetchall():
+            if total <= max_bytes:
+                break
+            con.execute("DELETE FROM entries WHERE key = ?", (evict_key,))
+            Path(cache_dir).joinpath(f"{evict_key}.pkl").unlink(missing_ok=True)
+            total -= size
+        con.execute("COMMIT")
+
+
+def memoize(version, depends_on=()):
+    """Decorator that memoizes a pure function on disk if config.MEMOIZE_DIR
+    is set. Calls are keyed on the fingerprint of all arguments, the
+    function's name, `version`, which must be incremented whenever the
+    function's output changes, and the values of the config constants named
+    in `depends_on` (i.e., settings that change the function's output)."""
+    def decorator(func):
+
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            cache_dir = config.MEMOIZE_DIR
+            if cache_dir is None:
+                return func(*args, **kwargs)
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+            settings = {setting: getattr(config, setting) for setting in depends_on}
+            key = fingerprint([name, version, list(args), kwargs, settings])
+            cached, result = load(cache_dir, key, name)
+            if not cached:
+                result = func(*args, **kwargs)
+                store(cache_dir, key, result, config.MEMOIZE_MAX_BYTES)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def cache_stats(cache_dir=None):
+    """Return the number of hits and misses per function, as well as the
+    number and total size (bytes) of cached results."""
+    cache_dir = config.MEMOIZE_DIR if cache_dir is None else cache_dir
+
+    with closing(connect(cache_dir)) as con:
+        stats = {func: {"hits": hits, "misses": misses} for func, hits, misses
+                 in con.execute("SELECT func, hits, misses FROM stats")}
+        n_entries, n_bytes = con.execute("SELECT COUNT(*), COALESCE(SUM(size), 0)"
+                                         " FROM entries").fetchone()
+    stats["entries"] = n_entries
+    stats["bytes"] = n_bytes
+
+    return stats
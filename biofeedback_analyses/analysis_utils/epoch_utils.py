@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Event-locked epochs of the processed signals across sessions. Epochs are
+written session by session into a memory-mapped .npy array of shape
+(n_epochs, n_samples, n_channels) and described by a metadata table with one
+row per epoch, such that cohort-level averages can be computed without
+holding all sessions in memory. Samples of an epoch that lie outside of a
+signal (e.g., before the start of the recording, or after the last IBI) are
+NaN.
+"""
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+
+def select_events(events, event_names, on_change=False):
+    """Return the rows of formatted events whose "event" is in event_names.
+
+    Parameters
+    ----------
+    events : DataFrame
+        Formatted events, see event_utils.format_events().
+    event_names : list of str
+        Names of the events that epochs are locked to.
+    on_change : bool, optional
+        Only keep events whose value differs from the previous event of the
+        same name (e.g., changes of the Feedback score).
+
+    Returns
+    -------
+    selected : DataFrame
+        With columns event, value, and physiosample.
+    """
+    selected = events.loc[events["event"].isin(event_names), ["event", "value", "physiosample"]]
+    if on_change:
+        previous = selected.groupby("event")["value"].shift()
+        selected = selected.loc[selected["value"] != previous]
+
+    return selected.reset_index(drop=True)
+
+
+def extract_epochs(signal, samples, pre, post):
+    """Return the epochs of signal from pre samples before until post samples
+    after each sample, as an array of shape (len(samples), pre + post). Samples
+    outside of the signal are NaN."""
+    samples = np.asarray(samples, dtype=int)
+    idcs = samples[:, np.newaxis] + np.arange(-pre, post)
+    valid = (idcs >= 0) & (idcs < signal.size)
+    epochs = np.full(idcs.shape, np.nan)
+    epochs[valid] = signal[idcs[valid]]
+
+    return epochs
+
+
+def read_channels(prefix_path, channels):
+    """Read the channels of a session, i.e., the column of the processed file
+    with each (suffix, column) in channels. A channel is None if its file
+    doesn't exist."""
+    signals = []
+    files = {}
+
+    for suffix, column in channels:
+        path = prefix_path.with_name(f"{prefix_path.name}{suffix}")
+        if not path.exists():
+            signals.append(None)
+            continue
+        if path not in files:
+            files[path] = pd.read_csv(path, sep="\t")
+        signals.append(files[path][column].to_numpy(dtype=float))
+
+    return signals
+
+
+def epoch_sessions(event_paths, event_names, pre, post, channels, save_path,
+                   on_change=False, dtype=np.float32):
+    """Write the event-locked epochs of all sessions to a memory-mapped array.
+
+    Parameters
+    ----------
+    event_paths : list of Path
+        Formatted events of the sessions. The channels of a session are read
+        from the processed files that share the events' prefix (e.g.,
+        subj-01_sess-01_cond-A_).
+    event_names : list of str
+        Names of the events that epochs are locked to.
+    pre, post : int
+        Number of samples before and after each event.
+    channels : list of tuple
+        (suffix, column) of each channel, see config.EPOCH_CHANNELS.
+    save_path : Path
+        The epochs are saved to save_path.npy and the metadata to
+        save_path_metadata (TSV).
+    on_change : bool, optional
+        See select_events().
+    dtype : dtype, optional
+        Data type of the epochs.
+
+    Returns
+    -------
+    epochs : memmap
+        Array of shape (n_epochs, pre + post, len(channels)).
+    metadata : DataFrame
+        One row per epoch with subject, session, condition, event, value, and
+        physiosample.
+    """
+    # Count the epochs first, such that the array can be allocated on disk.
+    selections = []
+    for event_path in event_paths:
+        selected = select_events(pd.read_csv(event_path, sep="\t"), event_names, on_change)
+        name = event_path.name
+        selected.insert(0, "subj", name[:7])
+        selected.insert(1, "sess", name[8:15])
+        selected.insert(2, "cond", name[16:22])
+        selections.append(selected)
+    metadata = pd.concat(selections, ignore_index=True) if selections else pd.DataFrame(
+        columns=["subj", "sess", "cond", "event", "value", "physiosample"])
+
+    epochs = open_memmap(save_path.with_name(f"{save_path.name}.npy"), mode="w+", dtype=dtype,
+                         shape=(len(metadata), pre + post, len(channels)))
+    beg = 0
+    for event_path, selected in zip(event_paths, selections):
+        end = beg + len(selected)
+        if end > beg:
+            signals = read_channels(event_path.with_name(event_path.name[:23]), channels)
+            for i, signal in enumerate(signals):
+                epochs[beg:end, :, i] = (np.nan if signal is None else
+                                         extract_epochs(signal, selected["physiosample"], pre, post))
+            print(f"Epoched {end - beg} event(s) of {event_path.name[:22]}.")
+        beg = end
+    epochs.flush()
+    metadata.to_csv(save_path.with_name(f"{save_path.name}_metadata"), sep="\t", index=False)
+
+    return epochs, metadata
+
+
+def load_epochs(save_path):
+    """Return the epochs (memory-mapped read-only) and metadata saved by
+    epoch_sessions()."""
+    epochs = np.load(save_path.with_name(f"{save_path.name}.npy"), mmap_mode="r")
+    metadata = pd.read_csv(save_path.with_name(f"{save_path.name}_metadata"), sep="\t")
+
+    return epochs, metadata
+
+
+def average_epochs(epochs, metadata, by, chunk_size=1024):
+    """Average the epochs within groups of the metadata (e.g., by=["cond",
+    "event"]), ignoring NaN. The epochs are read chunk by chunk.
+
+    Returns
+    -------
+    averages : dict
+        Maps each group to an array of shape (n_samples, n_channels).
+    counts : dict
+        Maps each group to the number of non-NaN values that have been
+        averaged at each sample and channel.
+    """
+    groups = metadata.groupby(by).ngroup().to_numpy()
+    keys = metadata.groupby(by).size().index
+    sums = np.zeros((len(keys),) + epochs.shape[1:])
+    counts = np.zeros((len(keys),) + epochs.shape[1:])
+
+    for beg in range(0, epochs.shape[0], chunk_size):
+        chunk = np.asarray(epochs[beg:beg + chunk_size], dtype=float)
+        chunk_groups = groups[beg:beg + chunk_size]
+        valid = ~np.isnan(chunk)
+        np.add.at(sums, chunk_groups, np.where(valid, chunk, 0))
+        np.add.at(counts, chunk_groups, valid)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = sums / counts
+
+    return dict(zip(keys, averages)), dict(zip(keys, counts))
@@ -4,8 +4,11 @@
 author: Jan C. Brammer <jan.c.brammer@gmail.com>
 """
 
+import json
 import numpy as np
 import dateutil
+from pandas.api.types import is_numeric_dtype
+from biofeedback_analyses.config import SYNC_SEGMENT_DURATION
 
 
 def isotimes_to_relativetimes(df):
@@ -21,8 +24,11 @@ def isotimes_to_relativetimes(df):
     Returns
     -------
     df : DataFrame
-        Mutated DataFrame.
+        Mutated DataFrame. Left as is if the timestamps have already been
+        converted.
     """
+    if is_numeric_dtype(df["timestamp"]):
+        return df
     isotimes = [dateutil.parser.parse(i) for i in df["timestamp"]]    # parser returns a datetime.datetime object
     # specify time in seconds relative to the first timestamp
     t_zero = isotimes[0]
@@ -32,7 +38,132 @@ def isotimes_to_relativetimes(df):
     return df
 
 
-def relativetimes_to_physiosamples(df, drop_rows_after_last_physiosample=False):
+def fit_sync_model(df, segment_duration=SYNC_SEGMENT_DURATION):
+    """Fit the mapping from seconds in the events file to samples in the
+    physiological recording based on the "bitalino.synchronize" events.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Containing (at least) three columns: event, value, timestamp. The
+        timestamps must be in seconds (see isotimes_to_relativetimes()).
+    segment_duration : float, optional
+        If None (default), fit a single line. Otherwise, fit a separate line
+        to the synchronization events within each consecutive segment of
+        segment_duration seconds, which accounts for drift between the
+        clocks of the events file and the physiological recording.
+
+    Returns
+    -------
+    sync_model : dict
+        Containing the number of samples per second ("slope"), the number of
+        samples elapsed between the start of the physiological recording and
+        the first event in the events file ("intercept"), the residuals of the
+        fit at each synchronization event in samples ("residuals"), and the
+        "segments" with their own "beg" (seconds), "slope" and "intercept".
+        "segments" is empty if segment_duration is None.
+    """
+    phys_sec = get_eventtimes(df, "bitalino.synchronize")
+    phys_samp = get_eventvalues(df, "bitalino.synchronize")
+
+    slope, intcpt = np.polyfit(phys_sec, phys_samp, 1)
+    sync_model = {"slope": slope, "intercept": intcpt, "segments": []}
+
+    if segment_duration is not None:
+        segment_idcs = np.floor((phys_sec - phys_sec[0]) / segment_duration).astype(int)
+        for segment_idx in np.unique(segment_idcs):
+            in_segment = segment_idcs == segment_idx
+            if in_segment.sum() < 2:    # too few events to fit a line, fall back to neighbouring segment
+                continue
+            segment_slope, segment_intcpt = np.polyfit(phys_sec[in_segment],
+                                                       phys_samp[in_segment], 1)
+            sync_model["segments"].append({"beg": phys_sec[in_segment][0],
+                                           "slope": segment_slope,
+                                           "intercept": segment_intcpt})
+
+    sync_model["residuals"] = list(phys_samp - relativetimes_to_samples(phys_sec, sync_model,
+                                                                        rint=False))
+
+    return sync_model
+
+
+def relativetimes_to_samples(seconds, sync_model, rint=True):
+    """Convert seconds in the events file to samples in the physiological
+    recording with a model fitted by fit_sync_model(). Seconds preceding the
+    first segment are converted with the first segment.
+
+    Parameters
+    ----------
+    seconds : array
+        Seconds relative to the first event in the events file.
+    sync_model : dict
+        The output of fit_sync_model().
+    rint : bool, optional
+        Whether to round to the nearest sample (default) or to return
+        fractional samples.
+
+    Returns
+    -------
+    samples : array
+        The samples corresponding to seconds.
+    """
+    seconds = np.asarray(seconds, dtype=float)
+    segments = sync_model["segments"]
+
+    if not segments:
+        samples = sync_model["intercept"] + seconds * sync_model["slope"]
+    else:
+        begs = np.array([segment["beg"] for segment in segments])
+        slopes = np.array([segment["slope"] for segment in segments])
+        intcpts = np.array([segment["intercept"] for segment in segments])
+        segment_idcs = np.clip(np.searchsorted(begs, seconds, side="right") - 1, 0, None)
+        samples = intcpts[segment_idcs] + seconds * slopes[segment_idcs]
+
+    if rint:
+        samples = np.rint(samples).astype(int)
+
+    return samples
+
+
+def save_sync_model(sync_model, path):
+    """Save the output of fit_sync_model() as JSON."""
+    with open(path, "w") as file:
+        json.dump(sync_model, file, default=float, indent=1)
+
+
+def load_sync_model(path):
+    """Load a model that has been saved with save_sync_model()."""
+    with open(path) as file:
+        sync_model = json.load(file)
+
+    return sync_model
+
+
+def rescale_sync_samples(df, factor):
+    """Multiply the samples of the "bitalino.synchronize" events by factor,
+    e.g., SFREQ / sfreq for a recording at sfreq that is resampled to SFREQ,
+    such that events are converted to samples at the resampled rate.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Containing (at least) two columns: event, value.
+    factor : float
+        Ratio of the resampled and the original sampling frequency.
+
+    Returns
+    -------
+    df : DataFrame
+        Mutated DataFrame.
+    """
+    sync_idcs = df["event"] == "bitalino.synchronize"
+    df.loc[sync_idcs, "value"] = get_eventvalues(df, "bitalino.synchronize") * factor
+
+    return df
+
+
+def relativetimes_to_physiosamples(df, drop_rows_after_last_physiosample=False,
+                                   sync_model=None):
     """Convert the df's "timestamp" column to samples that are aligned with the
     synchronization samples from the physiological recording. Append the
     samples to the df in a "physiosample" column.
@@ -44,6 +175,8 @@ def relativetimes_to_physiosamples(df, drop_rows_after_last_physiosample=False):
     drop_rows_after_last_physiosample : bool, optional
         Whether or not to drop the events that have been recorded after the
         physiological recording has been stopped.
+    sync_model : dict, optional
+        The output of fit_sync_model(). Fitted to df if None.
 
     Returns
     -------
@@ -51,17 +184,13 @@ def relativetimes_to_physiosamples(df, drop_rows_after_last_physiosample=False):
         Mutated DataFrame containing four columns: event, value, timestamp,
         physiosample.
     """
-    phys_sec = get_eventtimes(df, "bitalino.synchronize")
     phys_samp = get_eventvalues(df, "bitalino.synchronize")
-
-    # Get number of samples per second (slope), and number of samples elapsed
-    # between the start of the physiological recording and the first event in the
-    # events file (intcpt).
-    slope, intcpt = np.polyfit(phys_sec, phys_samp, 1)
+    if sync_model is None:
+        sync_model = fit_sync_model(df)
 
     # Convert the seconds at which the events occur to their corresponding samples
     # in the physiological recording.
-    events_samp = np.rint(intcpt + df["timestamp"] * slope).astype(int)
+    events_samp = relativetimes_to_samples(df["timestamp"], sync_model)
     df["physiosample"] = events_samp
 
     # Make sure that the conversion from seconds to samples is correct by asserting
@@ -126,7 +255,7 @@ def ibis_to_ms(df):
     return df
 
 
-def format_events(df):
+def format_events(df, sync_model=None):
     """Format the df for further processing.
     For details on the formatting steps see docstrings of
     isotimes_to_relativetimes(), relativetimes_to_physiosamples(),
@@ -136,6 +265,8 @@ def format_events(df):
     ----------
     df : DataFrame
         Containing three columns: event, value, timestamp.
+    sync_model : dict, optional
+        The output of fit_sync_model(). Fitted to df if None.
 
     Returns
     -------
@@ -143,7 +274,8 @@ def format_events(df):
         Mutated DataFrame.
     """
     df = isotimes_to_relativetimes(df)
-    df = relativetimes_to_physiosamples(df, drop_rows_after_last_physiosample=True)
+    df = relativetimes_to_physiosamples(df, drop_rows_after_last_physiosample=True,
+                                        sync_model=sync_model)
     df = specify_unityevents(df)
     df = ibis_to_ms(df)
 
@@ -181,6 +313,18 @@ def get_eventtimes(df, event, as_sample=False):
     return t
 
 
+def get_game_window(df):
+    """Return the first and last sample of the game, or None if there isn't
+    exactly one "GameEnd" event. If the game was restarted, the latest
+    "GameStart" event is used (see summary_stats.steps.get_game_beg_end())."""
+    beg = get_eventtimes(df, "GameStart", as_sample=True)
+    end = get_eventtimes(df, "GameEnd", as_sample=True)
+    if len(beg) < 1 or len(end) != 1:
+        return None
+
+    return beg[-1], end[0]
+
+
 def get_eventvalues(df, event):
     """Return entires of df's "value" column for a specific event.
 
@@ -5,11 +5,11 @@ author: Jan C. Brammer <jan.c.brammer@gmail.com>
 """
 
 import numpy as np
-from biofeedback_analyses.analysis_utils import event_utils
+from biofeedback_analyses.analysis_utils import event_utils, cache_utils, quantile_utils, ragged_utils
 from biopeaks.filters import butter_lowpass_filter
 from biopeaks.heart import correct_peaks
 from scipy.interpolate import interp1d
-from scipy.signal import welch, coherence, find_peaks
+from scipy.signal import welch, coherence
 
 
 def correct_ibis(ibis):
@@ -38,7 +38,7 @@ def correct_ibis(ibis):
     return ibis_corrected
 
 
-def ibis_to_rpeaks(ibis, events):
+def ibis_to_rpeaks(ibis, events, sync_model=None):
     """For each IBI, calculate the corresponding R-peak in samples.
     This allows for aligning the IBIs with the physiological recording.
     IMPORTANT: Polar H10 (H9) records IBIs in 1/1024 seconds format, i.e. not
@@ -51,6 +51,8 @@ def ibis_to_rpeaks(ibis, events):
         IBIs in milliseconds.
     events : DataFrame
         Must be formatted with event_utils.format_events() prior to calling this function.
+    sync_model : dict, optional
+        The output of event_utils.fit_sync_model(). Fitted to events if None.
 
     Returns
     -------
@@ -60,14 +62,13 @@ def ibis_to_rpeaks(ibis, events):
     peaks_ms = np.cumsum(ibis)
     peaks_ms = peaks_ms - peaks_ms[0]    # start peaks at 0 milliseconds
 
-    # Get number of samples per second (slope), and number of samples elapsed
-    # between the start of the physiological recording and the first event in the
-    # events file (intcpt).
-    phys_sec = event_utils.get_eventtimes(events, "bitalino.synchronize", as_sample=False)
-    phys_samp = event_utils.get_eventvalues(events, "bitalino.synchronize")
-    slope, intcpt = np.polyfit(phys_sec, phys_samp, 1)
+    if sync_model is None:
+        sync_model = event_utils.fit_sync_model(events)
     # Convert peaks from milliseconds to seconds and then to samples.
-    peaks_samp = np.rint(intcpt + (peaks_ms / 1000) * slope).astype(int)
+    peaks_sec = peaks_ms / 1000
+    if sync_model["segments"]:    # convert each peak with the segment it occurs in
+        peaks_sec = peaks_sec + event_utils.get_eventtimes(events, "InterBeatInterval")[0]
+    peaks_samp = event_utils.relativetimes_to_samples(peaks_sec, sync_model)
 
     # Since peaks start at zero, the first peak has to be offset such that it
     # coincides with the first recorded IBI.
@@ -78,6 +79,7 @@ def ibis_to_rpeaks(ibis, events):
     return peaks_samp
 
 
+@cache_utils.memoize(version=1)
 def interpolate_ibis(peaks, ibis, interpolation_samples):
     """Interpolate IBIs between peaks over a range of samples.
     IMPORTANT: Polar H10 (H9) records IBIs in 1/1024 seconds format, i.e. not
@@ -109,12 +111,24 @@ def interpolate_ibis(peaks, ibis, interpolation_samples):
     return ibis_filt
 
 
-def compute_hrv_stats(ibis, sfreq):
-
-    stats = {}
+@cache_utils.memoize(version=1)
+def compute_hrv_spectral_stats(ibis, sfreq):
 
+    ibis = np.asarray(ibis, dtype=np.float64)    # accumulate the PSD in float64 regardless of config.SIGNAL_DTYPE
     freqs, psd = welch(ibis, fs=sfreq, nperseg=4096)
 
+    stats = compute_hrv_band_stats(freqs, psd)
+
+    return stats
+
+
+def compute_hrv_band_stats(freqs, psd):
+    """Band powers of the PSD of IBIs. psd can hold several PSDs along its
+    first axis (e.g., one per window), in which case each statistic is an
+    array with one entry per PSD."""
+
+    stats = {}
+
     vlf_band = {"fmin": 0.003, "fmax": 0.04}
     lf_band = {"fmin": 0.04, "fmax": 0.15}
     hf_band = {"fmin": 0.15, "fmax": 0.40}
@@ -124,17 +138,15 @@ def compute_hrv_stats(ibis, sfreq):
     hf_idcs = np.logical_and(freqs >= hf_band["fmin"], freqs < hf_band["fmax"])
 
     # Integrate using the composite trapezoidal rule.
-    vlf = np.trapz(y=psd[vlf_idcs], x=freqs[vlf_idcs])
-    lf = np.trapz(y=psd[lf_idcs], x=freqs[lf_idcs])
-    hf = np.trapz(y=psd[hf_idcs], x=freqs[hf_idcs])
+    vlf = np.trapz(y=psd[..., vlf_idcs], x=freqs[vlf_idcs])
+    lf = np.trapz(y=psd[..., lf_idcs], x=freqs[lf_idcs])
+    hf = np.trapz(y=psd[..., hf_idcs], x=freqs[hf_idcs])
     stats["hrv_vlf"] = vlf
     stats["hrv_lf"] = lf
     stats["hrv_hf"] = hf
     stats["hrv_lf_hf_ratio"] = lf / hf
     stats["hrv_lf_nu"] = (lf / (lf + hf)) * 100
     stats["hrv_hf_nu"] = (hf / (lf + hf)) * 100
-    stats["median_heart_period"] = np.median(ibis)
-    stats["rmssd"] = np.sqrt(np.mean(np.diff(ibis) ** 2))
 
     # plt.figure()
 
@@ -147,8 +159,34 @@ def compute_hrv_stats(ibis, sfreq):
     return stats
 
 
+def compute_time_domain_hrv_stats_segmented(ibis, offsets):
+    """Time-domain HRV statistics of each segment of a ragged batch of IBIs
+    (see ragged_utils.pack()). Returns a dict of arrays with one entry per
+    segment."""
+
+    stats = {}
+    stats["median_heart_period"] = ragged_utils.segment_median(ibis, offsets)
+    diffs, diff_offsets = ragged_utils.segment_diff(ibis, offsets)
+    stats["rmssd"] = np.sqrt(ragged_utils.segment_mean(diffs ** 2, diff_offsets))
+
+    return stats
+
+
+@cache_utils.memoize(version=2, depends_on=["QUANTILE_SKETCH_K"])
+def compute_hrv_stats(ibis, sfreq):
+
+    stats = compute_hrv_spectral_stats(ibis, sfreq)
+    time_domain_stats = compute_time_domain_hrv_stats_segmented(ibis, np.array([0, len(ibis)]))
+    stats.update({key: value[0] for key, value in time_domain_stats.items()})
+
+    return stats
+
+
+@cache_utils.memoize(version=1)
 def compute_coherence(resp, ibis, sfreq):
 
+    resp = np.asarray(resp, dtype=np.float64)
+    ibis = np.asarray(ibis, dtype=np.float64)
     freqs, coh = coherence(resp, ibis, sfreq, nperseg=1024)
 
     lf_band = {"fmin": 0.04, "fmax": 0.15}
@@ -171,19 +209,50 @@ def compute_coherence(resp, ibis, sfreq):
     # plt.show()
 
 
-def compute_local_power(ibis):
-    """Compute local HRV power on interpolated IBI signal."""
-    loc_max, _ = find_peaks(ibis)
-    loc_min, _ = find_peaks(ibis * -1)
-    loc_ext = np.concatenate((loc_max, loc_min))
-    loc_ext.sort(kind="mergesort")
+def local_extrema(ibis, chunk_size=None):
+    """Return the local maxima and minima of ibis in a single, ordered array,
+    identical to the merged and sorted find_peaks() of ibis and -ibis.
+
+    An extreme is where the sign of the first difference changes, ignoring
+    zero differences. The extreme of a plateau is its middle sample (rounded
+    down), as in find_peaks(). If chunk_size is not None, the differences are
+    computed chunk_size samples at a time, such that temporary arrays are
+    bounded in size.
+    """
+    chunk_size = ibis.size if chunk_size is None else chunk_size
+    extrema = []
+    last_idx, last_sign = -1, 0    # last non-zero difference of the preceding chunks
+
+    for beg in range(0, max(ibis.size - 1, 0), chunk_size):
+
+        signs = np.sign(np.diff(ibis[beg:beg + chunk_size + 1]))
+        idcs = np.flatnonzero(signs)
+        idcs, signs = np.r_[last_idx, idcs + beg], np.r_[last_sign, signs[idcs]]
+        turns = np.flatnonzero(signs[:-1] * signs[1:] < 0)    # the difference changes sign
+        extrema.append((idcs[turns] + 1 + idcs[turns + 1]) // 2)    # middle of the plateau from idcs[turns] + 1 to idcs[turns + 1]
+        if idcs.size > 1:
+            last_idx, last_sign = idcs[-1], signs[-1]
+
+    return np.concatenate(extrema) if extrema else np.empty(0, dtype=int)
+
+
+def compute_local_power(ibis, chunk_size=None):
+    """Compute local HRV power on interpolated IBI signal, i.e., the absolute
+    difference between consecutive local extrema, interpolated at every
+    sample. If chunk_size is not None, the extrema and the interpolation are
+    computed chunk_size samples at a time (see local_extrema()), with output
+    identical to computing them at once."""
+    ibis = np.asarray(ibis, dtype=np.float64)
+    loc_ext = local_extrema(ibis, chunk_size)
 
     loc_power = np.abs(np.ediff1d(ibis[loc_ext], to_begin=0))
     loc_power[0] = loc_power[1]
 
-    f_interp = interp1d(loc_ext, loc_power, bounds_error=False,
-                        fill_value=(loc_power[0], loc_power[-1]))
-    inst_loc_power = f_interp(range(ibis.size))
+    chunk_size = ibis.size if chunk_size is None else chunk_size
+    inst_loc_power = np.empty(ibis.size)
+    for beg in range(0, ibis.size, chunk_size):
+        samples = np.arange(beg, min(beg + chunk_size, ibis.size))
+        inst_loc_power[samples] = np.interp(samples, loc_ext, loc_power)    # constant before the first and after the last extreme
 
     return inst_loc_power
 
@@ -197,8 +266,19 @@ def compute_local_power(ibis):
 
 def compute_local_power_hrv_stats(local_power_hrv):
 
+    local_power_hrv = np.asarray(local_power_hrv, dtype=np.float64)
     stats = {}
-    stats["median_local_power_hrv"] = np.median(local_power_hrv)
+    stats["median_local_power_hrv"] = quantile_utils.median(local_power_hrv)
     stats["mean_local_power_hrv"] = np.mean(local_power_hrv)
 
-    return stats
\ No newline at end of file
+    return stats
+
+
+def compute_local_power_hrv_stats_segmented(local_power_hrv, offsets):
+    """compute_local_power_hrv_stats() of each segment of a ragged batch."""
+
+    stats = {}
+    stats["median_local_power_hrv"] = ragged_utils.segment_median(local_power_hrv, offsets)
+    stats["mean_local_power_hrv"] = ragged_utils.segment_mean(local_power_hrv, offsets)
+
+    return stats
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+"""
+
+import time
+import numpy as np
+from fractions import Fraction
+from collections import deque
+from scipy.signal import resample_poly
+from concurrent.futures import ThreadPoolExecutor
+from biofeedback_analyses import config
+from biofeedback_analyses.config import PREFETCH_DEPTH
+
+
+def prefetch(items, load, depth=PREFETCH_DEPTH):
+    """Load the inputs of the next `depth` items on background threads while
+    the current item is being processed.
+
+    At most `depth` loaded items are waiting to be processed at any time,
+    which bounds the memory used by prefetching. Once all items have been
+    processed, print how much of the time spent loading has been hidden behind
+    computation and how much time has been spent waiting for inputs (exposed).
+
+    Parameters
+    ----------
+    items : iterable
+        Items (e.g., paths) that are passed to `load`.
+    load : callable
+        Called as load(item) and returns the loaded inputs of the item.
+        Exceptions raised by `load` are re-raised when the item is yielded.
+    depth : int, optional
+        Number of items that are loaded ahead of time. If depth <= 0, each
+        item is loaded synchronously (on the calling thread) right before it
+        is yielded.
+
+    Yields
+    ------
+    item : object
+        The next item.
+    inputs : object
+        The return value of load(item).
+    """
+    def timed_load(item):
+        t0 = time.perf_counter()
+        inputs = load(item)
+        return inputs, time.perf_counter() - t0
+
+    if depth <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+
+    items = iter(items)
+    pending = deque()
+    t_load = t_exposed = 0
+    n_items = 0
+
+    executor = ThreadPoolExecutor(max_workers=depth)
+    try:
+        for item in items:
+            pending.append((item, executor.submit(timed_load, item)))
+            if len(pending) == depth:
+                break
+
+        while pending:
+            item, future = pending.popleft()
+            t0 = time.perf_counter()
+            inputs, t_item = future.result()
+            t_exposed += time.perf_counter() - t0
+            t_load += t_item
+            n_items += 1
+
+            for next_item in items:    # refill the queue with (at most) one item
+                pending.append((next_item, executor.submit(timed_load, next_item)))
+                break
+
+            yield item, inputs
+    finally:
+        for _, future in pending:    # consumer stopped early
+            future.cancel()
+        executor.shutdown(wait=True)
+
+    if n_items:
+        print(f"Loaded {n_items} input(s) in {t_load:.2f} s: {max(t_load - t_exposed, 0):.2f} s"
+              f" hidden behind computation, {t_exposed:.2f} s exposed.")
+
+
+EDF_UNIT_GAINS = {"uV": 1e-6, "\u03bcV": 1e-6, "\u00b5V": 1e-6, "mV": 1e-3}    # to Volts, other units are left as is (as in MNE)
+
+
+def read_edf_header(path):
+    """Parse the header of an EDF file.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the EDF file.
+
+    Returns
+    -------
+    header : dict
+        Containing the channel "labels" and "units", the number of samples per
+        data record of each channel ("n_samples"), the number of data records
+        ("n_records"), the duration of a data record in seconds
+        ("record_duration"), the size of the header in bytes
+        ("header_bytes"), the sampling frequency of each channel ("sfreq"),
+        the number of samples of each channel ("n_times"), and the calibration
+        ("cal"), offset ("offsets") and unit ("gains") that convert the stored
+        integers to physical values.
+    """
+    with open(path, "rb") as file:
+        fixed = file.read(256)
+        header_bytes = int(fixed[184:192])
+        n_records = int(fixed[236:244])
+        record_duration = float(fixed[244:252]) or 1.0
+        n_channels = int(fixed[252:256])
+
+        variable = file.read(header_bytes - 256)
+        data_bytes = file.seek(0, 2) - header_bytes
+
+    def fields(offset, width):
+        """Return a field of all channels, given the summed widths of the
+        preceding fields and the field's width in bytes."""
+        beg = offset * n_channels
+        return [variable[beg + i * width:beg + (i + 1) * width].decode("latin-1").strip()
+                for i in range(n_channels)]
+
+    labels = fields(0, 16)
+    units = fields(96, 8)    # preceded by label (16) and transducer type (80)
+    physical_min = np.array(fields(104, 8), dtype=float)
+    physical_max = np.array(fields(112, 8), dtype=float)
+    digital_min = np.array(fields(120, 8), dtype=float)
+    digital_max = np.array(fields(128, 8), dtype=float)
+    n_samples = np.array(fields(216, 8), dtype=int)    # preceded by prefiltering (80)
+
+    record_bytes = 2 * n_samples.sum()
+    if n_records < 0 or n_records * record_bytes > data_bytes:    # unknown or truncated recording
+        n_records = data_bytes // record_bytes
+
+    cal = (physical_max - physical_min) / (digital_max - digital_min)
+
+    header = {"labels": labels, "units": units, "n_samples": n_samples,
+              "n_records": n_records, "record_duration": record_duration,
+              "header_bytes": header_bytes,
+              "sfreq": n_samples / record_duration,
+              "n_times": n_records * n_samples,
+              "cal": cal,
+              "offsets": physical_min - digital_min * cal,
+              "gains": np.array([EDF_UNIT_GAINS.get(unit, 1.0) for unit in units])}
+
+    return header
+
+
+def as_signal(values):
+    """Return values as a per-sample signal of dtype config.SIGNAL_DTYPE,
+    without copying if they already are."""
+
+    return np.asarray(values, dtype=config.SIGNAL_DTYPE)
+
+
+def read_edf_channel(path, channel=0, start=0, stop=None, dtype=np.float64,
+                     out=None, header=None):
+    """Read the physical values of a single EDF channel.
+
+    The data records are memory-mapped, such that only the stored integers of
+    the requested channel and samples are read from disk. They are converted
+    to physical values in place in the output buffer, as in MNE's
+    read_raw_edf() (i.e., in Volts for channels stored in uV or mV).
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the EDF file.
+    channel : int, optional
+        Index of the channel.
+    start, stop : int, optional
+        First and last (exclusive) sample of the channel. By default, all
+        samples are read. As when slicing, stop is clipped to the end of the
+        channel and no samples are read if start is at or beyond stop (e.g.,
+        a game window that starts after the end of the recording).
+    dtype : dtype, optional
+        float64 or float32. Ignored if out is provided.
+    out : ndarray, optional
+        Preallocated buffer of stop - start floats into which the samples
+        are written.
+    header : dict, optional
+        The output of read_edf_header(). Pass the header to avoid parsing it
+        again when reading a file repeatedly.
+
+    Returns
+    -------
+    out : ndarray
+        The samples.
+    """
+    if header is None:
+        header = read_edf_header(path)
+    n_samples = header["n_samples"]
+    n_channel = n_samples[channel]
+    n_times = header["n_times"][channel]
+    stop = n_times if stop is None else min(stop, n_times)
+    start = min(start, stop)    # empty, as when slicing
+    if start < 0:
+        raise IndexError(f"Can't read samples {start} to {stop} of {n_times} samples.")
+
+    if out is None:
+        out = np.empty(stop - start, dtype=dtype)
+    if out.shape != (stop - start,):
+        raise ValueError(f"Output buffer has shape {out.shape} instead of ({stop - start},).")
+    if start == stop:
+        return out
+
+    records = np.memmap(path, dtype="<i2", mode="r", offset=header["header_bytes"],
+                        shape=(header["n_records"], n_samples.sum()))
+    col = n_samples[:channel].sum()
+    samples = records[:, col:col + n_channel]    # view, nothing has been read yet
+
+    # Copy (and convert) the first partial record, the full records, and the
+    # last partial record.
+    rec_beg, rec_end = start // n_channel, (stop - 1) // n_channel
+    beg = start - rec_beg * n_channel
+    if rec_beg == rec_end:
+        out[:] = samples[rec_beg, beg:beg + stop - start]
+    else:
+        head = n_channel - beg
+        tail = stop - rec_end * n_channel
+        out[:head] = samples[rec_beg, beg:]
+        out[head:out.size - tail].reshape(-1, n_channel)[:] = samples[rec_beg + 1:rec_end]
+        out[out.size - tail:] = samples[rec_end, :tail]
+    del records
+
+    out *= header["cal"][channel]
+    out += header["offsets"][channel]
+    out *= header["gains"][channel]
+
+    return out
+
+
+def resampling_factors(sfreq, target_sfreq):
+    """Return the up- and downsampling factors that resample sfreq to
+    target_sfreq, e.g., (1, 100) from 1000 Hz to 10 Hz."""
+    ratio = Fraction(target_sfreq / sfreq).limit_denominator(1000)
+
+    return ratio.numerator, ratio.denominator
+
+
+def n_resampled(n_times, sfreq, target_sfreq):
+    """Number of samples of a signal of n_times samples at sfreq once it has
+    been resampled to target_sfreq."""
+    up, down = resampling_factors(sfreq, target_sfreq)
+
+    return -(-n_times * up // down)    # ceil, as resample_poly()
+
+
+def resample(signal, sfreq, target_sfreq):
+    """Resample signal from sfreq to target_sfreq with a polyphase filter,
+    which includes an anti-aliasing low-pass filter (see
+    scipy.signal.resample_poly()). Returns signal as is if the rates are
+    equal."""
+    up, down = resampling_factors(sfreq, target_sfreq)
+    if up == down:
+        return signal
+
+    return resample_poly(np.asarray(signal, dtype=np.float64), up, down)
+
+
+def read_edf_resampled(path, channel=0, start=0, stop=None, sfreq=None,
+                       dtype=np.float64, header=None):
+    """Read a single EDF channel resampled to sfreq (default config.SFREQ).
+
+    start and stop are samples at sfreq. Only the requested samples are
+    resampled, plus a margin on each side that covers the resampling filter.
+    The reading starts at a multiple of the downsampling factor, such that the
+    samples are on the same grid as if the whole channel had been resampled
+    (and are identical up to floating point error). Recordings at sfreq are
+    read as by read_edf_channel().
+    """
+    if header is None:
+        header = read_edf_header(path)
+    sfreq = config.SFREQ if sfreq is None else sfreq
+    native_sfreq = header["sfreq"][channel]
+    up, down = resampling_factors(native_sfreq, sfreq)
+    if up == down:
+        return read_edf_channel(path, channel, start, stop, dtype, header=header)
+
+    n_times = header["n_times"][channel]
+    stop = n_resampled(n_times, native_sfreq, sfreq) if stop is None else min(stop, n_resampled(n_times, native_sfreq, sfreq))
+    start = min(start, stop)    # empty, as by read_edf_channel()
+    margin = -(-10 * max(up, down) // up) + 1    # half the length of resample_poly()'s filter in native samples
+    read_start = max((start * down // up - margin) // down * down, 0)
+    read_stop = min(-(-stop * down // up) + margin, n_times)
+
+    signal = resample(read_edf_channel(path, channel, read_start, read_stop, header=header),
+                      native_sfreq, sfreq)
+    offset = read_start * up // down
+
+    return signal[start - offset:stop - offset].astype(dtype, copy=False)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Signal-quality screening of sessions. Right after the events have been
+formatted, each session is screened (see preprocessing.steps.screen_sessions())
+with indices that are cheap to compute from the raw recording and the events:
+
+    flatline_fraction    fraction of the game's raw respiration in runs of
+                         identical samples of at least QC_FLATLINE_DURATION
+                         seconds (e.g., a detached belt)
+    clipping_fraction    fraction of the game's raw respiration at its
+                         minimum or maximum value (e.g., a saturated belt)
+    ibi_coverage         duration of the IBIs during the game relative to
+                         the game's duration (e.g., a detached Polar belt)
+    sync_residual        largest deviation of a synchronization event from
+                         the synchronization model in seconds
+    game_window          whether the game window can be determined
+
+The indices of a session are saved to
+processed/<subject>/<subject>_<session>_qc, and collected into
+processed/qc_all_sessions at the end of a run. A session fails a check if its
+index is beyond the threshold in config. Each check concerns some of the
+signals ("resp", "ibis", "biofeedback", see CHECK_SIGNALS). If QC_ACTION is
+"skip", the stages that compute a signal skip the sessions that failed a
+check concerning that signal. Otherwise, sessions that failed are processed
+as usual and only flagged in the QC table.
+"""
+
+import numpy as np
+import pandas as pd
+from biofeedback_analyses import config
+from biofeedback_analyses.analysis_utils import event_utils, io_utils
+from biofeedback_analyses.config import (SFREQ, QC_ACTION, QC_FLATLINE_DURATION, QC_MAX_FLATLINE_FRACTION,
+                                         QC_MAX_CLIPPING_FRACTION, QC_MIN_IBI_COVERAGE,
+                                         QC_MAX_SYNC_RESIDUAL)
+
+
+CHECK_SIGNALS = {"flatline_fraction": ["resp"],
+                 "clipping_fraction": ["resp"],
+                 "ibi_coverage": ["ibis"],
+                 "sync_residual": ["resp", "ibis", "biofeedback"],
+                 "game_window": ["resp", "ibis", "biofeedback"]}
+
+
+def flatline_fraction(signal, min_samples):
+    """Fraction of samples in runs of at least min_samples identical
+    consecutive samples."""
+    if signal.size < 2:
+        return np.nan
+    same = np.diff(signal) == 0
+    edges = np.diff(np.concatenate(([0], same.astype(np.int8), [0])))
+    lengths = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1) + 1    # samples per run
+
+    return lengths[lengths >= min_samples].sum() / signal.size
+
+
+def clipping_fraction(signal):
+    """Fraction of samples at the minimum or maximum of the signal."""
+    if not signal.size:
+        return np.nan
+
+    return np.mean((signal == signal.min()) | (signal == signal.max()))
+
+
+def ibi_coverage(events, game):
+    """Summed IBIs (milliseconds) that occur during the game relative to the
+    duration of the game, at most 1."""
+    beg, end = game
+    samples = event_utils.get_eventtimes(events, "InterBeatInterval", as_sample=True)
+    ibis = event_utils.get_eventvalues(events, "InterBeatInterval")
+    covered = ibis[(samples >= beg) & (samples < end)].sum() / 1000
+
+    return min(covered / ((end - beg) / SFREQ), 1.)
+
+
+def sync_residual(sync_model):
+    """Largest absolute residual of the synchronization model in seconds."""
+
+    return np.max(np.abs(sync_model["residuals"]), initial=0) / SFREQ
+
+
+def screen_session(events, sync_model, physio_path=None):
+    """Compute the quality indices of a session.
+
+    Parameters
+    ----------
+    events : DataFrame
+        Formatted events of the session.
+    sync_model : dict
+        The output of event_utils.fit_sync_model().
+    physio_path : Path, optional
+        EDF file of the session. The respiration indices are NaN if it is
+        None.
+
+    Returns
+    -------
+    qc : dict
+        The indices, NaN if they can't be computed (e.g., the IBI coverage
+        without game window).
+    """
+    game = event_utils.get_game_window(events)
+    qc = {"flatline_fraction": np.nan, "clipping_fraction": np.nan,
+          "ibi_coverage": np.nan, "sync_residual": sync_residual(sync_model),
+          "game_window": game is not None}
+
+    if game is not None:
+        qc["ibi_coverage"] = ibi_coverage(events, game)
+
+    if physio_path is not None:
+        header = io_utils.read_edf_header(physio_path)
+        sfreq = header["sfreq"][0]
+        start, stop = 0, None
+        if game is not None:    # game window is in samples at SFREQ, the raw recording isn't resampled
+            start, stop = (int(np.rint(sample * sfreq / SFREQ)) for sample in game)
+        resp = io_utils.read_edf_channel(physio_path, channel=0, start=start, stop=stop,
+                                         header=header, dtype=config.SIGNAL_DTYPE)
+        qc["flatline_fraction"] = flatline_fraction(resp, int(np.rint(QC_FLATLINE_DURATION * sfreq)))
+        qc["clipping_fraction"] = clipping_fraction(resp)
+
+    return qc
+
+
+def failed_checks(qc):
+    """Return the names of the checks that the indices qc fail. Indices that
+    are NaN don't fail."""
+    failed = {"flatline_fraction": qc["flatline_fraction"] > QC_MAX_FLATLINE_FRACTION,
+              "clipping_fraction": qc["clipping_fraction"] > QC_MAX_CLIPPING_FRACTION,
+              "ibi_coverage": qc["ibi_coverage"] < QC_MIN_IBI_COVERAGE,
+              "sync_residual": qc["sync_residual"] > QC_MAX_SYNC_RESIDUAL,
+              "game_window": not qc["game_window"]}
+
+    return [check for check, fails in failed.items() if fails]
+
+
+def qc_path(directory, path):
+    """Return the path of the QC file in directory of the session that path
+    belongs to."""
+
+    return directory.joinpath(f"{path.name[:23]}qc")
+
+
+def skip_session(path, signal, action=QC_ACTION):
+    """Whether a stage that computes signal ("resp", "ibis", or
+    "biofeedback") skips a session, given the session's QC file at path.
+    Sessions are only skipped if action is "skip" and they failed a check
+    that concerns signal. Sessions without QC file aren't skipped."""
+    if action != "skip" or not path.exists():
+        return False
+
+    qc = pd.read_csv(path, sep="\t").iloc[0]
+    failed = [check for check in failed_checks(qc) if signal in CHECK_SIGNALS[check]]
+    if failed:
+        print(f"Skipping {signal} of {path.name[:22]}, failed quality screening ({', '.join(failed)}).")
+
+    return bool(failed)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Mergeable quantile sketches, such that medians can be computed chunk by chunk
+and merged across chunks or workers.
+
+If config.QUANTILE_SKETCH_K is None (default), sketches keep all values and
+quantiles are exact (identical to np.median() and np.quantile()). Otherwise,
+sketches are KLL sketches [1] with parameter k, which retain at most about
+3k values regardless of how many values they summarize. The error of a KLL
+sketch is bounded in rank: the returned quantile has a rank within
++/- epsilon * n of q * n, where n is the number of summarized values. Epsilon
+is O(1/k), e.g., about 1.65 % with 99 % confidence for k = 200 [2].
+benchmarks.benchmark_quantile_sketch() measures the rank error empirically.
+
+References
+----------
+[1] Karnin, Z., Lang, K., & Liberty, E. (2016). Optimal quantile
+approximation in streams. IEEE 57th Annual Symposium on Foundations of
+Computer Science, 71-78.
+[2] https://datasketches.apache.org/docs/KLL/KLLAccuracyAndSize.html
+"""
+
+import numpy as np
+from biofeedback_analyses import config
+
+
+def sketch_init(k=None, seed=0):
+    """Return an empty sketch. Quantiles are exact if k is None. The integer
+    seed seeds the random offsets of the compactions."""
+
+    return {"k": k, "n": 0, "levels": [np.empty(0)], "seed": seed,
+            "rng": np.random.default_rng(seed)}
+
+
+def level_capacity(level, n_levels, k):
+    """Capacity of a level of a KLL sketch. Capacities shrink geometrically
+    (by 2/3) from the top level down."""
+
+    return max(2, int(np.ceil(k * (2 / 3) ** (n_levels - 1 - level))))
+
+
+def compress(sketch):
+    """Compact the lowest level that exceeds its capacity until all levels are
+    within capacity. Compacting a level sorts it and promotes every other
+    value (starting at a random offset) to the next level, where each value
+    represents twice as many values."""
+    levels = sketch["levels"]
+
+    while True:
+        n_levels = len(levels)
+        full = [level for level in range(n_levels)
+                if levels[level].size > level_capacity(level, n_levels, sketch["k"])]
+        if not full:
+            break
+        level = full[0]
+
+        values = np.sort(levels[level])
+        remainder = values[:values.size % 2]    # an odd value stays at its level
+        values = values[values.size % 2:]
+        promoted = values[sketch["rng"].integers(2)::2]
+
+        if level + 1 == n_levels:
+            levels.append(np.empty(0))
+        levels[level] = remainder
+        levels[level + 1] = np.concatenate((levels[level + 1], promoted))
+
+    return sketch
+
+
+def sketch_update(sketch, values):
+    """Add values (e.g., a chunk of a signal) to the sketch in place."""
+    values = np.ravel(values).astype(float)
+    sketch["levels"][0] = np.concatenate((sketch["levels"][0], values))
+    sketch["n"] += values.size
+    if sketch["k"] is not None:
+        compress(sketch)
+
+    return sketch
+
+
+def sketch_merge(*sketches):
+    """Merge sketches with the same k into a new sketch that summarizes all of
+    their values. The seed of the merged sketch is derived from the seeds of
+    the sketches, which are left unchanged (including their random state)."""
+    k = sketches[0]["k"]
+    assert all(sketch["k"] == k for sketch in sketches), "Can't merge sketches with different k."
+
+    seed = np.random.SeedSequence([sketch["seed"] for sketch in sketches]).generate_state(1)[0]
+    merged = sketch_init(k, seed=int(seed))
+    n_levels = max(len(sketch["levels"]) for sketch in sketches)
+    merged["levels"] = [np.concatenate([sketch["levels"][level] for sketch in sketches
+                                        if level < len(sketch["levels"])])
+                        for level in range(n_levels)]
+    merged["n"] = sum(sketch["n"] for sketch in sketches)
+    if k is not None:
+        compress(merged)
+
+    return merged
+
+
+def sketch_quantile(sketch, q):
+    """Return the q-th quantile of the values summarized by the sketch."""
+    if sketch["n"] == 0:
+        return np.nan
+    if sketch["k"] is None:
+        values = sketch["levels"][0]
+        return np.median(values) if q == .5 else np.quantile(values, q)    # identical to np.median()
+
+    values = np.concatenate(sketch["levels"])
+    weights = np.concatenate([np.full(level.size, 2 ** i)
+                              for i, level in enumerate(sketch["levels"])])
+    order = np.argsort(values, kind="stable")
+    cumulative_weights = np.cumsum(weights[order])
+    idx = np.searchsorted(cumulative_weights, q * cumulative_weights[-1])
+
+    return values[order][min(idx, values.size - 1)]
+
+
+def median(values):
+    """Median of values, approximated with a sketch unless
+    config.QUANTILE_SKETCH_K is None."""
+    if config.QUANTILE_SKETCH_K is None:
+        return np.median(values)
+
+    return sketch_quantile(sketch_update(sketch_init(config.QUANTILE_SKETCH_K), values), .5)
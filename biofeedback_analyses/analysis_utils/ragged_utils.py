@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Ragged batches, i.e., signals of different length (e.g., the game windows of
+all sessions of a subject) packed into a single contiguous buffer. Segment i
+is values[offsets[i]:offsets[i + 1]]. Statistics of all short segments (e.g.,
+the durations of the bursts in each session) are computed at once rather than
+with one NumPy call per segment, which is dominated by the overhead of the
+call. Long segments are still reduced with one NumPy call each (see
+LOOP_LENGTH).
+
+Short segments are summed sequentially with np.add.reduceat(), whereas
+np.sum() sums pairwise. Segmented sums, means, and standard deviations of
+short segments can therefore differ from np.sum(), np.mean(), and np.std()
+of the individual segments in the last digits (see the tolerances of the
+segmented functions in equivalence.py).
+"""
+
+import numpy as np
+from biofeedback_analyses import config
+from biofeedback_analyses.analysis_utils import quantile_utils
+
+
+LOOP_LENGTH = 256    # longer segments are reduced with one NumPy call each, since the call overhead is negligible compared to their length
+
+
+def pack(signals):
+    """Pack signals into a ragged batch.
+
+    Parameters
+    ----------
+    signals : list of array
+        One-dimensional signals.
+
+    Returns
+    -------
+    values : array
+        The concatenated signals.
+    offsets : array
+        Start of each signal in values, followed by the size of values.
+    """
+    offsets = np.concatenate(([0], np.cumsum([len(signal) for signal in signals]))).astype(int)
+    values = np.concatenate(signals) if signals else np.empty(0)
+
+    return values, offsets
+
+
+def unpack(values, offsets):
+
+    return np.split(values, offsets[1:-1])
+
+
+def segment_ids(offsets):
+    """Return the index of the segment that each value belongs to."""
+
+    return np.repeat(np.arange(offsets.size - 1), np.diff(offsets))
+
+
+def select(values, offsets, mask):
+    """Return the ragged batch of the segments selected by mask."""
+    lengths = np.diff(offsets)
+    selected_values = values[np.repeat(mask, lengths)]
+    selected_offsets = np.concatenate(([0], np.cumsum(lengths[mask]))).astype(int)
+
+    return selected_values, selected_offsets
+
+
+def segment_sum(values, offsets):
+    """Sum of each segment, 0 for empty segments. Short segments are summed
+    at once with np.add.reduceat(), long segments with np.sum() each."""
+    values = np.asarray(values, dtype=float)
+    lengths = np.diff(offsets)
+    sums = np.zeros(lengths.size)
+
+    long = lengths > LOOP_LENGTH
+    sums[long] = [np.sum(values[beg:end]) for beg, end in zip(offsets[:-1][long], offsets[1:][long])]
+    short = (lengths > 0) & ~long    # np.add.reduceat() returns a value rather than 0 for empty segments
+    if short.any():
+        short_values, short_offsets = select(values, offsets, short)
+        sums[short] = np.add.reduceat(short_values, short_offsets[:-1])
+
+    return sums
+
+
+def segment_mean(values, offsets):
+    """Mean of each segment, equal to np.mean() of each segment up to
+    floating point error (see segment_sum()). NaN for empty segments."""
+    lengths = np.diff(offsets)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = segment_sum(values, offsets) / lengths
+
+    return means
+
+
+def segment_std(values, offsets):
+    """Standard deviation of each segment, equal to np.std() of each segment
+    up to floating point error (see segment_sum())."""
+    lengths = np.diff(offsets)
+    means = segment_mean(values, offsets)
+    deviations = np.asarray(values, dtype=float) - np.repeat(means, lengths)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stds = np.sqrt(segment_sum(deviations * deviations, offsets) / lengths)
+
+    return stds
+
+
+def segment_median(values, offsets):
+    """Median of each segment, identical to np.median() of each segment if
+    config.QUANTILE_SKETCH_K is None, otherwise approximated as in
+    quantile_utils.median()."""
+    values = np.asarray(values, dtype=float)
+    lengths = np.diff(offsets)
+    if config.QUANTILE_SKETCH_K is not None:
+        return np.array([quantile_utils.median(segment) if segment.size else np.nan
+                         for segment in unpack(values, offsets)])
+    long = lengths > LOOP_LENGTH
+    if long.any():
+        medians = np.zeros(lengths.size)
+        medians[long] = [np.median(values[beg:end]) for beg, end in zip(offsets[:-1][long], offsets[1:][long])]
+        medians[~long] = segment_median(*select(values, offsets, ~long))
+        return medians
+
+    order = np.lexsort((values, segment_ids(offsets)))    # sort within segments
+    sorted_values = values[order]
+    medians = np.full(lengths.size, np.nan)
+    nonempty = lengths > 0
+    lower = offsets[:-1][nonempty] + (lengths[nonempty] - 1) // 2
+    upper = offsets[:-1][nonempty] + lengths[nonempty] // 2
+    medians[nonempty] = (sorted_values[lower] + sorted_values[upper]) / 2    # as np.mean() of the middle value(s)
+    medians[segment_sum(np.isnan(values), offsets) > 0] = np.nan    # NaN sorts last, but np.median() propagates it
+
+    return medians
+
+
+def segment_diff(values, offsets):
+    """First differences within each segment, i.e., np.diff() of each
+    segment, as a ragged batch."""
+    diffs = np.diff(values)
+    within = np.ones(diffs.size, dtype=bool)
+    boundaries = offsets[1:-1]
+    within[boundaries[(boundaries > 0) & (boundaries < values.size)] - 1] = False    # differences across segments
+    lengths = np.maximum(np.diff(offsets) - 1, 0)
+    diff_offsets = np.concatenate(([0], np.cumsum(lengths))).astype(int)
+
+    return diffs[within], diff_offsets
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Frozen reference implementations of the analysis functions, i.e., the
+straightforward implementations that the optimized functions in
+event_utils, hrv_utils, resp_utils, biofeedback_utils, window_utils,
+ragged_utils, and io_utils replace. They are kept as they are and must not be
+optimized, since optimized functions are checked against them (see
+equivalence.py).
+
+Outputs are compared per output (e.g., per key of a dict of statistics) with
+an absolute and relative tolerance, as np.allclose(), rather than by hashing
+them, such that a deviation is reported where it occurs.
+"""
+
+import fnmatch
+import numpy as np
+import pandas as pd
+from mne.io import read_raw_edf
+from scipy.signal import hilbert, welch, find_peaks, resample_poly
+from scipy.interpolate import interp1d
+from biopeaks.resp import resp_extrema, resp_stats    # references of resp_utils.resp_extrema() and resp_stats()
+from biofeedback_analyses.analysis_utils import io_utils
+
+
+def instantaneous_amplitude(signal):
+
+    return np.abs(hilbert(signal))
+
+
+def compute_resp_stats(resp, sfreq):
+
+    stats = {}
+    extrema = resp_extrema(resp, sfreq)
+    _, rate, amp = resp_stats(extrema, resp, sfreq)
+    stats["median_resp_rate"] = np.median(rate)
+    stats["median_resp_amp"] = np.median(amp)
+    stats["mean_resp_rate"] = np.mean(rate)
+
+    return stats
+
+
+def compute_resp_power_stats(inst_amp, normalize_by):
+
+    return {"normalized_median_resp_power": np.median(inst_amp) / normalize_by}
+
+
+def compute_hrv_stats(ibis, sfreq):
+
+    stats = {}
+
+    freqs, psd = welch(ibis, fs=sfreq, nperseg=4096)
+
+    vlf_idcs = np.logical_and(freqs >= 0.003, freqs < 0.04)
+    lf_idcs = np.logical_and(freqs >= 0.04, freqs < 0.15)
+    hf_idcs = np.logical_and(freqs >= 0.15, freqs < 0.40)
+
+    vlf = np.trapz(y=psd[vlf_idcs], x=freqs[vlf_idcs])
+    lf = np.trapz(y=psd[lf_idcs], x=freqs[lf_idcs])
+    hf = np.trapz(y=psd[hf_idcs], x=freqs[hf_idcs])
+    stats["hrv_vlf"] = vlf
+    stats["hrv_lf"] = lf
+    stats["hrv_hf"] = hf
+    stats["hrv_lf_hf_ratio"] = lf / hf
+    stats["hrv_lf_nu"] = (lf / (lf + hf)) * 100
+    stats["hrv_hf_nu"] = (hf / (lf + hf)) * 100
+    stats["median_heart_period"] = np.median(ibis)
+    stats["rmssd"] = np.sqrt(np.mean(np.diff(ibis) ** 2))
+
+    return stats
+
+
+def compute_time_domain_hrv_stats(ibis):
+
+    return {"median_heart_period": np.median(ibis),
+            "rmssd": np.sqrt(np.mean(np.diff(ibis) ** 2))}
+
+
+def compute_local_power(ibis):
+    """Local HRV power with find_peaks() and interp1d()."""
+    loc_max, _ = find_peaks(ibis)
+    loc_min, _ = find_peaks(ibis * -1)
+    loc_ext = np.concatenate((loc_max, loc_min))
+    loc_ext.sort(kind="mergesort")
+
+    loc_power = np.abs(np.ediff1d(ibis[loc_ext], to_begin=0))
+    loc_power[0] = loc_power[1]
+
+    f_interp = interp1d(loc_ext, loc_power, bounds_error=False,
+                        fill_value=(loc_power[0], loc_power[-1]))
+
+    return f_interp(range(ibis.size))
+
+
+def compute_local_power_hrv_stats(local_power_hrv):
+
+    return {"median_local_power_hrv": np.median(local_power_hrv),
+            "mean_local_power_hrv": np.mean(local_power_hrv)}
+
+
+def compute_original_resp_biofeedback_stats(original_resp_biofeedback):
+
+    return {"median_original_resp_biofeedback": np.median(original_resp_biofeedback),
+            "mean_original_resp_biofeedback": np.mean(original_resp_biofeedback)}
+
+
+def relativetimes_to_physiosamples(df):
+    """Samples in the physiological recording of the events' timestamps
+    (seconds), from a single fit of the "bitalino.synchronize" events."""
+    sync_idcs = df["event"] == "bitalino.synchronize"
+    phys_sec = df.loc[sync_idcs, "timestamp"].to_numpy(dtype=float)
+    phys_samp = df.loc[sync_idcs, "value"].to_numpy(dtype=float)
+    slope, intcpt = np.polyfit(phys_sec, phys_samp, 1)
+
+    return np.rint(intcpt + df["timestamp"] * slope).astype(int)
+
+
+def per_segment(func, values, offsets, *args):
+    """Apply func to each segment of a ragged batch (see ragged_utils.pack())
+    and collect its statistics into a dict of arrays with one entry per
+    segment, as the *_segmented() functions return them."""
+
+    results = [func(values[beg:end], *args) for beg, end in zip(offsets[:-1], offsets[1:])]
+
+    return {key: np.array([result[key] for result in results]) for key in results[0]} if results else {}
+
+
+def window_stats(signal, window, hop, sfreq, nperseg):
+    """Mean, median, RMSSD, and Welch PSD of each sliding window (see
+    window_utils), with one call per window."""
+    starts = np.arange(0, max(signal.size - window + 1, 0), hop)
+    windows = [signal[start:start + window] for start in starts]
+
+    return {"mean": np.array([np.mean(w) for w in windows]),
+            "median": np.array([np.median(w) for w in windows]),
+            "rmssd": np.array([np.sqrt(np.mean(np.diff(w) ** 2)) for w in windows]),
+            "psd": np.array([welch(w, fs=sfreq, nperseg=min(nperseg, window))[1] for w in windows])}
+
+
+def read_edf_resampled(path, channel, start, stop, sfreq):
+    """Read the whole channel with MNE, resample all of it to sfreq, and
+    return samples start to stop."""
+    raw = read_raw_edf(path, preload=True, verbose="error")
+    up, down = io_utils.resampling_factors(raw.info["sfreq"], sfreq)
+    signal = np.ravel(raw.get_data(picks=channel))
+    if up != down:
+        signal = resample_poly(signal, up, down)
+
+    return signal[start:stop]
+
+
+def lookup_tolerance(name, tolerances):
+    """Return (atol, rtol) of the first pattern in tolerances that matches
+    name (see fnmatch), (0, 0) if none does."""
+
+    for pattern, tolerance in tolerances.items():
+        if fnmatch.fnmatchcase(name, pattern):
+            return tolerance
+
+    return 0, 0
+
+
+def flatten_outputs(outputs):
+    """Return the outputs of a function as a dict of float arrays, keyed by
+    the keys of dicts and the positions of tuples ("" for a single array)."""
+
+    if isinstance(outputs, dict):
+        items = outputs.items()
+    elif isinstance(outputs, (tuple, list)):
+        items = ((str(i), output) for i, output in enumerate(outputs))
+    else:
+        items = [("", outputs)]
+
+    return {key: np.asarray(output, dtype=np.float64) for key, output in items}
+
+
+def deviation(reference, optimized, atol=0, rtol=0):
+    """Return the maximum absolute and relative deviation of optimized from
+    reference, and whether they agree within the tolerances, i.e.,
+    |optimized - reference| <= atol + rtol * |reference| for every element
+    (as np.allclose()). NaN must occur at the same elements. Arrays of
+    different shape deviate infinitely."""
+
+    if reference.shape != optimized.shape:
+        return np.inf, np.inf, False
+    nan = np.isnan(reference)
+    if not np.array_equal(nan, np.isnan(optimized)):
+        return np.inf, np.inf, False
+    reference, optimized = reference[~nan], optimized[~nan]
+    if not reference.size:
+        return 0., 0., True
+
+    absolute = np.abs(optimized - reference)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        relative = np.where(absolute > 0, absolute / np.abs(reference), 0)
+
+    return absolute.max(), relative.max(), bool(np.all(absolute <= atol + rtol * np.abs(reference)))
+
+
+def compare(name, reference, optimized, tolerances, trim=0, scale=False):
+    """Compare the outputs of a reference and optimized function.
+
+    Parameters
+    ----------
+    name : str
+        Name of the function. The tolerances of output "key" are looked up
+        for "<name>.<key>" (see lookup_tolerance()).
+    reference, optimized : array, tuple, or dict
+        Outputs of the functions (see flatten_outputs()).
+    tolerances : dict
+        Pattern: (atol, rtol).
+    trim : int, optional
+        Number of elements at each end of one-dimensional outputs that are
+        not compared, e.g., where edge effects differ by construction.
+    scale : bool, optional
+        Scale the atol of each output by the peak-to-peak range of its
+        reference, e.g., for deviations that scale with the amplitude of a
+        signal rather than with each of its samples.
+
+    Returns
+    -------
+    rows : list of dict
+        One row per output with its "output", "max_abs" and "max_rel"
+        deviation, "atol" (scaled if scale is True), "rtol", and whether it
+        "passed".
+    """
+    reference = flatten_outputs(reference)
+    optimized = flatten_outputs(optimized)
+    rows = []
+
+    for key in reference.keys() | optimized.keys():
+        output = f"{name}.{key}" if key else name
+        atol, rtol = lookup_tolerance(output, tolerances)
+        if key not in reference or key not in optimized:
+            rows.append({"output": output, "max_abs": np.inf, "max_rel": np.inf,
+                         "atol": atol, "rtol": rtol, "passed": False})
+            continue
+        a, b = reference[key], optimized[key]
+        if trim and a.ndim == 1 and b.ndim == 1:
+            a, b = a[trim:a.size - trim], b[trim:b.size - trim]
+        if scale and not np.all(np.isnan(a)):
+            atol = atol * (np.nanmax(a) - np.nanmin(a))
+        max_abs, max_rel, passed = deviation(a, b, atol, rtol)
+        rows.append({"output": output, "max_abs": max_abs, "max_rel": max_rel,
+                     "atol": atol, "rtol": rtol, "passed": passed})
+
+    return sorted(rows, key=lambda row: row["output"])
+
+
+def compare_summaries(summary, reference, tolerances, keys=("subj", "sess", "cond")):
+    """Compare every column of a summary table with a reference summary.
+
+    Rows are matched on keys. Each column is compared with the tolerances of
+    the first pattern that matches its name (see lookup_tolerance()).
+
+    Returns
+    -------
+    table : DataFrame
+        One row per column with its "max_abs" and "max_rel" deviation,
+        "atol", "rtol", whether it "passed", and a "detail" for columns or
+        rows that are missing in either summary.
+    """
+    keys = list(keys)
+    merged = summary.merge(reference, on=keys, how="outer", suffixes=("", "_reference"),
+                           indicator=True)
+    rows = []
+
+    unmatched = merged.loc[merged["_merge"] != "both"]
+    if not unmatched.empty:
+        detail = "; ".join(f"{' '.join(map(str, row[keys]))} only in "
+                           f"{'summary' if row['_merge'] == 'left_only' else 'reference'}"
+                           for _, row in unmatched.iterrows())
+        rows.append({"column": "/".join(keys), "max_abs": np.nan, "max_rel": np.nan,
+                     "atol": np.nan, "rtol": np.nan, "passed": False, "detail": detail})
+    matched = merged.loc[merged["_merge"] == "both"]
+
+    columns = [column for column in reference.columns if column not in keys]
+    columns += [column for column in summary.columns if column not in keys and column not in columns]
+    for column in columns:
+        atol, rtol = lookup_tolerance(column, tolerances)
+        row = {"column": column, "atol": atol, "rtol": rtol, "detail": ""}
+        if column not in summary.columns or column not in reference.columns:
+            row.update({"max_abs": np.nan, "max_rel": np.nan, "passed": False,
+                        "detail": f"only in {'summary' if column in summary.columns else 'reference'}"})
+        else:
+            max_abs, max_rel, passed = deviation(matched[f"{column}_reference"].to_numpy(dtype=np.float64),
+                                                 matched[column].to_numpy(dtype=np.float64), atol, rtol)
+            row.update({"max_abs": max_abs, "max_rel": max_rel, "passed": passed})
+        rows.append(row)
+
+    return pd.DataFrame(rows, columns=["column", "max_abs", "max_rel", "atol", "rtol", "passed", "detail"])
@@ -6,31 +6,219 @@ author: Jan C. Brammer <jan.c.brammer@gmail.com>
 
 import numpy as np
 import pandas as pd
-from scipy.signal import hilbert
-from biopeaks.resp import resp_extrema, resp_stats
-from biopeaks.analysis_utils import find_segments
+from scipy import fft
+from scipy.signal import sosfiltfilt
+from biopeaks.resp import ensure_peak_trough_alternation
+from biopeaks.filters import butter_bandpass_filter
+from biopeaks.analysis_utils import find_segments, interp_stats
+from biofeedback_analyses.analysis_utils import biofeedback_utils, cache_utils, quantile_utils, ragged_utils, sidecar_utils
+from biofeedback_analyses import config
 
 
 def median_inst_amp(paths):
+    """Mean across files of the median instantaneous amplitude of each file.
+    The medians are taken from the files' statistics sidecars if available
+    (see sidecar_utils), otherwise the files are read."""
 
     inst_amps = []
 
     for path in paths:
 
-        data = pd.read_csv(path, sep="\t")
-        inst_amp = np.ravel(data["inst_amp"])
-        inst_amps.append(np.median(inst_amp))
+        sidecar = sidecar_utils.load_sidecar(path)
+        if sidecar is not None and "inst_amp" in sidecar["columns"]:
+            median = sidecar["columns"]["inst_amp"]["median"]
+            inst_amps.append(np.nan if median is None else median)    # None for empty files
+            continue
 
-    return np.mean(inst_amps)
+        # Read in chunks, such that only the sketch is held in memory if
+        # medians are approximated.
+        sketch = quantile_utils.sketch_init(config.QUANTILE_SKETCH_K)
+        for data in pd.read_csv(path, sep="\t", usecols=["inst_amp"],
+                                chunksize=config.BLOCK_DURATION * config.SFREQ):
+            quantile_utils.sketch_update(sketch, data["inst_amp"])
+        inst_amps.append(quantile_utils.sketch_quantile(sketch, .5))
 
+    return np.mean(inst_amps)
 
-def instantaneous_amplitude(signal):
 
-    inst_amp = np.abs(hilbert(signal))
+def hilbert_transform(signal, workers=None):
+    """Compute the Hilbert transform (i.e., the imaginary part of the analytic
+    signal) of a real signal, as scipy.signal.hilbert(). The FFT is computed at
+    the length of the signal, since zero-padding would change the analytic
+    signal (scipy.fft is efficient for any length, including lengths with large
+    prime factors).
+
+    Parameters
+    ----------
+    signal : array
+        Real-valued signal.
+    workers : int, optional
+        Number of threads used for the FFT. Defaults to a single thread.
+
+    Returns
+    -------
+    signal_hilbert : array
+        The Hilbert transform of `signal`.
+    """
+    n_samples = signal.size
+    spectrum = fft.rfft(signal, workers=workers)
+    spectrum[0] = 0    # the Hilbert transform has no DC component ...
+    if n_samples % 2 == 0:
+        spectrum[-1] = 0    # ... and no Nyquist component
+    signal_hilbert = fft.irfft(-1j * spectrum, n_samples, workers=workers)
+
+    return signal_hilbert
+
+
+def circular_margins(beg, end, n_samples, margin):
+    """Return the number of samples that the margins of block [beg, end) lack
+    at the start and at the end of a signal of n_samples samples. The
+    Hilbert transform of the entire signal treats the signal as periodic, so
+    these samples are wrapped around from the other end of the signal."""
+    spare = n_samples - (min(end + margin, n_samples) - max(beg - margin, 0))    # samples outside of the block and its margins
+    left = min(max(margin - beg, 0), spare)
+    right = min(max(end + margin - n_samples, 0), spare - left)
+
+    return left, right
+
+
+def taper_margins(block, margin):
+    """Taper `margin` samples at both ends of a block with raised-cosine
+    ramps. The truncated block then has no discontinuities at its ends, which
+    would otherwise leak into the analytic signal of the block."""
+    ramp = .5 - .5 * np.cos(np.pi * (np.arange(margin) + .5) / margin)
+    block = block.copy()
+    block[:margin] *= ramp
+    block[block.size - margin:] *= ramp[::-1]
+
+    return block
+
+
+def instantaneous_amplitude(signal, blocksize=None, margin=None, workers=None):
+    """Compute the instantaneous amplitude, i.e., the magnitude of the
+    analytic signal.
+    Equivalent to np.abs(scipy.signal.hilbert(signal)) unless it is computed
+    in blocks.
+
+    Parameters
+    ----------
+    signal : array
+        Real-valued signal.
+    blocksize : int, optional
+        If specified, compute the analytic signal in blocks of `blocksize`
+        samples with `margin` overlap on each side (overlap-save). At the ends
+        of the signal, the margins are wrapped around (see
+        circular_margins()). The margins are tapered (see taper_margins())
+        unless a block spans the entire signal. This bounds the FFT length
+        for arbitrarily long inputs. By default, the analytic signal is
+        computed over the entire signal.
+    margin : int, optional
+        Number of samples on each side of a block that are used for computing
+        the analytic signal and then discarded. Defaults to `blocksize`.
+    workers : int, optional
+        Number of threads used for the FFT. Defaults to a single thread.
+
+    Returns
+    -------
+    inst_amp : array
+        Instantaneous amplitude of `signal`.
+    """
+    if blocksize is None or blocksize >= signal.size:
+        return np.hypot(signal, hilbert_transform(signal, workers))
+
+    if margin is None:
+        margin = blocksize
+    n_samples = signal.size
+    inst_amp = np.empty(n_samples)
+
+    for beg in range(0, n_samples, blocksize):
+
+        end = min(beg + blocksize, n_samples)
+        block_beg = max(beg - margin, 0)
+        block_end = min(end + margin, n_samples)
+        left, right = circular_margins(beg, end, n_samples, margin)
+        block = np.concatenate((signal[n_samples - left:], signal[block_beg:block_end], signal[:right]))
+        tapered = taper_margins(block, margin) if block.size < n_samples else block
+        block_amp = np.hypot(block, hilbert_transform(tapered, workers))
+        offset = left - block_beg
+        inst_amp[beg:end] = block_amp[beg + offset:end + offset]
 
     return inst_amp
 
 
+def iter_resp_blocks(read_block, n_samples, sfreq, blocksize, hilbert_margin,
+                     workers=None):
+    """Filter respiration and compute its instantaneous amplitude block by block.
+    Only a single block (plus margins) is held in memory at any time, such that
+    recordings of arbitrary length can be processed out-of-core.
+
+    Each block is read with margins on both sides. The outer margin absorbs
+    the transients of the forward and backward pass of the biofeedback filter
+    (see biofeedback_utils.biofeedback_filter()). The inner margin absorbs the
+    edge effects of the Hilbert transform and is discarded after computing the
+    instantaneous amplitude (overlap-save). At the edges of the recording the
+    outer margins are clipped, so that the blocks reproduce the edge handling
+    of the in-memory filter, and the inner margins are wrapped around from the
+    other end of the recording (see circular_margins()), as in the in-memory
+    Hilbert transform, and tapered (see taper_margins()). The instantaneous
+    amplitude deviates from the in-memory computation only due to the finite
+    inner margin, which can't capture the slowest components of the
+    recording (see equivalence.py).
+
+    Parameters
+    ----------
+    read_block : callable
+        Called as read_block(beg, end) and returns the raw respiration samples
+        in the half-open interval [beg, end).
+    n_samples : int
+        Number of samples in the recording.
+    sfreq : float
+        Sampling frequency of the recording.
+    blocksize : int
+        Number of samples per returned block.
+    hilbert_margin : int
+        Number of samples on each side of a block that are used for computing
+        the Hilbert transform and then discarded.
+    workers : int, optional
+        Number of threads used for the FFT. Defaults to a single thread.
+
+    Yields
+    ------
+    resp_filt : array
+        Filtered respiration of the current block.
+    inst_amp : array
+        Instantaneous amplitude of the current block.
+    """
+    sos = biofeedback_utils.biofeedback_filter_sos(sfreq)
+    filter_margin = biofeedback_utils.filter_transient(sos)
+
+    head = tail = np.empty(0)
+    if n_samples > blocksize:    # filtered samples that are wrapped around into the margins of the first and last block
+        head = sosfiltfilt(sos, read_block(0, min(hilbert_margin + filter_margin, n_samples)))[:hilbert_margin]
+        tail_beg = max(n_samples - hilbert_margin - filter_margin, 0)
+        tail = sosfiltfilt(sos, read_block(tail_beg, n_samples))[-hilbert_margin:]
+
+    for beg in range(0, n_samples, blocksize):
+
+        end = min(beg + blocksize, n_samples)
+        hilbert_beg = max(beg - hilbert_margin, 0)
+        hilbert_end = min(end + hilbert_margin, n_samples)
+        read_beg = max(hilbert_beg - filter_margin, 0)
+        read_end = min(hilbert_end + filter_margin, n_samples)
+
+        resp = read_block(read_beg, read_end)
+        resp_filt = sosfiltfilt(sos, resp)
+        resp_filt = resp_filt[hilbert_beg - read_beg:hilbert_end - read_beg]
+        left, right = circular_margins(beg, end, n_samples, hilbert_margin)
+        block = np.concatenate((tail[tail.size - left:], resp_filt, head[:right]))
+        tapered = taper_margins(block, hilbert_margin) if block.size < n_samples else block
+        inst_amp = np.hypot(block, hilbert_transform(tapered, workers))
+        offset = left - hilbert_beg
+
+        yield (resp_filt[beg - hilbert_beg:end - hilbert_beg],
+               inst_amp[beg + offset:end + offset])
+
+
 def bursts_dual_threshold(inst_amp, low, high, min_duration=0):
 
     above_low = inst_amp > low
@@ -51,13 +239,112 @@ def bursts_dual_threshold(inst_amp, low, high, min_duration=0):
     return bursts
 
 
+def resp_extrema(signal, sfreq):
+    """Detect inhalation peaks and exhalation troughs, identical to
+    biopeaks.resp.resp_extrema(), without a Python loop over breaths.
+
+    Between consecutive zero crossings of the band-pass filtered signal, the
+    extreme is alternately the maximum and the minimum (starting with the
+    maximum if the first crossing is rising), as the first sample that
+    attains the segment's maximum (minimum). Extrema whose vertical
+    difference to their successor is small, and extrema that break the
+    alternation of peaks and troughs, are removed as in biopeaks.
+
+    Parameters
+    ----------
+    signal : array
+        The respiration.
+    sfreq : float
+        Sampling frequency of signal.
+
+    Returns
+    -------
+    extrema : array
+        Alternating samples of peaks and troughs.
+    """
+    signal = butter_bandpass_filter(signal, lowcut=.05, highcut=3, sfreq=sfreq,
+                                    order=2)    # preserve breathing rates > 3 bpm and < 180 bpm
+
+    greater = signal > 0
+    smaller = signal < 0
+    risex = np.flatnonzero(smaller[:-1] & greater[1:])
+    fallx = np.flatnonzero(greater[:-1] & smaller[1:])
+    crossings = np.sort(np.concatenate((risex, fallx)), kind="mergesort")
+
+    # Segment i spans crossings[i]:crossings[i + 1]. Even segments take the
+    # maximum unless the first crossing is falling.
+    begs = crossings[:-1]
+    is_max = np.arange(begs.size) % 2 == (1 if fallx[0] < risex[0] else 0)
+    segment_max = np.maximum.reduceat(signal[:crossings[-1]], begs) if begs.size else np.empty(0)
+    segment_min = np.minimum.reduceat(signal[:crossings[-1]], begs) if begs.size else np.empty(0)
+    target = np.where(is_max, segment_max, segment_min)
+
+    samples = np.arange(crossings[0], crossings[-1])
+    segments = np.repeat(np.arange(begs.size), np.diff(crossings))
+    hits = np.flatnonzero(signal[samples] == target[segments])
+    first = np.diff(segments[hits], prepend=-1) != 0    # the first hit of each segment, as np.argmax()
+    extrema = samples[hits[first]]
+
+    vertdiff = np.abs(np.diff(signal[extrema]))
+    extrema = extrema[np.flatnonzero(vertdiff > np.median(vertdiff) * 0.3)]
+
+    extdiffs = np.sign(np.diff(signal[extrema]))
+    extdiffs = extdiffs[:-1] + extdiffs[1:]
+    extrema = np.delete(extrema, np.flatnonzero(extdiffs != 0) + 1)
+
+    return extrema
+
+
+def breath_stats(extrema, signal, sfreq):
+    """Breath-by-breath statistics, i.e., of each peak that is preceded by a
+    trough, as in biopeaks.resp.resp_stats() before interpolation.
+
+    Returns
+    -------
+    peaks : array
+        Samples of the peaks.
+    period, rate, amp : array
+        Breathing period (seconds since the previous peak, the mean period
+        for the first peak), rate (breaths per minute), and tidal amplitude
+        (peak minus the preceding trough) of each peak.
+    """
+    extrema = ensure_peak_trough_alternation(extrema, signal)
+    amplitudes = signal[extrema]
+
+    first_peak = 0 if amplitudes[0] > amplitudes[1] else 1
+    peak_idcs = np.arange(first_peak, extrema.size, 2)
+    peak_idcs = peak_idcs[peak_idcs > 0]    # a peak without preceding trough has no tidal amplitude
+    peaks = extrema[peak_idcs]
+    amp = amplitudes[peak_idcs] - amplitudes[peak_idcs - 1]
+
+    period = np.ediff1d(peaks, to_begin=0) / sfreq
+    period[0] = np.mean(period[1:])
+    rate = 60 / period
+
+    return peaks, period, rate, amp
+
+
+def resp_stats(extrema, signal, sfreq):
+    """Instantaneous breathing period, rate, and tidal amplitude at every
+    sample of signal, linearly interpolated between peaks (see
+    breath_stats()), identical to biopeaks.resp.resp_stats()."""
+
+    peaks, period, _, amp = breath_stats(extrema, signal, sfreq)
+    period = interp_stats(peaks, period, signal.size)    # np.interp() differs in the last digit, which changes the summary file
+    amp = interp_stats(peaks, amp, signal.size)
+
+    return period, 60 / period, amp
+
+
+@cache_utils.memoize(version=1, depends_on=["QUANTILE_SKETCH_K"])
 def compute_resp_stats(resp, sfreq):
 
+    resp = np.asarray(resp, dtype=np.float64)    # accumulate in float64 regardless of config.SIGNAL_DTYPE
     stats = {}
     extrema = resp_extrema(resp, sfreq)
     _, rate, amp = resp_stats(extrema, resp, sfreq)
-    stats["median_resp_rate"] = np.median(rate)
-    stats["median_resp_amp"] = np.median(amp)
+    stats["median_resp_rate"] = quantile_utils.median(rate)
+    stats["median_resp_amp"] = quantile_utils.median(amp)
     stats["mean_resp_rate"] = np.mean(rate)
 
     return stats
@@ -65,8 +352,18 @@ def compute_resp_stats(resp, sfreq):
 
 def compute_resp_power_stats(inst_amp, normalize_by):
 
+    inst_amp = np.asarray(inst_amp, dtype=np.float64)
     stats = {}
-    stats["normalized_median_resp_power"] = np.median(inst_amp) / normalize_by
+    stats["normalized_median_resp_power"] = quantile_utils.median(inst_amp) / normalize_by
+
+    return stats
+
+
+def compute_resp_power_stats_segmented(inst_amp, offsets, normalize_by):
+    """compute_resp_power_stats() of each segment of a ragged batch."""
+
+    stats = {}
+    stats["normalized_median_resp_power"] = ragged_utils.segment_median(inst_amp, offsets) / normalize_by
 
     return stats
 
@@ -105,3 +402,34 @@ def compute_burst_stats(bursts, sfreq):
     stats["percent_bursts"] = 100 * np.sum(bursts) / len(bursts)
 
     return stats
+
+
+def compute_burst_stats_segmented(bursts, offsets, sfreq):
+    """compute_burst_stats() of each segment of a ragged batch of boolean
+    burst masks. Returns a dict of arrays with one entry per segment."""
+    bursts = np.asarray(bursts, dtype=bool)
+    lengths = np.diff(offsets)
+    segment_starts = np.zeros(bursts.size, dtype=bool)
+    segment_starts[offsets[:-1][lengths > 0]] = True
+    segment_ends = np.zeros(bursts.size, dtype=bool)
+    segment_ends[offsets[1:][lengths > 0] - 1] = True
+
+    # Bursts don't continue across segments.
+    previous = np.r_[False, bursts[:-1]] & ~segment_starts
+    following = np.r_[bursts[1:], False] & ~segment_ends
+    starts, = np.nonzero(bursts & ~previous)
+    ends, = np.nonzero(bursts & ~following)
+    durations = ends + 1 - starts
+    burst_offsets = np.searchsorted(starts, offsets)
+
+    n_bursts = np.diff(burst_offsets)
+    has_bursts = n_bursts > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        percent_bursts = 100 * ragged_utils.segment_sum(bursts, offsets) / lengths
+
+    stats = {"n_bursts": n_bursts,
+             "mean_duration_bursts": np.where(has_bursts, ragged_utils.segment_mean(durations, burst_offsets) / sfreq, 0),
+             "std_duration_bursts": np.where(has_bursts, ragged_utils.segment_std(durations, burst_offsets) / sfreq, 0),
+             "percent_bursts": np.where(has_bursts, percent_bursts, 0)}
+
+    return stats
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Statistics sidecars of preprocessed files. Along with each file, the
+preprocessing steps save a small JSON file (<file>_stats.json) with the
+file's length, the game window of the session (in samples), and the min,
+max, mean, median, and config.SIDECAR_PERCENTILES of each column. Subject
+level aggregates (e.g., the burst thresholds in resp_utils.median_inst_amp())
+are computed from the sidecars instead of re-reading the files.
+
+The statistics describe the values as written, i.e., rounded to the decimals
+of the file's float format, such that they are identical to the statistics
+of the re-read file. Medians and percentiles are computed with
+quantile_utils, i.e., they are approximated if config.QUANTILE_SKETCH_K is
+set. Files that are written block by block (see
+preprocessing.steps.preprocess_resp_blockwise()) are summarized block by
+block.
+"""
+
+import json
+import numpy as np
+from biofeedback_analyses import config
+from biofeedback_analyses.analysis_utils import quantile_utils
+
+
+def sidecar_path(path):
+    """Return the path of the sidecar of the file at path."""
+
+    return path.with_name(f"{path.name}_stats.json")
+
+
+def stats_init(columns):
+    """Return empty running statistics of columns."""
+
+    return {"n_samples": 0,
+            "columns": {column: {"min": np.inf, "max": -np.inf, "sum": 0.,
+                                 "sketch": quantile_utils.sketch_init(config.QUANTILE_SKETCH_K)}
+                        for column in columns}}
+
+
+def stats_update(stats, data, decimals=4):
+    """Update running statistics in place with a block of data (DataFrame),
+    rounded to decimals."""
+
+    for column, column_stats in stats["columns"].items():
+        values = np.round(np.asarray(data[column], dtype=float), decimals)    # as written with float_format="%.{decimals}f"
+        column_stats["min"] = min(column_stats["min"], np.min(values, initial=np.inf))
+        column_stats["max"] = max(column_stats["max"], np.max(values, initial=-np.inf))
+        column_stats["sum"] += np.sum(values)
+        quantile_utils.sketch_update(column_stats["sketch"], values)
+    stats["n_samples"] += len(data)
+
+    return stats
+
+
+def stats_finalize(stats, game=None):
+    """Return the content of a sidecar from running statistics.
+
+    Parameters
+    ----------
+    stats : dict
+        Running statistics, see stats_init() and stats_update().
+    game : tuple of int, optional
+        First and last sample of the game, None if unknown.
+
+    Returns
+    -------
+    sidecar : dict
+        With "n_samples", "game" ({"beg", "end"} or None), and the statistics
+        of each column in "columns".
+    """
+    n_samples = stats["n_samples"]
+    sidecar = {"n_samples": n_samples,
+               "game": None if game is None else {"beg": int(game[0]), "end": int(game[1])},
+               "columns": {}}
+
+    for column, column_stats in stats["columns"].items():
+        sketch = column_stats["sketch"]
+        sidecar["columns"][column] = {
+            "min": float(column_stats["min"]) if n_samples else None,
+            "max": float(column_stats["max"]) if n_samples else None,
+            "mean": column_stats["sum"] / n_samples if n_samples else None,
+            "median": float(quantile_utils.sketch_quantile(sketch, .5)) if n_samples else None,
+            "percentiles": {str(q): float(quantile_utils.sketch_quantile(sketch, q / 100)) if n_samples else None
+                            for q in config.SIDECAR_PERCENTILES}}
+
+    return sidecar
+
+
+def save_sidecar(path, sidecar):
+    """Save a sidecar next to the file at path."""
+    with open(sidecar_path(path), "w") as file:
+        json.dump(sidecar, file, indent=1)
+
+
+def write_sidecar(path, data, game=None, decimals=4, columns=None):
+    """Summarize the DataFrame that has been written to path and save the
+    sidecar of path. Summarize all columns if columns is None."""
+
+    stats = stats_update(stats_init(data.columns if columns is None else columns), data, decimals)
+    save_sidecar(path, stats_finalize(stats, game))
+
+
+def load_sidecar(path):
+    """Return the sidecar of the file at path, or None if it doesn't exist or
+    is older than the file (e.g., the file has been re-written by an earlier
+    version)."""
+    sidecar = sidecar_path(path)
+    if not sidecar.exists() or sidecar.stat().st_mtime < path.stat().st_mtime:
+        return None
+    with open(sidecar) as file:
+        return json.load(file)
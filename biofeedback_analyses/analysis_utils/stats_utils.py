@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+"""
+
+import multiprocessing
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from concurrent.futures import ProcessPoolExecutor
+
+
+def resample_mean_diffs(x, y, seed_seq, n_resamples):
+    """Draw a batch of bootstrap resamples of the mean difference (y - x) of
+    all metrics at once.
+
+    Parameters
+    ----------
+    x, y : array
+        Observations (rows) of all metrics (columns) for both groups.
+    seed_seq : SeedSequence
+        Seeds the random stream of the batch.
+    n_resamples : int
+        Number of resamples in the batch.
+
+    Returns
+    -------
+    diffs : array
+        Resampled mean differences with shape (n_resamples, n_metrics).
+    """
+    rng = np.random.default_rng(seed_seq)
+    idcs_x = rng.integers(0, x.shape[0], size=(n_resamples, x.shape[0]))
+    idcs_y = rng.integers(0, y.shape[0], size=(n_resamples, y.shape[0]))
+    diffs = y[idcs_y].mean(axis=1) - x[idcs_x].mean(axis=1)
+
+    return diffs
+
+
+def permute_mean_diffs(x, y, seed_seq, n_resamples):
+    """Draw a batch of mean differences (y - x) of all metrics at once under
+    random permutations of the group labels."""
+    rng = np.random.default_rng(seed_seq)
+    pooled = np.concatenate((x, y))
+    idcs = rng.permuted(np.tile(np.arange(pooled.shape[0]), (n_resamples, 1)), axis=1)
+    diffs = (pooled[idcs[:, :y.shape[0]]].mean(axis=1) -
+             pooled[idcs[:, y.shape[0]:]].mean(axis=1))
+
+    return diffs
+
+
+def run_batches(func, x, y, seed_seq, n_resamples, batch_size, n_jobs):
+    """Evaluate func in batches with independent random streams. Since each
+    batch has its own stream, the result doesn't depend on n_jobs."""
+    batch_sizes = [batch_size] * (n_resamples // batch_size)
+    if n_resamples % batch_size:
+        batch_sizes.append(n_resamples % batch_size)
+    seed_seqs = seed_seq.spawn(len(batch_sizes))
+
+    if n_jobs == 1:
+        batches = map(func, [x] * len(batch_sizes), [y] * len(batch_sizes),
+                      seed_seqs, batch_sizes)
+        return np.concatenate(list(batches))
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        batches = executor.map(func, [x] * len(batch_sizes), [y] * len(batch_sizes),
+                               seed_seqs, batch_sizes)
+        return np.concatenate(list(batches))
+
+
+def bca_interval(diffs, observed, jackknife, alpha):
+    """Bias-corrected and accelerated bootstrap confidence interval [1] of
+    every metric (column).
+
+    References
+    ----------
+    [1] Efron, B. (1987). Better bootstrap confidence intervals. Journal of
+    the American Statistical Association, 82(397), 171-185.
+    """
+    n_resamples = diffs.shape[0]
+    # Keep the bias correction finite for (near) constant metrics.
+    proportion = np.clip(np.mean(diffs < observed, axis=0), 1 / n_resamples,
+                         1 - 1 / n_resamples)
+    z0 = norm.ppf(proportion)
+    jackknife_mean = jackknife.mean(axis=0)
+    numerator = np.sum((jackknife_mean - jackknife) ** 3, axis=0)
+    denominator = 6 * np.sum((jackknife_mean - jackknife) ** 2, axis=0) ** 1.5
+    acceleration = np.divide(numerator, denominator, out=np.zeros_like(numerator),
+                             where=denominator > 0)
+
+    z_alpha = norm.ppf([alpha / 2, 1 - alpha / 2])[:, np.newaxis]
+    quantiles = norm.cdf(z0 + (z0 + z_alpha) / (1 - acceleration * (z0 + z_alpha)))
+
+    # Linear interpolation between order statistics, per metric.
+    diffs_sorted = np.sort(diffs, axis=0)
+    position = quantiles * (n_resamples - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, n_resamples - 1)
+    weight = position - lower
+    ci = ((1 - weight) * np.take_along_axis(diffs_sorted, lower, axis=0) +
+          weight * np.take_along_axis(diffs_sorted, upper, axis=0))
+
+    return ci[0], ci[1]
+
+
+def mean_diff_contrasts(x, y, n_resamples=5000, alpha=.05, seed=12345,
+                        batch_size=500, n_jobs=1, return_resamples=False):
+    """Compute the mean difference (y - x) of all metrics, its bootstrap
+    confidence interval, and its two-sided permutation p-value.
+
+    Parameters
+    ----------
+    x, y : array
+        Observations (rows) of all metrics (columns) for both groups. Must not
+        contain NaN.
+    n_resamples : int, optional
+        Number of bootstrap resamples and of permutations.
+    alpha : float, optional
+        The confidence interval covers 1 - alpha.
+    seed : int, optional
+        Seed of the random streams.
+    batch_size : int, optional
+        Number of resamples that are drawn at once. Bounds memory usage.
+    n_jobs : int, optional
+        Number of processes among which batches are distributed.
+    return_resamples : bool, optional
+        Also return the bootstrap resamples of the mean difference.
+
+    Returns
+    -------
+    contrasts : dict
+        Arrays with one entry per metric.
+    diffs : array
+        Bootstrap resamples of the mean difference with shape (n_resamples,
+        n_metrics). Only returned if return_resamples is True.
+    """
+    observed = y.mean(axis=0) - x.mean(axis=0)
+    bootstrap_seq, permutation_seq = np.random.SeedSequence(seed).spawn(2)
+
+    diffs = run_batches(resample_mean_diffs, x, y, bootstrap_seq, n_resamples,
+                        batch_size, n_jobs)
+    # Leave-one-out means of each group, see dabest.
+    jackknife = np.concatenate((y.mean(axis=0) - (x.sum(axis=0) - x) / (x.shape[0] - 1),
+                                (y.sum(axis=0) - y) / (y.shape[0] - 1) - x.mean(axis=0)))
+    ci_low, ci_high = bca_interval(diffs, observed, jackknife, alpha)
+
+    permuted_diffs = run_batches(permute_mean_diffs, x, y, permutation_seq,
+                                 n_resamples, batch_size, n_jobs)
+    n_extreme = np.sum(np.abs(permuted_diffs) >= np.abs(observed), axis=0)
+    pvalue = (n_extreme + 1) / (n_resamples + 1)
+
+    contrasts = {"mean_diff": observed, "ci_low": ci_low, "ci_high": ci_high,
+                 "pvalue_permutation": pvalue}
+    if return_resamples:
+        return contrasts, diffs
+
+    return contrasts
+
+
+def contrast_table(df, metrics, group_col, control, test, return_resamples=False,
+                   **kwargs):
+    """Compute mean_diff_contrasts() of test minus control for all metrics.
+    Metrics whose missing values occur in the same rows share their
+    resamples, such that usually all metrics are resampled at once.
+
+    Returns
+    -------
+    table : DataFrame
+        One row per metric. Metrics with fewer than two observations per
+        group are omitted.
+    resamples : DataFrame
+        Bootstrap resamples of the mean difference with one column per metric
+        in table, e.g., for plotting the bootstrap distribution. Only returned
+        if return_resamples is True.
+    """
+    metrics = list(metrics)
+    df = df.loc[df[group_col].isin([control, test])]
+    is_test = (df[group_col] == test).to_numpy()
+    values = df[metrics].to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+
+    rows = []
+    resamples = {}
+    patterns, pattern_idcs = np.unique(valid, axis=1, return_inverse=True)
+    for i, pattern in enumerate(patterns.T):
+        columns = np.flatnonzero(np.ravel(pattern_idcs) == i)
+        x = values[pattern & ~is_test][:, columns]
+        y = values[pattern & is_test][:, columns]
+        if min(x.shape[0], y.shape[0]) < 2:
+            continue
+        contrasts, diffs = mean_diff_contrasts(x, y, return_resamples=True, **kwargs)
+        for j, column in enumerate(columns):
+            resamples[metrics[column]] = diffs[:, j]
+            row = {"metric": metrics[column], f"n_{control}": x.shape[0],
+                   f"n_{test}": y.shape[0], f"mean_{control}": x[:, j].mean(),
+                   f"mean_{test}": y[:, j].mean()}
+            row.update({key: value[j] for key, value in contrasts.items()})
+            rows.append(row)
+
+    rows.sort(key=lambda row: metrics.index(row["metric"]))
+    table = pd.DataFrame(rows)
+    if return_resamples:
+        return table, pd.DataFrame({row["metric"]: resamples[row["metric"]] for row in rows})
+
+    return table
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Statistics of all sliding windows of a signal at once. Windows of `window`
+samples start every `hop` samples, i.e., window i is
+signal[i * hop:i * hop + window]. Only windows that lie entirely within the
+signal are computed.
+
+Work that overlapping windows share is done once: means are differences of a
+single cumulative sum, medians are computed on strided views of the signal
+(no copy of the windows), and band powers average periodograms of Welch
+segments that are computed once, even if they belong to several windows.
+"""
+
+import numpy as np
+from scipy import fft
+from scipy.signal import get_window
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def window_starts(n_samples, window, hop):
+    """Return the first sample of each window that lies entirely within
+    n_samples."""
+
+    return np.arange(0, max(n_samples - window + 1, 0), hop)
+
+
+def sliding_windows(signal, window, hop):
+    """Return the windows of signal as a strided (read-only) view of shape
+    (n_windows, window)."""
+    if signal.size < window:
+        return np.empty((0, window), dtype=signal.dtype)
+
+    return sliding_window_view(signal, window)[::hop]
+
+
+def window_mean(signal, window, hop):
+    """Mean of each window, from the differences of the cumulative sum of
+    signal. Identical to np.mean() of each window up to floating point error.
+    NaN for windows that contain NaN."""
+    signal = np.asarray(signal, dtype=np.float64)
+    starts = window_starts(signal.size, window, hop)
+    if not starts.size:
+        return np.empty(0)
+    finite = signal[:window][np.isfinite(signal[:window])]
+    reference = finite.mean() if finite.size else 0    # summing deviations from a reference reduces cancellation
+    cumsum = np.concatenate(([0], np.cumsum(np.nan_to_num(signal - reference))))
+    n_nan = np.concatenate(([0], np.cumsum(np.isnan(signal))))
+
+    means = (cumsum[starts + window] - cumsum[starts]) / window + reference
+    means[n_nan[starts + window] - n_nan[starts] > 0] = np.nan
+
+    return means
+
+
+def window_median(signal, window, hop, chunk_size=256):
+    """Median of each window. Windows are copied chunk_size at a time, such
+    that memory is bounded regardless of the number of windows."""
+    signal = np.asarray(signal, dtype=np.float64)
+    windows = sliding_windows(signal, window, hop)
+    medians = np.empty(windows.shape[0])
+
+    for beg in range(0, windows.shape[0], chunk_size):
+        medians[beg:beg + chunk_size] = np.median(windows[beg:beg + chunk_size], axis=1)
+
+    return medians
+
+
+def window_rmssd(signal, window, hop):
+    """Root mean square of successive differences within each window. The
+    squared differences are computed once for the whole signal."""
+    squared_diffs = np.diff(np.asarray(signal, dtype=np.float64)) ** 2
+
+    return np.sqrt(window_mean(squared_diffs, window - 1, hop))
+
+
+def periodograms(signal, starts, nperseg, sfreq, workers=None):
+    """One-sided power spectral densities of the segments
+    signal[start:start + nperseg], each detrended (constant) and tapered
+    with a Hann window, as the segments of scipy.signal.welch(). Returns
+    (freqs, psds) with one PSD per start."""
+    taper = get_window("hann", nperseg)
+    segments = signal[starts[:, np.newaxis] + np.arange(nperseg)]
+    segments = segments - segments.mean(axis=1, keepdims=True)
+
+    spectra = fft.rfft(segments * taper, axis=1, workers=workers)
+    psds = (spectra.real ** 2 + spectra.imag ** 2) / (sfreq * np.sum(taper ** 2))
+    psds[:, 1:nperseg // 2 + nperseg % 2] *= 2    # one-sided, excluding DC and Nyquist
+    freqs = fft.rfftfreq(nperseg, 1 / sfreq)
+
+    return freqs, psds
+
+
+def window_welch(signal, window, hop, sfreq, nperseg, workers=None):
+    """Welch's PSD of each window (segments of nperseg samples that overlap
+    by half, averaged with the mean), identical to scipy.signal.welch() of
+    each window up to floating point error.
+
+    Returns
+    -------
+    freqs : array
+        Frequencies of the PSDs.
+    psds : array
+        Shape (n_windows, freqs.size).
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    nperseg = min(nperseg, window)
+    step = nperseg - nperseg // 2
+    starts = window_starts(signal.size, window, hop)
+    segment_offsets = np.arange(0, window - nperseg + 1, step)
+
+    segment_starts = starts[:, np.newaxis] + segment_offsets    # (n_windows, n_segments)
+    unique_starts, idcs = np.unique(segment_starts, return_inverse=True)    # segments shared by overlapping windows
+    freqs, psds = periodograms(signal, unique_starts, nperseg, sfreq, workers)
+    window_psds = psds[idcs.reshape(segment_starts.shape)].mean(axis=1)
+
+    return freqs, window_psds
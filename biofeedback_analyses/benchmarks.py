@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Benchmarks of optimized code paths against the implementations they replace.
+Run with `python -m biofeedback_analyses.benchmarks`.
+"""
+
+import timeit
+import tracemalloc
+import numpy as np
+from pathlib import Path
+from scipy.signal import hilbert, welch
+from mne.io import read_raw_edf
+from biopeaks import resp as biopeaks_resp
+from biofeedback_analyses import config, sessions
+from biofeedback_analyses.config import SFREQ
+from biofeedback_analyses.analysis_utils import resp_utils, hrv_utils, io_utils, quantile_utils, ragged_utils, window_utils, reference_utils
+
+
+def next_prime(n):
+    """Return the smallest prime that is greater or equal to n."""
+    while True:
+        if n > 1 and all(n % d for d in range(2, int(np.sqrt(n)) + 1)):
+            return n
+        n += 1
+
+
+def synthetic_resp(n_samples, sfreq=SFREQ, seed=42):
+    """Simulate a respiration signal with slowly varying rate and amplitude."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_samples) / sfreq
+    rate = .25 + .05 * np.sin(2 * np.pi * t / 600)    # Hz
+    phase = 2 * np.pi * np.cumsum(rate) / sfreq
+    amp = 1 + .3 * np.sin(2 * np.pi * t / 300)
+    resp = amp * np.sin(phase) + rng.normal(0, .05, n_samples)
+
+    return resp
+
+
+def synthetic_ibis(n_samples, sfreq=SFREQ, seed=42):
+    """Simulate interpolated IBIs (milliseconds) that oscillate at 0.1 Hz and
+    drift slowly. Rounding produces plateaus."""
+    rng = np.random.default_rng(seed)
+    ibis = np.round(800 + 50 * np.sin(2 * np.pi * np.arange(n_samples) / (10 * sfreq)) +
+                    rng.normal(0, 5, n_samples).cumsum() * .01, 1)
+
+    return ibis
+
+
+def benchmark_instantaneous_amplitude(durations=(1, 8, 24), repeats=3,
+                                      workers=None):
+    """Compare resp_utils.instantaneous_amplitude() with
+    np.abs(scipy.signal.hilbert()) on signals whose length is a prime number
+    (i.e., worst case for the FFT) of roughly the requested durations in hours.
+
+    Maximum absolute deviation is reported for the whole signal, and for the
+    blockwise computation separately.
+    """
+    print(f"{'samples':>10} {'hilbert [s]':>12} {'rfft [s]':>9} "
+          f"{'blockwise [s]':>14} {'max dev':>9} {'max dev blockwise':>18}")
+
+    for duration in durations:
+
+        n_samples = next_prime(int(duration * 3600 * SFREQ))
+        resp = synthetic_resp(n_samples)
+
+        t_hilbert = min(timeit.repeat(lambda: np.abs(hilbert(resp)),
+                                      number=1, repeat=repeats))
+        t_rfft = min(timeit.repeat(lambda: resp_utils.instantaneous_amplitude(resp, workers=workers),
+                                   number=1, repeat=repeats))
+        t_blocks = min(timeit.repeat(lambda: resp_utils.instantaneous_amplitude(resp, blocksize=36000,
+                                                                                margin=3000,
+                                                                                workers=workers),
+                                     number=1, repeat=repeats))
+
+        reference = np.abs(hilbert(resp))
+        deviation = np.abs(resp_utils.instantaneous_amplitude(resp) - reference)
+        deviation_blocks = np.abs(resp_utils.instantaneous_amplitude(resp, blocksize=36000, margin=3000) -
+                                  reference)
+        print(f"{n_samples:>10} {t_hilbert:>12.3f} {t_rfft:>9.3f} "
+              f"{t_blocks:>14.3f} {deviation.max():>9.2e} {deviation_blocks.max():>18.2e}")
+
+
+def peak_memory(func):
+    """Return the peak memory (bytes) allocated while calling func."""
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak
+
+
+def benchmark_resp_extrema(durations=(1, 8, 24), sfreq=SFREQ, repeats=3):
+    """Compare resp_utils.resp_extrema() and resp_stats() with biopeaks on
+    synthetic respiration of each duration (hours), and make sure that both
+    return identical extrema and instantaneous rate and amplitude."""
+    print(f"{'duration [h]':>13} {'breaths':>8} {'biopeaks [s]':>13} {'resp_utils [s]':>15} {'identical':>10}")
+
+    for duration in durations:
+
+        resp = synthetic_resp(int(duration * 3600 * sfreq), sfreq)
+
+        def run_biopeaks():
+            extrema = biopeaks_resp.resp_extrema(resp, sfreq)
+            return (extrema, *biopeaks_resp.resp_stats(extrema, resp, sfreq))
+
+        def run_resp_utils():
+            extrema = resp_utils.resp_extrema(resp, sfreq)
+            return (extrema, *resp_utils.resp_stats(extrema, resp, sfreq))
+
+        t_biopeaks = min(timeit.repeat(run_biopeaks, number=1, repeat=repeats))
+        t_resp_utils = min(timeit.repeat(run_resp_utils, number=1, repeat=repeats))
+        identical = all(np.array_equal(a, b) for a, b in zip(run_biopeaks(), run_resp_utils()))
+        n_breaths = resp_utils.breath_stats(resp_utils.resp_extrema(resp, sfreq), resp, sfreq)[0].size
+        print(f"{duration:>13} {n_breaths:>8} {t_biopeaks:>13.3f} {t_resp_utils:>15.3f} {str(identical):>10}")
+
+
+def benchmark_local_power(durations=(1, 8, 24), chunk_duration=3600, sfreq=SFREQ,
+                          repeats=3):
+    """Compare hrv_utils.compute_local_power() (at once and in chunks of
+    chunk_duration seconds) with the implementation based on find_peaks()
+    (see reference_utils.compute_local_power()) on synthetic IBIs of each duration (hours)."""
+    print(f"{'duration [h]':>13} {'find_peaks [s]':>15} {'at once [s]':>12} {'chunked [s]':>12} "
+          f"{'max dev':>8} {'chunked identical':>18}")
+
+    for duration in durations:
+
+        n_samples = int(duration * 3600 * sfreq)
+        ibis = synthetic_ibis(n_samples, sfreq)
+        chunk_size = int(chunk_duration * sfreq)
+
+        t_find_peaks = min(timeit.repeat(lambda: reference_utils.compute_local_power(ibis), number=1, repeat=repeats))
+        t_once = min(timeit.repeat(lambda: hrv_utils.compute_local_power(ibis), number=1, repeat=repeats))
+        t_chunked = min(timeit.repeat(lambda: hrv_utils.compute_local_power(ibis, chunk_size),
+                                      number=1, repeat=repeats))
+        once = hrv_utils.compute_local_power(ibis)
+        deviation = np.max(np.abs(once - reference_utils.compute_local_power(ibis)))
+        identical = np.array_equal(once, hrv_utils.compute_local_power(ibis, chunk_size))
+        print(f"{duration:>13} {t_find_peaks:>15.3f} {t_once:>12.3f} {t_chunked:>12.3f} "
+              f"{deviation:>8.1e} {str(identical):>18}")
+
+
+def benchmark_edf_reader(paths=None, repeats=3):
+    """Compare io_utils.read_edf_channel() with MNE's read_raw_edf() when
+    reading the respiration channel (as the pipelines did before), and make
+    sure that both return identical samples.
+
+    By default, all EDF files in the "raw" directory in the current working
+    directory are compared.
+    """
+    if paths is None:
+        paths = sorted(Path.cwd().joinpath("raw").glob("*/*.edf"))
+    if not paths:
+        print("Didn't find EDF files to benchmark the EDF reader on.")
+        return
+
+    def read_mne(path):
+        return np.ravel(read_raw_edf(path, preload=True, verbose="error").get_data(picks=0))
+
+    print(f"{'file':>40} {'mne [s]':>8} {'memmap [s]':>11} {'mne [MB]':>9} "
+          f"{'memmap [MB]':>12} {'identical':>10} {'max dev float32':>16}")
+
+    for path in paths:
+
+        reference = read_mne(path)
+        identical = np.array_equal(io_utils.read_edf_channel(path, channel=0), reference)
+        deviation = np.abs(io_utils.read_edf_channel(path, channel=0, dtype=np.float32) - reference)
+
+        t_mne = min(timeit.repeat(lambda: read_mne(path), number=1, repeat=repeats))
+        t_memmap = min(timeit.repeat(lambda: io_utils.read_edf_channel(path, channel=0),
+                                     number=1, repeat=repeats))
+        mem_mne = peak_memory(lambda: read_mne(path))
+        mem_memmap = peak_memory(lambda: io_utils.read_edf_channel(path, channel=0))
+
+        print(f"{Path(path).name:>40} {t_mne:>8.3f} {t_memmap:>11.3f} {mem_mne / 1e6:>9.1f} "
+              f"{mem_memmap / 1e6:>12.1f} {str(identical):>10} {deviation.max():>16.2e}")
+
+
+def benchmark_quantile_sketch(ks=(50, 200, 800), n_samples=24 * 3600 * SFREQ,
+                              n_chunks=24, n_trials=20):
+    """Measure the rank error of the median of quantile_utils sketches that
+    are updated chunk by chunk (e.g., an hour at a time), and merged from
+    two halves (e.g., two workers), on a day of synthetic respiration. The
+    rank error is the distance between the rank of the approximate median and
+    n / 2, relative to n."""
+    resp = synthetic_resp(n_samples)
+    sorted_resp = np.sort(resp)
+    chunks = np.array_split(resp, n_chunks)
+
+    t_exact = min(timeit.repeat(lambda: np.median(resp), number=1, repeat=3))
+    print(f"Exact median of {n_samples} samples in {t_exact:.3f} s.")
+    print(f"{'k':>5} {'retained':>9} {'time [s]':>9} {'max rank error':>15} "
+          f"{'max rank error merged':>22}")
+
+    for k in ks:
+
+        errors, errors_merged = [], []
+        for trial in range(n_trials):
+            sketches = []
+            for half in np.array_split(np.arange(n_chunks), 2):
+                sketch = quantile_utils.sketch_init(k, seed=trial)
+                for i in half:
+                    quantile_utils.sketch_update(sketch, chunks[i])
+                sketches.append(sketch)
+            merged = quantile_utils.sketch_merge(*sketches)
+
+            sketch = quantile_utils.sketch_init(k, seed=trial)
+            t0 = timeit.default_timer()
+            for chunk in chunks:
+                quantile_utils.sketch_update(sketch, chunk)
+            t_sketch = timeit.default_timer() - t0
+
+            for s, e in [(sketch, errors), (merged, errors_merged)]:
+                rank = np.searchsorted(sorted_resp, quantile_utils.sketch_quantile(s, .5))
+                e.append(abs(rank - n_samples / 2) / n_samples)
+
+        retained = sum(level.size for level in sketch["levels"])
+        print(f"{k:>5} {retained:>9} {t_sketch:>9.3f} {max(errors):>15.2%} "
+              f"{max(errors_merged):>22.2%}")
+
+
+def benchmark_segment_stats(batches=((3, 600), (300, 600), (3000, 60), (30000, 6)),
+                            sfreq=SFREQ, repeats=3):
+    """Compare the mean, median, and RMSSD of every segment of ragged batches
+    of n_segments segments of up to duration seconds, computed with
+    ragged_utils against one NumPy call per segment."""
+    rng = np.random.default_rng(42)
+    print(f"{'segments':>9} {'samples':>9} {'per segment [s]':>16} {'ragged [s]':>11} {'max dev':>8}")
+
+    for n_segments, duration in batches:
+
+        n_samples = int(duration * sfreq)
+        segments = [rng.normal(size=n) for n in rng.integers(n_samples // 2, n_samples, n_segments)]
+        values, offsets = ragged_utils.pack(segments)
+
+        def per_segment():
+            return np.array([[np.mean(segment), np.median(segment),
+                              np.sqrt(np.mean(np.diff(segment) ** 2))] for segment in segments])
+
+        def ragged():
+            diffs, diff_offsets = ragged_utils.segment_diff(values, offsets)
+            return np.column_stack((ragged_utils.segment_mean(values, offsets),
+                                    ragged_utils.segment_median(values, offsets),
+                                    np.sqrt(ragged_utils.segment_mean(diffs ** 2, diff_offsets))))
+
+        t_per_segment = min(timeit.repeat(per_segment, number=1, repeat=repeats))
+        t_ragged = min(timeit.repeat(ragged, number=1, repeat=repeats))
+        deviation = np.max(np.abs(per_segment() - ragged()))
+        print(f"{n_segments:>9} {values.size:>9} {t_per_segment:>16.4f} {t_ragged:>11.4f} {deviation:>8.1e}")
+
+
+def benchmark_window_stats(durations=(1, 8), window=300, hop=30, nperseg=1024,
+                           sfreq=SFREQ, repeats=3):
+    """Compare the mean, median, RMSSD, and Welch PSD of all sliding windows
+    of a signal of each duration (hours), computed with window_utils against
+    one call per window."""
+    rng = np.random.default_rng(42)
+    window, hop = int(window * sfreq), int(hop * sfreq)
+    print(f"{'duration [h]':>13} {'windows':>8} {'per window [s]':>15} {'window_utils [s]':>17} {'max rel dev':>12}")
+
+    for duration in durations:
+
+        signal = 800 + rng.normal(size=int(duration * 3600 * sfreq)).cumsum() * .1
+        starts = window_utils.window_starts(signal.size, window, hop)
+
+        def per_window():
+            stats = np.array([[np.mean(segment), np.median(segment), np.sqrt(np.mean(np.diff(segment) ** 2))]
+                              for segment in (signal[start:start + window] for start in starts)])
+            psds = np.array([welch(signal[start:start + window], fs=sfreq, nperseg=nperseg)[1] for start in starts])
+            return stats, psds
+
+        def windowed():
+            stats = np.column_stack((window_utils.window_mean(signal, window, hop),
+                                     window_utils.window_median(signal, window, hop),
+                                     window_utils.window_rmssd(signal, window, hop)))
+            return stats, window_utils.window_welch(signal, window, hop, sfreq, nperseg)[1]
+
+        t_per_window = min(timeit.repeat(per_window, number=1, repeat=repeats))
+        t_windowed = min(timeit.repeat(windowed, number=1, repeat=repeats))
+        deviation = max(np.max(np.abs(a - b) / np.abs(a)) for a, b in zip(per_window(), windowed()))
+        print(f"{duration:>13} {starts.size:>8} {t_per_window:>15.3f} {t_windowed:>17.3f} {deviation:>12.1e}")
+
+
+def compare_signal_dtypes(DATADIR_RAW=None, dtypes=("float64", "float32")):
+    """Preprocess and summarize all sessions in memory (see sessions.py) with
+    each config.SIGNAL_DTYPE in dtypes, and compare the memory taken by the
+    per-sample signals of all sessions as well as the maximum deviation of
+    every summary metric from the first dtype.
+
+    By default, the sessions in the "raw" directory in the current working
+    directory are compared.
+    """
+    if DATADIR_RAW is None:
+        DATADIR_RAW = Path.cwd().joinpath("raw")
+    signals = ["resp", "resp_filt", "inst_amp", "ibis", "original_resp_biofeedback"]
+    default_dtype = config.SIGNAL_DTYPE
+
+    summaries = {}
+    print(f"{'dtype':>8} {'signals [MB]':>13} {'saved':>6}")
+    for dtype in dtypes:
+
+        config.SIGNAL_DTYPE = dtype
+        n_bytes = 0
+        results = []
+        try:
+            for session, metrics in sessions.summarize_sessions(sessions.preprocess_sessions(sessions.iter_raw_sessions(DATADIR_RAW))):
+                n_bytes += sum(session[signal].nbytes for signal in signals if session[signal] is not None)
+                results.append((session, metrics))
+        finally:
+            config.SIGNAL_DTYPE = default_dtype
+        if not results:
+            print(f"Didn't find sessions in {DATADIR_RAW}.")
+            return
+        summaries[dtype] = sessions.summary_table(results)
+        if dtype == dtypes[0]:
+            reference_bytes = n_bytes
+        print(f"{dtype:>8} {n_bytes / 1e6:>13.2f} {1 - n_bytes / reference_bytes:>6.0%}")
+
+    reference = summaries[dtypes[0]]
+    metrics = reference.columns.drop(["subj", "sess", "cond"])
+    for dtype in dtypes[1:]:
+        print(f"\nDeviation of {dtype} from {dtypes[0]}:")
+        print(f"{'metric':>40} {'max abs':>10} {'max rel':>10}")
+        for metric in metrics:
+            deviation = np.abs(summaries[dtype][metric] - reference[metric])
+            with np.errstate(invalid="ignore", divide="ignore"):
+                relative = deviation / np.abs(reference[metric])
+            print(f"{metric:>40} {np.nanmax(deviation):>10.2e} {np.nanmax(relative):>10.2e}")
+
+
+if __name__ == "__main__":
+    benchmark_instantaneous_amplitude()
+    benchmark_resp_extrema()
+    benchmark_local_power()
+    benchmark_edf_reader()
+    benchmark_quantile_sketch()
+    benchmark_segment_stats()
+    benchmark_window_stats()
+    compare_signal_dtypes()
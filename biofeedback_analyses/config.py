@@ -5,7 +5,51 @@ author: Jan C. Brammer <jan.c.brammer@gmail.com>
 """
 
 DATA_HASH = "9f5ab7692cf0bc96c64b388c87fc99c7"  # MD5 hash of original data used for regression tests during re-runs of the analysis
-SFREQ = 10
+REFERENCE_SUMMARY = None    # path of a reference summary file, if set the summary is validated column by column with SUMMARY_TOLERANCES instead of with DATA_HASH
+SUMMARY_TOLERANCES = {"n_bursts": (0, 0), "*": (1e-12, 1e-9)}    # (atol, rtol) of each summary column, the first pattern (see fnmatch) that matches the column's name applies
+EQUIVALENCE_TOLERANCES = {"instantaneous_amplitude": (1e-9, 0), "instantaneous_amplitude_blockwise": (4e-4, 0), "preprocess_resp_blockwise.inst_amp": (4e-4, 0), "*": (1e-12, 1e-9)}    # (atol, rtol) of the outputs ("<function>.<output>") of optimized functions against their reference implementations (see equivalence.py), the atol of the blockwise outputs is relative to their range, the blockwise amplitude deviates depending on BLOCK_MARGIN (up to about 2e-4 of its range with 300 seconds)
+SFREQ = 10    # Hz, analysis rate, recordings at other rates are resampled to SFREQ when they are read (see io_utils.read_edf_resampled())
+OUT_OF_CORE_DURATION = 6 * 3600    # seconds, recordings longer than this are preprocessed block by block instead of in memory
+BLOCK_DURATION = 3600    # seconds, length of a block during out-of-core preprocessing
+BLOCK_MARGIN = 300    # seconds, margin on each side of a block that absorbs the edge effects of the Hilbert transform, the margins are tapered and the out-of-core inst_amp deviates from the in-memory one by up to about 2e-4 of its range (see preprocessing.steps.preprocess_resp_blockwise())
+FFT_WORKERS = 1    # number of threads used for FFTs of long signals
+SIGNAL_DTYPE = "float64"    # dtype of per-sample signals, "float32" halves their memory while statistics are still accumulated in float64 (see benchmarks.compare_signal_dtypes())
+QUANTILE_SKETCH_K = None    # medians are exact if None, otherwise approximated with KLL sketches of this size (e.g., 200, see analysis_utils.quantile_utils)
+SIDECAR_PERCENTILES = (1, 5, 25, 75, 95, 99)    # percentiles of each column that are saved in the statistics sidecar of each preprocessed file
+MEMOIZE_DIR = None    # directory in which results of analysis functions are memoized, memoization is disabled if None
+MEMOIZE_MAX_BYTES = 2 * 1024 ** 3    # least recently used results are evicted once the memoized results exceed this size
+BOOTSTRAP_RESAMPLES = 5000    # number of bootstrap resamples and permutations for condition contrasts
+BOOTSTRAP_SEED = 12345    # seed of the random streams used for condition contrasts
+BOOTSTRAP_JOBS = 1    # number of processes used for condition contrasts
+SYNC_SEGMENT_DURATION = None    # seconds, fit clock synchronization piecewise in segments of this duration to account for drift, a single fit if None
+REPLAY_WINDOW = 15    # seconds, envelope window of the streamed biofeedback score, spans the slowest breathing cycle in the biofeedback band
+REPLAY_CHUNK = 1    # samples, number of samples that are sent to the streamed biofeedback score at once during replay
+REPLAY_FIT_FRACTION = .5    # fraction of the Feedback events (the earliest) from which the target is estimated during replay, the agreement is reported on the remaining events
+TIMINGS_FILENAME = "unit_timings.sqlite"    # runtime and memory of past runs are recorded in this file in the working directory, used by --dry-run
+RSS_INTERVAL = .01    # seconds, interval at which the resident set size is sampled during each recorded call (see planner.timed_call())
+PREFETCH_DEPTH = 2    # number of sessions whose inputs are read in the background while the current session is processed, 0 reads them synchronously
+LEASE_DURATION = 600    # seconds, a unit of work is requeued if its worker hasn't renewed the lease for this long
+HEARTBEAT_INTERVAL = 60    # seconds, interval at which workers renew the lease on their current unit of work
+POLL_INTERVAL = 5    # seconds, interval at which idle workers poll the work queue
+MAX_ATTEMPTS = 3    # number of times a failing unit of work is attempted before it is marked as failed
+THROUGHPUT_WINDOW = 300    # seconds, progress reports the throughput of units of work that finished within this window (see progress.py)
+STALL_DURATION = 1800    # seconds, a stage is reported as stalled if none of its units started or finished for this long while some are running
+INGEST_POLL_INTERVAL = 10    # seconds, interval at which the ingest daemon polls the "raw" directory for new sessions
+INGEST_STABLE_DURATION = 60    # seconds, files of a new session are ingested once neither of them has been modified for this long
+INGEST_DEBOUNCE = 600    # seconds, figures are refreshed at most once per this interval while sessions are being ingested
+EPOCH_CHANNELS = [("resp", "resp_filt"), ("resp", "inst_amp"), ("ibis", "0"), ("resp_biofeedback", "original_resp_biofeedback")]    # (suffix of the processed file, column) of each channel of event-locked epochs
+WINDOW_DURATION = 300    # seconds, duration of the sliding windows of time-resolved features (see windows.py)
+WINDOW_HOP = 30    # seconds, interval between the starts of consecutive sliding windows
+WINDOW_NPERSEG = 1024    # samples, length of the Welch segments of the band powers of each sliding window
+PREVIEW_WINDOWS = 3    # number of randomly placed windows of the game of each session that preview runs summarize (see preview.py)
+PREVIEW_WINDOW_DURATION = 600    # seconds, duration of each preview window, bounds the cost of a session in preview runs
+PREVIEW_SEED = 0    # seed of the placement of the preview windows
+QC_ACTION = "flag"    # "skip": later stages skip sessions that fail the quality screening (see analysis_utils/qc_utils.py), "flag": failures are only recorded in the QC table
+QC_FLATLINE_DURATION = 2    # seconds, runs of identical consecutive samples of the raw respiration at least this long count as flatline
+QC_MAX_FLATLINE_FRACTION = 0.05    # sessions fail the screening if more of the game's respiration than this is flatline
+QC_MAX_CLIPPING_FRACTION = 0.01    # sessions fail the screening if more of the game's respiration than this is at its minimum or maximum value
+QC_MIN_IBI_COVERAGE = 0.9    # sessions fail the screening if the IBIs cover less of the game than this
+QC_MAX_SYNC_RESIDUAL = 0.25    # seconds, sessions fail the screening if a synchronization event deviates more than this from the synchronization model
 SUBJECTS = [f"subj-{str(i).zfill(2)}" for i in range(1, 10)]
 sessions = [f"sess-{str(i).zfill(2)}" for i in range(1, 11)]
 conditions = ["cond-A", "cond-B", "cond-B", "cond-A", "cond-B", "cond-A", "cond-B", "cond-A", "cond-B", "cond-A"]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Extract event-locked epochs of the processed signals of all sessions (see
+analysis_utils.epoch_utils), e.g., respiration, IBIs, and biofeedback around
+every change of the Feedback score. Run with
+
+    python -m biofeedback_analyses.epochs Feedback --pre 5 --post 10 --on-change
+
+in the directory that contains "processed". The epochs are saved to
+processed/epochs.npy and their metadata to processed/epochs_metadata. Load
+them with epoch_utils.load_epochs() and average them with
+epoch_utils.average_epochs().
+"""
+
+import argparse
+import numpy as np
+from pathlib import Path
+from biofeedback_analyses.analysis_utils import epoch_utils
+from biofeedback_analyses.config import SFREQ, EPOCH_CHANNELS
+
+
+def epoch_cohort(DATADIR_PROCESSED, event_names, pre, post, on_change=False,
+                 channels=EPOCH_CHANNELS, filename="epochs"):
+    """Epoch all sessions in DATADIR_PROCESSED around event_names, from pre
+    seconds before until post seconds after each event."""
+    event_paths = sorted(DATADIR_PROCESSED.glob("subj-*/subj-*events"))
+    if not event_paths:
+        raise FileNotFoundError(f"Didn't find formatted events in {DATADIR_PROCESSED}.")
+
+    epochs, metadata = epoch_utils.epoch_sessions(event_paths, event_names,
+                                                  int(np.rint(pre * SFREQ)),
+                                                  int(np.rint(post * SFREQ)),
+                                                  channels,
+                                                  DATADIR_PROCESSED.joinpath(filename),
+                                                  on_change)
+    print(f"Saved {epochs.shape[0]} epoch(s) of {epochs.shape[1]} samples and {epochs.shape[2]}"
+          f" channel(s) to {DATADIR_PROCESSED.joinpath(filename)}.npy.")
+
+    return epochs, metadata
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Extract event-locked epochs of the processed signals of all sessions.")
+    parser.add_argument("events", nargs="+", help="Names of the events that epochs are locked to, e.g., Feedback.")
+    parser.add_argument("--pre", type=float, default=5, metavar="SECONDS",
+                        help="Duration of the epoch before each event.")
+    parser.add_argument("--post", type=float, default=10, metavar="SECONDS",
+                        help="Duration of the epoch after each event.")
+    parser.add_argument("--on-change", action="store_true",
+                        help="Only epoch events whose value differs from the previous event of the same name.")
+    parser.add_argument("--filename", default="epochs",
+                        help="Name of the epochs in the \"processed\" directory.")
+    args = parser.parse_args()
+
+    epoch_cohort(Path.cwd().joinpath("processed"), args.events, args.pre, args.post,
+                 args.on_change, filename=args.filename)
+
+
+if __name__ == "__main__":
+    main()
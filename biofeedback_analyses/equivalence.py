@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Equivalence of the optimized analysis functions with their frozen reference
+implementations (see analysis_utils.reference_utils). Every function in
+ENTRIES is run side by side with its reference on synthetic inputs and on the
+game window of every recorded session, and the maximum absolute and relative
+deviation of each of its outputs is reported against the tolerances in
+config.EQUIVALENCE_TOLERANCES. Run with
+
+    python -m biofeedback_analyses.equivalence --hours 1 8
+
+in the directory that contains "raw" (recorded inputs are skipped if there
+is none). Compare every column of a summary file with a reference summary
+file, each with its own tolerance in config.SUMMARY_TOLERANCES, with
+
+    python -m biofeedback_analyses.equivalence --summary processed/summary_all_subjects reference/summary_all_subjects
+
+Check that a distributed run (see work_queue) reproduces the summary of a
+sequential run byte by byte, on the (e.g., synthetic) recordings in "raw", with
+
+    python -m biofeedback_analyses.equivalence --distributed 2
+
+The command exits with status 1 if any output deviates beyond its tolerance.
+"""
+
+import sys
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from biofeedback_analyses import config, sessions, benchmarks, run_analysis, work_queue
+from biofeedback_analyses.analysis_utils import (reference_utils, event_utils, resp_utils, hrv_utils,
+                                                 biofeedback_utils, window_utils, io_utils)
+from biofeedback_analyses.config import (SUBJECTS, SESSIONS, SFREQ, FFT_WORKERS, BLOCK_DURATION, BLOCK_MARGIN, OUT_OF_CORE_DURATION,
+                                         WINDOW_DURATION, WINDOW_HOP, WINDOW_NPERSEG,
+                                         EQUIVALENCE_TOLERANCES, SUMMARY_TOLERANCES)
+
+
+def segment_offsets(n_samples, seed=42):
+    """Cut n_samples into segments of random length (2 to 4096 samples, most
+    of them short), such that every code path of the segmented statistics
+    (see ragged_utils) is exercised."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(2, 2 ** rng.integers(2, 13, n_samples // 8 + 1))
+    offsets = np.cumsum(lengths)
+
+    return np.r_[0, offsets[offsets < n_samples - 1], n_samples]
+
+
+def burst_masks(inst_amp, sfreq):
+    """Bursts of inst_amp with thresholds as in the summary pipeline, but
+    relative to the median of inst_amp itself."""
+    low = np.median(inst_amp)
+
+    return resp_utils.bursts_dual_threshold(inst_amp, low, 1.5 * low,
+                                            min_duration=int(np.rint(10 * sfreq)))
+
+
+def window_features(signal, sfreq):
+
+    window, hop = int(np.rint(WINDOW_DURATION * sfreq)), int(np.rint(WINDOW_HOP * sfreq))
+
+    return {"mean": window_utils.window_mean(signal, window, hop),
+            "median": window_utils.window_median(signal, window, hop),
+            "rmssd": window_utils.window_rmssd(signal, window, hop),
+            "psd": window_utils.window_welch(signal, window, hop, sfreq, WINDOW_NPERSEG)[1]}
+
+
+def reference_window_features(signal, sfreq):
+
+    return reference_utils.window_stats(signal, int(np.rint(WINDOW_DURATION * sfreq)),
+                                        int(np.rint(WINDOW_HOP * sfreq)), sfreq, WINDOW_NPERSEG)
+
+
+def resp_blockwise(resp, sfreq):
+    """Filtered respiration and instantaneous amplitude as computed by the
+    out-of-core preprocessing (see preprocessing.steps.preprocess_resp_blockwise())."""
+    blocks = list(resp_utils.iter_resp_blocks(lambda beg, end: resp[beg:end], resp.size, sfreq,
+                                              int(np.rint(BLOCK_DURATION * sfreq)),
+                                              int(np.rint(BLOCK_MARGIN * sfreq)), FFT_WORKERS))
+
+    return {"resp_filt": np.concatenate([block[0] for block in blocks]),
+            "inst_amp": np.concatenate([block[1] for block in blocks])}
+
+
+def resp_in_memory(resp, sfreq):
+    """Filtered respiration and instantaneous amplitude as computed by the
+    in-memory preprocessing (see sessions.compute_resp())."""
+
+    return dict(zip(["resp_filt", "inst_amp"], sessions.compute_resp(resp, sfreq)))
+
+
+def named(period_rate_amp):
+
+    return dict(zip(["period", "rate", "amp"], period_rate_amp))
+
+
+# Each entry runs the "reference" and "optimized" function on a case (see
+# synthetic_case() and recorded_cases()) that contains all keys in "requires".
+# Samples within "edge" seconds of either end of one-dimensional outputs are
+# not compared. The atol of entries with "scale" is relative to the
+# peak-to-peak range of each reference output (see reference_utils.compare()).
+ENTRIES = [
+    {"name": "instantaneous_amplitude", "requires": ["resp_filt"],
+     "reference": lambda c: reference_utils.instantaneous_amplitude(c["resp_filt"]),
+     "optimized": lambda c: resp_utils.instantaneous_amplitude(c["resp_filt"], workers=FFT_WORKERS)},
+    {"name": "instantaneous_amplitude_blockwise", "requires": ["resp_filt"],
+     "reference": lambda c: reference_utils.instantaneous_amplitude(c["resp_filt"]),
+     "optimized": lambda c: resp_utils.instantaneous_amplitude(c["resp_filt"], int(BLOCK_DURATION * c["sfreq"]),
+                                                               int(BLOCK_MARGIN * c["sfreq"]), FFT_WORKERS),
+     "scale": True},
+    {"name": "preprocess_resp_blockwise", "requires": ["resp"],
+     "reference": lambda c: resp_in_memory(c["resp"], c["sfreq"]),
+     "optimized": lambda c: resp_blockwise(c["resp"], c["sfreq"]),
+     "scale": True},
+    {"name": "resp_extrema", "requires": ["resp"],
+     "reference": lambda c: reference_utils.resp_extrema(c["resp"], c["sfreq"]),
+     "optimized": lambda c: resp_utils.resp_extrema(c["resp"], c["sfreq"])},
+    {"name": "resp_stats", "requires": ["resp"],
+     "reference": lambda c: named(reference_utils.resp_stats(reference_utils.resp_extrema(c["resp"], c["sfreq"]),
+                                                             c["resp"], c["sfreq"])),
+     "optimized": lambda c: named(resp_utils.resp_stats(resp_utils.resp_extrema(c["resp"], c["sfreq"]),
+                                                        c["resp"], c["sfreq"]))},
+    {"name": "compute_resp_stats", "requires": ["resp"],
+     "reference": lambda c: reference_utils.compute_resp_stats(c["resp"], c["sfreq"]),
+     "optimized": lambda c: resp_utils.compute_resp_stats(c["resp"], c["sfreq"])},
+    {"name": "compute_resp_power_stats", "requires": ["inst_amp"],
+     "reference": lambda c: reference_utils.compute_resp_power_stats(c["inst_amp"], 1),
+     "optimized": lambda c: resp_utils.compute_resp_power_stats(c["inst_amp"], 1)},
+    {"name": "compute_resp_power_stats_segmented", "requires": ["inst_amp"],
+     "reference": lambda c: reference_utils.per_segment(reference_utils.compute_resp_power_stats, c["inst_amp"],
+                                                        segment_offsets(c["inst_amp"].size), 1),
+     "optimized": lambda c: resp_utils.compute_resp_power_stats_segmented(c["inst_amp"],
+                                                                          segment_offsets(c["inst_amp"].size), 1)},
+    {"name": "compute_burst_stats_segmented", "requires": ["inst_amp"],
+     "reference": lambda c: reference_utils.per_segment(resp_utils.compute_burst_stats,
+                                                        burst_masks(c["inst_amp"], c["sfreq"]),
+                                                        segment_offsets(c["inst_amp"].size), c["sfreq"]),
+     "optimized": lambda c: resp_utils.compute_burst_stats_segmented(burst_masks(c["inst_amp"], c["sfreq"]),
+                                                                     segment_offsets(c["inst_amp"].size), c["sfreq"])},
+    {"name": "compute_hrv_stats", "requires": ["ibis"],
+     "reference": lambda c: reference_utils.compute_hrv_stats(c["ibis"], c["sfreq"]),
+     "optimized": lambda c: hrv_utils.compute_hrv_stats(c["ibis"], c["sfreq"])},
+    {"name": "compute_time_domain_hrv_stats_segmented", "requires": ["ibis"],
+     "reference": lambda c: reference_utils.per_segment(reference_utils.compute_time_domain_hrv_stats, c["ibis"],
+                                                        segment_offsets(c["ibis"].size)),
+     "optimized": lambda c: hrv_utils.compute_time_domain_hrv_stats_segmented(c["ibis"], segment_offsets(c["ibis"].size))},
+    {"name": "compute_local_power", "requires": ["ibis"],
+     "reference": lambda c: reference_utils.compute_local_power(c["ibis"]),
+     "optimized": lambda c: hrv_utils.compute_local_power(c["ibis"])},
+    {"name": "compute_local_power_chunked", "requires": ["ibis"],
+     "reference": lambda c: reference_utils.compute_local_power(c["ibis"]),
+     "optimized": lambda c: hrv_utils.compute_local_power(c["ibis"], int(BLOCK_DURATION * c["sfreq"]))},
+    {"name": "compute_local_power_hrv_stats", "requires": ["ibis"],
+     "reference": lambda c: reference_utils.compute_local_power_hrv_stats(reference_utils.compute_local_power(c["ibis"])),
+     "optimized": lambda c: hrv_utils.compute_local_power_hrv_stats(hrv_utils.compute_local_power(c["ibis"]))},
+    {"name": "compute_local_power_hrv_stats_segmented", "requires": ["ibis"],
+     "reference": lambda c: reference_utils.per_segment(reference_utils.compute_local_power_hrv_stats,
+                                                        reference_utils.compute_local_power(c["ibis"]),
+                                                        segment_offsets(c["ibis"].size)),
+     "optimized": lambda c: hrv_utils.compute_local_power_hrv_stats_segmented(hrv_utils.compute_local_power(c["ibis"]),
+                                                                              segment_offsets(c["ibis"].size))},
+    {"name": "compute_original_resp_biofeedback_stats", "requires": ["biofeedback"],
+     "reference": lambda c: reference_utils.compute_original_resp_biofeedback_stats(c["biofeedback"]),
+     "optimized": lambda c: biofeedback_utils.compute_original_resp_biofeedback_stats(c["biofeedback"])},
+    {"name": "compute_original_resp_biofeedback_stats_segmented", "requires": ["biofeedback"],
+     "reference": lambda c: reference_utils.per_segment(reference_utils.compute_original_resp_biofeedback_stats,
+                                                        c["biofeedback"], segment_offsets(c["biofeedback"].size)),
+     "optimized": lambda c: biofeedback_utils.compute_original_resp_biofeedback_stats_segmented(c["biofeedback"],
+                                                                                                segment_offsets(c["biofeedback"].size))},
+    {"name": "window_stats", "requires": ["ibis"],
+     "reference": lambda c: reference_window_features(c["ibis"], c["sfreq"]),
+     "optimized": lambda c: window_features(c["ibis"], c["sfreq"])},
+    {"name": "relativetimes_to_samples", "requires": ["events"],
+     "reference": lambda c: reference_utils.relativetimes_to_physiosamples(c["events"]),
+     "optimized": lambda c: event_utils.relativetimes_to_samples(c["events"]["timestamp"],
+                                                                 event_utils.fit_sync_model(c["events"], None))},
+    {"name": "read_edf_resampled", "requires": ["path", "game"],
+     "reference": lambda c: reference_utils.read_edf_resampled(c["path"], 0, *c["game"], c["sfreq"]),
+     "optimized": lambda c: io_utils.read_edf_resampled(c["path"], 0, *c["game"], c["sfreq"])},
+]
+
+
+def synthetic_case(n_samples, sfreq=SFREQ, seed=42):
+    """Synthetic respiration (see benchmarks.synthetic_resp()), IBIs, and
+    biofeedback of a session of n_samples samples."""
+    resp = benchmarks.synthetic_resp(n_samples, sfreq, seed)
+    resp_filt = biofeedback_utils.biofeedback_filter(resp, sfreq)
+    inst_amp = reference_utils.instantaneous_amplitude(resp_filt)
+
+    return {"name": f"synthetic {n_samples}", "sfreq": sfreq, "resp": resp, "resp_filt": resp_filt,
+            "inst_amp": inst_amp, "ibis": benchmarks.synthetic_ibis(n_samples, sfreq, seed),
+            "biofeedback": biofeedback_utils.compute_biofeedback_score(inst_amp, np.median(inst_amp))}
+
+
+def synthetic_lengths(hours, sfreq=SFREQ):
+    """Numbers of samples of the synthetic cases: for each duration in hours
+    the exact number of samples, the next odd number, and the next prime
+    (i.e., lengths that aren't fast FFT lengths), as well as the next prime
+    after OUT_OF_CORE_DURATION, such that the out-of-core preprocessing is
+    compared with the in-memory preprocessing of the same recording."""
+    lengths = []
+    for duration in hours:
+        n_samples = int(duration * 3600 * sfreq)
+        lengths += [n_samples, n_samples | 1, benchmarks.next_prime(n_samples + 2)]
+    lengths.append(benchmarks.next_prime(int(OUT_OF_CORE_DURATION * sfreq) + 1))
+
+    return sorted(set(lengths))
+
+
+def recorded_cases(DATADIR_RAW):
+    """Yield the game window of every session in DATADIR_RAW, preprocessed
+    in memory (see sessions.preprocess_session()), together with the path of
+    its recording and its events (timestamps in seconds)."""
+
+    for subject, session, physio_path, event_path in sessions.iter_raw_sessions(DATADIR_RAW):
+
+        preprocessed = sessions.preprocess_session(physio_path, event_path, subject=subject,
+                                                   session=session)
+        if preprocessed["game"] is None:
+            continue
+        beg, end = preprocessed["game"]
+        case = {"name": f"{subject} {session}", "sfreq": preprocessed["sfreq"],
+                "path": physio_path, "game": (beg, end),
+                "events": event_utils.isotimes_to_relativetimes(pd.read_csv(event_path, sep="\t"))}
+        for key, signal in [("resp", "resp"), ("resp_filt", "resp_filt"), ("inst_amp", "inst_amp"),
+                            ("ibis", "ibis"), ("biofeedback", "original_resp_biofeedback")]:
+            if preprocessed[signal] is not None:
+                case[key] = np.asarray(preprocessed[signal][beg:end], dtype=np.float64)
+
+        yield case
+
+
+def run_equivalence(cases, entries=ENTRIES, tolerances=EQUIVALENCE_TOLERANCES):
+    """Run every entry on every case that contains the entry's required
+    inputs, and print the deviation of each output.
+
+    Returns
+    -------
+    results : DataFrame
+        One row per case and output with its "input", "output", "max_abs"
+        and "max_rel" deviation, "atol", "rtol", and whether it "passed".
+    """
+    memoize_dir = config.MEMOIZE_DIR
+    config.MEMOIZE_DIR = None    # compare what the functions compute rather than what they memoized
+    rows = []
+    print(f"{'input':<24} {'output':<84} {'max abs':>9} {'max rel':>9} {'atol':>7} {'rtol':>7} {'passed':>6}")
+    try:
+        for case in cases:
+            for entry in entries:
+
+                if any(case.get(key) is None for key in entry["requires"]):
+                    continue
+                trim = int(np.rint(entry.get("edge", 0) * case["sfreq"]))
+                for row in reference_utils.compare(entry["name"], entry["reference"](case),
+                                                   entry["optimized"](case), tolerances, trim,
+                                                   entry.get("scale", False)):
+                    print(f"{case['name']:<24} {row['output']:<84} {row['max_abs']:>9.1e} {row['max_rel']:>9.1e} "
+                          f"{row['atol']:>7.0e} {row['rtol']:>7.0e} {str(row['passed']):>6}")
+                    rows.append({"input": case["name"], **row})
+    finally:
+        config.MEMOIZE_DIR = memoize_dir
+
+    results = pd.DataFrame(rows, columns=["input", "output", "max_abs", "max_rel", "atol", "rtol", "passed"])
+    failed = results.loc[~results["passed"].astype(bool)]
+    print(f"\n{len(results) - len(failed)} of {len(results)} output(s) within tolerance.")
+    for _, row in failed.iterrows():
+        print(f"FAILED: {row['output']} on {row['input']} deviates by {row['max_abs']:.2e}"
+              f" (relative {row['max_rel']:.2e}).")
+
+    return results
+
+
+def run_summary_equivalence(summary_path, reference_path, tolerances=SUMMARY_TOLERANCES):
+    """Compare every column of the summary file at summary_path with the
+    reference summary file at reference_path (see
+    reference_utils.compare_summaries()) and print the deviations."""
+
+    table = reference_utils.compare_summaries(pd.read_csv(summary_path, sep="\t"),
+                                              pd.read_csv(reference_path, sep="\t"), tolerances)
+    with pd.option_context("display.max_rows", None, "display.width", 200,
+                           "display.max_colwidth", 200):
+        print(table.to_string(index=False))
+    n_failed = (~table["passed"]).sum()
+    print(f"\n{len(table) - n_failed} of {len(table)} column(s) within tolerance.")
+
+    return table
+
+
+def run_distributed_equivalence(DATADIR_RAW, n_workers=2):
+    """Run the preprocessing and summary pipelines on the recordings in
+    DATADIR_RAW sequentially (see run_analysis.run()) and with n_workers local
+    workers (see work_queue.coordinate()), each in a temporary directory, and
+    compare the summary files byte by byte. If they differ, the columns are
+    compared (see run_summary_equivalence()).
+
+    Returns
+    -------
+    identical : bool
+        Whether the summary files are identical.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        summary_paths = []
+        for name in ["sequential", "distributed"]:
+            DATADIR_PROCESSED = Path(tmpdir).joinpath(name, "processed")
+            DATADIR_PROCESSED.mkdir(parents=True)
+            for subject in SUBJECTS:
+                DATADIR_PROCESSED.joinpath(subject).mkdir()
+            run_analysis.setup_summary(DATADIR_PROCESSED)
+            if name == "sequential":
+                run_analysis.run(run_analysis.preprocessing_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED))
+                run_analysis.run(run_analysis.summary_stats_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED))
+            else:
+                work_queue.coordinate(DATADIR_RAW, DATADIR_PROCESSED, n_workers)
+            summary_paths.append(DATADIR_PROCESSED.joinpath("summary_all_subjects"))
+
+        sequential_path, distributed_path = summary_paths
+        identical = sequential_path.read_bytes() == distributed_path.read_bytes()
+        print(f"\nSummary of the run with {n_workers} worker(s) is"
+              f" {'identical' if identical else 'NOT identical'} to the summary of the sequential run.")
+        if not identical:
+            run_summary_equivalence(distributed_path, sequential_path)
+
+    return identical
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Compare optimized analysis functions with their reference implementations.")
+    parser.add_argument("--hours", type=float, nargs="*", default=[1],
+                        help="Durations of the synthetic inputs, each also at an odd and a prime number of"
+                             " samples. A recording just longer than OUT_OF_CORE_DURATION is always included.")
+    parser.add_argument("--summary", nargs=2, metavar=("SUMMARY", "REFERENCE"),
+                        help="Compare the columns of a summary file with a reference summary file instead.")
+    parser.add_argument("--distributed", type=int, metavar="N",
+                        help="Compare the summary of a run on the recordings in \"raw\" with N local workers with"
+                             " the summary of a sequential run instead.")
+    args = parser.parse_args()
+
+    if args.distributed is not None:
+        sys.exit(0 if run_distributed_equivalence(Path.cwd().joinpath("raw"), args.distributed) else 1)
+    if args.summary is not None:
+        results = run_summary_equivalence(*args.summary)
+    else:
+        cases = [synthetic_case(n_samples) for n_samples in synthetic_lengths(args.hours)]
+        DATADIR_RAW = Path.cwd().joinpath("raw")
+        if DATADIR_RAW.is_dir():
+            cases = [*cases, *recorded_cases(DATADIR_RAW)]
+        results = run_equivalence(cases)
+
+    sys.exit(0 if results["passed"].all() else 1)
+
+
+if __name__ == "__main__":
+    main()
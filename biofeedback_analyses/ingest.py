@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Incremental ingestion of sessions that are added to the "raw" directory while
+the study is running. The daemon polls "raw" for sessions whose recordsignal
+and recordtrigger files are both present and haven't been modified for
+INGEST_STABLE_DURATION seconds (i.e., have been copied completely). Only
+these sessions are run through preprocessing and summary statistics (see
+work_queue.restrict_to_session()), their rows are added to the summary if
+they are missing, and the figures are refreshed at most once every
+INGEST_DEBOUNCE seconds. Run with
+
+    python -m biofeedback_analyses.ingest
+
+in the directory that contains "raw". Ingested sessions are recorded in an
+SQLite database in the "processed" directory together with the size and
+modification time of their files, such that a session is processed once,
+even across restarts of the daemon or with several daemons, and processed
+again only if its files change. As in the work queue, a daemon renews its
+claim on a session every HEARTBEAT_INTERVAL seconds while ingesting it, and
+sessions whose claim hasn't been renewed for LEASE_DURATION seconds (e.g.,
+because their daemon was killed) are claimed again. The refreshed figures
+skip the validation against the original data, since the summary grows
+beyond it, and re-compute the contrasts from the grown summary.
+"""
+
+import time
+import sqlite3
+import argparse
+import threading
+import pandas as pd
+from pathlib import Path
+from contextlib import closing
+from biofeedback_analyses import planner
+from biofeedback_analyses.run_analysis import setup_summary, run
+from biofeedback_analyses.work_queue import restrict_to_session
+from biofeedback_analyses.config import (INGEST_POLL_INTERVAL, INGEST_STABLE_DURATION,
+                                         INGEST_DEBOUNCE, SUBJECTS, SESSIONS,
+                                         TIMINGS_FILENAME, LEASE_DURATION,
+                                         HEARTBEAT_INTERVAL)
+from biofeedback_analyses.preprocessing.pipeline import pipeline as preprocessing_pipeline
+from biofeedback_analyses.summary_stats.pipeline import pipeline as summary_stats_pipeline
+from biofeedback_analyses.plotting.pipeline import pipeline as plotting_pipeline
+from biofeedback_analyses.plotting.steps import validate_summary_data, compute_contrasts
+
+
+def find_sessions(DATADIR_RAW):
+    """Return the sessions in DATADIR_RAW that have exactly one recordsignal
+    and one recordtrigger file, as a dict mapping (subject, session) to the
+    pair of paths. Sessions are named as in config.SESSIONS, e.g.,
+    "sess-01_cond-A"."""
+    files = {}
+    for path in DATADIR_RAW.glob("subj-*/subj-*_record*"):
+        subject, session = path.name[:7], path.name[8:22]
+        kind = "signal" if "recordsignal" in path.name else "trigger"
+        files.setdefault((subject, session), {}).setdefault(kind, []).append(path)
+
+    sessions = {}
+    for key, kinds in sorted(files.items()):
+        if len(kinds.get("signal", [])) == 1 and len(kinds.get("trigger", [])) == 1:
+            sessions[key] = (kinds["signal"][0], kinds["trigger"][0])
+
+    return sessions
+
+
+def fingerprint(paths):
+    """Size and modification time of paths, which identify a version of a
+    session's files."""
+    stats = [path.stat() for path in paths]
+
+    return ";".join(f"{stat.st_size}:{stat.st_mtime_ns}" for stat in stats)
+
+
+def is_stable(paths, stable_duration, now=None):
+    """Whether none of paths has been modified for stable_duration seconds."""
+    now = time.time() if now is None else now
+
+    return all(now - path.stat().st_mtime >= stable_duration for path in paths)
+
+
+def connect(ingest_path):
+
+    con = sqlite3.connect(str(ingest_path), timeout=60,
+                          isolation_level=None)    # transactions are managed explicitly
+    con.execute("CREATE TABLE IF NOT EXISTS sessions (subject TEXT, session TEXT,"
+                " fingerprint TEXT, status TEXT, detail TEXT, updated REAL,"
+                " PRIMARY KEY (subject, session))")
+
+    return con
+
+
+def claim_sessions(ingest_path, candidates, lease_duration=LEASE_DURATION):
+    """Mark the candidate sessions as running unless their current files have
+    already been claimed (by this or another daemon). Sessions that are still
+    running but whose claim hasn't been renewed for lease_duration seconds
+    (see renew_session()) are claimed again.
+
+    Parameters
+    ----------
+    ingest_path : Path
+        The ingest database.
+    candidates : dict
+        Maps (subject, session) to the fingerprint of the session's files.
+    lease_duration : float, optional
+        Seconds after which the claim of a running session expires.
+
+    Returns
+    -------
+    claimed : list of tuple
+        The (subject, session) pairs that have been claimed.
+    """
+    claimed = []
+    now = time.time()
+
+    with closing(connect(ingest_path)) as con:
+        con.execute("BEGIN IMMEDIATE")    # serialize claims across daemons
+        for (subject, session), files in candidates.items():
+            row = con.execute("SELECT fingerprint, status, updated FROM sessions WHERE subject = ?"
+                              " AND session = ?", (subject, session)).fetchone()
+            if row is not None and row[0] == files:
+                if not (row[1] == "running" and row[2] < now - lease_duration):
+                    continue
+                print(f"Claiming {subject} {session} again, its claim expired.")
+            con.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, 'running', '', ?)",
+                        (subject, session, files, now))
+            claimed.append((subject, session))
+        con.execute("COMMIT")
+
+    return claimed
+
+
+def renew_session(ingest_path, subject, session):
+    """Renew the claim on a running session."""
+    with closing(connect(ingest_path)) as con:
+        con.execute("UPDATE sessions SET updated = ? WHERE subject = ? AND session = ?"
+                    " AND status = 'running'", (time.time(), subject, session))
+
+
+def finish_session(ingest_path, subject, session, status, detail=""):
+
+    with closing(connect(ingest_path)) as con:
+        con.execute("UPDATE sessions SET status = ?, detail = ?, updated = ?"
+                    " WHERE subject = ? AND session = ?",
+                    (status, detail, time.time(), subject, session))
+
+
+def upsert_summary_row(summary_path, subject, session):
+    """Add an empty row for the session to the summary unless it exists."""
+    df_summary = pd.read_csv(summary_path, sep="\t")
+    row = {"subj": subject, "sess": session[:7], "cond": session[-6:]}
+    exists = ((df_summary["subj"] == row["subj"]) & (df_summary["sess"] == row["sess"]) &
+              (df_summary["cond"] == row["cond"])).any()
+    if exists:
+        return
+
+    df_summary = pd.concat([df_summary, pd.DataFrame([row])], ignore_index=True)
+    df_summary.to_csv(summary_path, sep="\t", index=False)
+    print(f"Added {subject} {session} to {summary_path}.")
+
+
+def ingest_session(subject, session, DATADIR_RAW, DATADIR_PROCESSED):
+    """Run a single session through preprocessing and summary statistics,
+    re-computing its outputs."""
+    DATADIR_PROCESSED.joinpath(subject).mkdir(exist_ok=True)
+    upsert_summary_row(DATADIR_PROCESSED.joinpath("summary_all_subjects"), subject, session)
+
+    tasks = (preprocessing_pipeline([subject], [session], DATADIR_RAW, DATADIR_PROCESSED) +
+             summary_stats_pipeline([subject], [session], DATADIR_RAW, DATADIR_PROCESSED))
+    for task in tasks:
+        planner.timed_call(dict(task, recompute=True), subject,
+                           restrict_to_session(task["inputs"], session), task["outputs"],
+                           DATADIR_PROCESSED.parent.joinpath(TIMINGS_FILENAME), session)
+
+
+def refresh_figures(DATADIR_RAW, DATADIR_PROCESSED):
+    """Re-plot the figures from the current summary. The contrasts (and their
+    bootstrap resamples) are re-computed, since the summary has grown since
+    they were saved."""
+    tasks = [dict(task, recompute=True) if task["func"] is compute_contrasts else task
+             for task in plotting_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED)
+             if task["func"] is not validate_summary_data]
+    run(tasks)
+    print("Refreshed figures.")
+
+
+def ingest(DATADIR_RAW, DATADIR_PROCESSED, poll_interval=INGEST_POLL_INTERVAL,
+           stable_duration=INGEST_STABLE_DURATION, debounce=INGEST_DEBOUNCE,
+           once=False):
+    """Poll for new sessions and ingest them until interrupted.
+
+    Parameters
+    ----------
+    DATADIR_RAW, DATADIR_PROCESSED : Path
+        The data directories. DATADIR_PROCESSED and the summary are created
+        if they don't exist.
+    poll_interval : float, optional
+        Seconds between polls of DATADIR_RAW.
+    stable_duration : float, optional
+        Seconds for which the files of a session must not have been modified.
+    debounce : float, optional
+        Minimum number of seconds between refreshes of the figures.
+    once : bool, optional
+        Ingest the sessions that are currently stable, refresh the figures,
+        and return instead of polling.
+    """
+    DATADIR_PROCESSED.mkdir(exist_ok=True)
+    if not DATADIR_PROCESSED.joinpath("summary_all_subjects").exists():
+        setup_summary(DATADIR_PROCESSED)
+    ingest_path = DATADIR_PROCESSED.joinpath("ingest.sqlite")
+    last_refresh = -float("inf")
+    pending_refresh = False
+
+    while True:
+
+        candidates = {key: fingerprint(paths) for key, paths in find_sessions(DATADIR_RAW).items()
+                      if is_stable(paths, stable_duration)}
+        claimed = claim_sessions(ingest_path, candidates)
+        if claimed:
+            print(f"Ingesting {len(claimed)} session(s).")
+
+        for subject, session in claimed:
+            stop_heartbeat = threading.Event()
+
+            def beat():
+                while not stop_heartbeat.wait(HEARTBEAT_INTERVAL):
+                    renew_session(ingest_path, subject, session)
+
+            heartbeat_thread = threading.Thread(target=beat, daemon=True)
+            heartbeat_thread.start()
+            try:
+                ingest_session(subject, session, DATADIR_RAW, DATADIR_PROCESSED)
+                status, detail = "done", ""
+            except Exception as e:
+                print(f"Failed to ingest {subject} {session}: {e!r}")
+                status, detail = "failed", repr(e)
+            finally:
+                stop_heartbeat.set()
+                heartbeat_thread.join()
+            finish_session(ingest_path, subject, session, status, detail)
+            pending_refresh = pending_refresh or status == "done"
+
+        if pending_refresh and (once or time.monotonic() - last_refresh >= debounce):
+            refresh_figures(DATADIR_RAW, DATADIR_PROCESSED)
+            last_refresh = time.monotonic()
+            pending_refresh = False
+
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Ingest sessions as they are added to the \"raw\" directory.")
+    parser.add_argument("--once", action="store_true",
+                        help="Ingest the sessions that are currently complete and exit.")
+    parser.add_argument("--poll-interval", type=float, default=INGEST_POLL_INTERVAL, metavar="SECONDS",
+                        help="Interval at which \"raw\" is polled for new sessions.")
+    parser.add_argument("--stable", type=float, default=INGEST_STABLE_DURATION, metavar="SECONDS",
+                        help="Ingest a session once its files haven't been modified for this long.")
+    parser.add_argument("--debounce", type=float, default=INGEST_DEBOUNCE, metavar="SECONDS",
+                        help="Refresh the figures at most once per this interval.")
+    args = parser.parse_args()
+
+    DATADIR_RAW = Path.cwd().joinpath("raw")
+    if not DATADIR_RAW.is_dir():
+        raise FileNotFoundError("Couldn't find \"raw\" data directory.")
+    ingest(DATADIR_RAW, Path.cwd().joinpath("processed"), args.poll_interval,
+           args.stable, args.debounce, args.once)
+
+
+if __name__ == "__main__":
+    main()
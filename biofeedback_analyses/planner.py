@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Dry-run planning of the pipelines. The tasks are compiled against the files
+on disk into units of work, i.e., (task, subject, session) triplets, as in
+the work queue. Each unit is marked as "run", "skip" (its output exists and
+recompute is False), "missing" (an input doesn't match any file), or
+"ambiguous" (an input matches more than one file). Outputs of units that
+would run count as existing inputs of the units of later tasks.
+
+Runtime and peak memory of each unit are estimated from the timings of past
+runs, which run_analysis.run() and the work queue record in an SQLite
+database in the working directory (see TIMINGS_FILENAME). Memory is the
+resident set size of the process (which is what matters for sizing worker
+pools), since tracing allocations would slow the pipelines down several
+times. It is recorded before each call ("base_bytes") and sampled every
+RSS_INTERVAL seconds on a background thread during the call ("peak_bytes"),
+such that the increase due to a call is known even if earlier calls of the
+same process needed more memory. Peaks that are shorter than RSS_INTERVAL
+can be missed.
+"""
+
+import time
+import socket
+import threading
+import sqlite3
+import fnmatch
+import resource
+import numpy as np
+import pandas as pd
+from contextlib import closing
+from biofeedback_analyses.preprocessing import steps as preprocessing_steps
+from biofeedback_analyses.config import RSS_INTERVAL
+
+
+def resolve_input(root, pattern, subject, session, planned):
+    """Return the existing and planned files that match an input of a task
+    for a subject and session. Tasks without subject (None) read a single
+    file in root."""
+
+    if subject is None:
+        path = root.joinpath(pattern)
+        return [path] if path.exists() or path in planned else []
+
+    if session is not None:
+        pattern = f"*{session}{pattern}"
+    directory = root.joinpath(subject)
+    existing = set(directory.glob(pattern)) if directory.is_dir() else set()
+    planned = {path for path in planned
+               if path.parent == directory and fnmatch.fnmatchcase(path.name, pattern)}
+
+    return sorted(existing | planned)
+
+
+def input_bytes(paths):
+    """Return the total size of paths or NaN if any of them doesn't exist
+    yet."""
+
+    if not all(path.exists() for path in paths):
+        return np.nan
+
+    return sum(path.stat().st_size for path in paths)
+
+
+def plan(tasks):
+    """Compile tasks into units of work.
+
+    Parameters
+    ----------
+    tasks : list of dict
+        Tasks as returned by the pipelines.
+
+    Returns
+    -------
+    units : DataFrame
+        One row per unit with its "stage", "task", "subject", "session",
+        "status", "detail", and "input_bytes" (NaN if some inputs are only
+        produced by preceding units).
+    """
+    planned = set()
+    rows = []
+
+    for stage, task in enumerate(tasks):
+        for subject in task["subjects"]:
+            for session in task.get("sessions", [None]):
+
+                row = {"stage": stage, "task": task["func"].__name__,
+                       "subject": subject, "session": session,
+                       "status": "run", "detail": "", "input_bytes": np.nan}
+
+                matches = {key: resolve_input(root, pattern, subject, session, planned)
+                           for key, (root, pattern) in task["inputs"].items()}
+                missing = [key for key, paths in matches.items() if not paths]
+                ambiguous = [key for key, paths in matches.items() if len(paths) > 1
+                             and (session is not None or subject is None)]
+                if missing:
+                    row["status"] = "missing"
+                    row["detail"] = f"no match for {', '.join(missing)}"
+                elif ambiguous:
+                    row["status"] = "ambiguous"
+                    row["detail"] = "; ".join(f"{key} matches {', '.join(path.name for path in matches[key])}"
+                                              for key in ambiguous)
+                else:
+                    row["input_bytes"] = input_bytes([path for paths in matches.values()
+                                                      for path in paths])
+
+                outputs = task["outputs"]
+                if row["status"] != "run" or outputs is None:
+                    pass
+                elif task["func"].__module__ == preprocessing_steps.__name__:
+                    # Outputs are named after the session's input, see preprocessing.steps.get_jobs().
+                    root, suffix = outputs["save_path"]
+                    for path in next(iter(matches.values())):
+                        save_path = root.joinpath(subject, f"{path.name[:23]}{suffix}")
+                        if save_path.exists() and not task["recompute"]:
+                            row["status"] = "skip"
+                        planned.add(save_path)
+                else:
+                    planned.update(root.joinpath(filename) for root, filename in outputs.values())
+
+                rows.append(row)
+
+    units = pd.DataFrame(rows)
+
+    return units
+
+
+def connect(timings_path):
+
+    con = sqlite3.connect(str(timings_path), timeout=60)
+    con.execute("CREATE TABLE IF NOT EXISTS timings (task TEXT, subject TEXT,"
+                " session TEXT, n_sessions INTEGER, input_bytes INTEGER,"
+                " seconds REAL, peak_bytes INTEGER, host TEXT, finished REAL)")
+    columns = [row[1] for row in con.execute("PRAGMA table_info(timings)")]
+    if "base_bytes" not in columns:    # recorded by earlier versions, whose peak_bytes is the peak of the process
+        con.execute("ALTER TABLE timings ADD COLUMN base_bytes INTEGER")
+
+    return con
+
+
+def current_rss():
+    """Current resident set size of the process in bytes. Falls back to the
+    peak resident set size of the process where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss    # bytes on macOS
+
+
+def sampled_call(func, interval=RSS_INTERVAL):
+    """Call func and return the resident set size before the call and its
+    maximum during the call, sampled every interval seconds on a background
+    thread (and right after the call)."""
+    base_bytes = current_rss()
+    samples = [base_bytes]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            samples.append(current_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        func()
+    finally:
+        stop.set()
+        sampler.join()
+    samples.append(current_rss())
+
+    return base_bytes, max(samples)
+
+
+def timed_call(task, subject, inputs, outputs, timings_path, session=None):
+    """Call a task and record its runtime, the resident set size before and
+    at its peak during the call (see sampled_call()), and the size of its
+    inputs in the timings database at timings_path."""
+
+    matches = {key: resolve_input(root, pattern, subject, None, set())
+               for key, (root, pattern) in inputs.items()}
+    paths = [path for paths in matches.values() for path in paths]
+    n_sessions = len(next(iter(matches.values()))) if subject is not None else 1
+
+    t0 = time.perf_counter()
+    base_bytes, peak_bytes = sampled_call(lambda: task["func"](subject, inputs, outputs, task["recompute"]))
+    seconds = time.perf_counter() - t0
+
+    with closing(connect(timings_path)) as con, con:
+        con.execute("INSERT INTO timings (task, subject, session, n_sessions, input_bytes, seconds,"
+                    " peak_bytes, host, finished, base_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (task["func"].__name__, subject, session, n_sessions,
+                     sum(path.stat().st_size for path in paths), seconds,
+                     peak_bytes, socket.gethostname(), time.time(), base_bytes))
+
+
+def load_timings(timings_path):
+
+    if not timings_path.exists():
+        return pd.DataFrame(columns=["task", "subject", "session", "n_sessions", "input_bytes",
+                                     "seconds", "peak_bytes", "host", "finished", "base_bytes"])
+    with closing(connect(timings_path)) as con:
+        timings = pd.read_sql_query("SELECT * FROM timings", con)
+
+    return timings
+
+
+def estimate(units, timings):
+    """Add the estimated runtime ("est_seconds") and peak memory
+    ("est_peak_bytes") of every unit that runs.
+
+    Runtime is scaled from the task's recorded seconds per input byte. Peak
+    memory is the task's largest recorded resident set size before a call
+    plus its largest recorded increase during a call, which is scaled up for
+    units whose inputs are larger than the largest recorded inputs of a
+    session (sessions are processed one after the other). Timings of earlier
+    versions without base_bytes count as increase. Units whose inputs don't
+    exist yet get the task's median runtime per session instead. Units of
+    tasks without recorded timings aren't estimated (NaN).
+    """
+    units = units.copy()
+    units["est_seconds"] = np.nan
+    units["est_peak_bytes"] = np.nan
+
+    timings = timings.loc[timings["input_bytes"] > 0]    # e.g., subjects without recordings
+
+    for task_name, task_timings in timings.groupby("task"):
+
+        n_sessions = task_timings["n_sessions"].clip(lower=1)
+        seconds_per_byte = task_timings["seconds"].sum() / task_timings["input_bytes"].sum()
+        seconds_per_session = (task_timings["seconds"] / n_sessions).median()
+        base_bytes = task_timings["base_bytes"].fillna(0)
+        increase_bytes = (task_timings["peak_bytes"] - base_bytes).max()
+        base_bytes = base_bytes.max()
+        bytes_per_session = (task_timings["input_bytes"] / n_sessions).max()
+
+        runs = (units["task"] == task_name) & (units["status"] == "run")
+        known = runs & units["input_bytes"].notna()
+        unknown = runs & units["input_bytes"].isna()
+        units.loc[known, "est_seconds"] = units.loc[known, "input_bytes"] * seconds_per_byte
+        units.loc[known, "est_peak_bytes"] = base_bytes + increase_bytes * (units.loc[known, "input_bytes"] /
+                                                                            bytes_per_session).clip(lower=1)
+        units.loc[unknown, "est_seconds"] = seconds_per_session
+        units.loc[unknown, "est_peak_bytes"] = base_bytes + increase_bytes
+
+    return units
+
+
+def print_plan(units, n_workers=1):
+    """Print the units and a summary of the plan, including the estimated
+    wall time with n_workers. Units of a stage can only start once all units
+    of preceding stages have finished."""
+
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(units.to_string(index=False))
+
+    counts = units["status"].value_counts()
+    print("\n" + ", ".join(f"{count} unit(s) {status}" for status, count in counts.items()) + ".")
+    for _, unit in units.loc[units["status"].isin(["missing", "ambiguous"])].iterrows():
+        print(f"{unit['status'].upper()}: {unit['task']} for {unit['subject']} {unit['session']}: {unit['detail']}")
+
+    runs = units.loc[units["status"] == "run"]
+    if runs["est_seconds"].isna().all():
+        print("No recorded timings to estimate runtime and memory from.")
+        return
+
+    wall_seconds = 0
+    for _, stage in runs.groupby("stage"):
+        seconds = stage["est_seconds"].dropna()
+        if seconds.size:
+            wall_seconds += max(seconds.sum() / n_workers, seconds.max())
+    n_estimated = runs["est_seconds"].notna().sum()
+    print(f"Estimated {runs['est_seconds'].sum():.1f} s of work in {n_estimated} of {len(runs)} unit(s) that"
+          f" run, about {wall_seconds:.1f} s wall time with {n_workers} worker(s). Estimated peak memory per"
+          f" worker {runs['est_peak_bytes'].max() / 1e6:.0f} MB.")
@@ -4,15 +4,23 @@
 author: Jan C. Brammer <jan.c.brammer@gmail.com>
 """
 
-from biofeedback_analyses.plotting.steps import (validate_summary_data,
+from biofeedback_analyses.plotting.steps import (collect_qc,
+                            validate_summary_data,
+                            compute_contrasts,
                             plot_figure_2,
                             plot_figure_3)
 
 
-def pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED):
+def pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED):
 
     return [
 
+        {"func": collect_qc,
+         "subjects": [None],
+         "inputs": {"qc_root": [DATADIR_PROCESSED, ""]},    # the QC files of all subjects
+         "outputs": {"save_path": [DATADIR_PROCESSED, "qc_all_sessions"]},
+         "recompute": True},
+
         {"func": validate_summary_data,
          "subjects": [None],
          "inputs": {"summary_path": [DATADIR_PROCESSED, "summary_all_subjects"]},
@@ -25,9 +33,18 @@ def pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED):
          "outputs": {"save_path": [DATADIR_PROCESSED, "Figure2.png"]},
          "recompute": False},
 
-        {"func": plot_figure_3,
+        {"func": compute_contrasts,
          "subjects": [None],
          "inputs": {"summary_path": [DATADIR_PROCESSED, "summary_all_subjects"]},
+         "outputs": {"save_path": [DATADIR_PROCESSED, "contrasts_all_metrics"],
+                     "bootstrap_path": [DATADIR_PROCESSED, "contrasts_all_metrics_bootstrap"]},
+         "recompute": False},
+
+        {"func": plot_figure_3,
+         "subjects": [None],
+         "inputs": {"summary_path": [DATADIR_PROCESSED, "summary_all_subjects"],
+                    "contrasts_path": [DATADIR_PROCESSED, "contrasts_all_metrics"],
+                    "bootstrap_path": [DATADIR_PROCESSED, "contrasts_all_metrics_bootstrap"]},
          "outputs": {"save_path": [DATADIR_PROCESSED, "Figure3.png"]},
          "recompute": False}
 
@@ -5,27 +5,70 @@ author: Jan C. Brammer <jan.c.brammer@gmail.com>
 """
 
 import hashlib
-import dabest
+import numpy as np
 import seaborn as sns
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 from matplotlib.lines import Line2D
-from biofeedback_analyses.config import DATA_HASH
+from biofeedback_analyses.analysis_utils import stats_utils, reference_utils
+from biofeedback_analyses.config import (DATA_HASH, REFERENCE_SUMMARY, SUMMARY_TOLERANCES,
+                                         BOOTSTRAP_RESAMPLES, BOOTSTRAP_SEED, BOOTSTRAP_JOBS)
 
 sns.set_theme()
 
 
+def collect_qc(subject, inputs, outputs, recompute):
+    """Collect the quality indices of all sessions (see
+    preprocessing.steps.screen_sessions()) into a single table, with one row
+    per session and the checks that it "failed"."""
+
+    root = inputs["qc_root"][0]
+    filename = inputs["qc_root"][1]
+    qc_paths = sorted(root.joinpath(filename).glob("*/*_qc"))
+
+    root = outputs["save_path"][0]
+    filename = outputs["save_path"][1]
+    save_path = root.joinpath(filename)
+
+    if not qc_paths:
+        print(f"No quality screening found in {root}.")
+        return
+
+    df = pd.concat([pd.read_csv(path, sep="\t") for path in qc_paths])
+    df["failed"] = df["failed"].fillna("")
+    df.to_csv(save_path, sep="\t", index=False)
+    n_failed = (df["failed"] != "").sum()
+    print(f"Saved {save_path} ({n_failed} of {len(df)} session(s) failed quality screening).")
+
+
 def validate_summary_data(subject, inputs, outputs, recompute):
     """Match the summary statistics which have been computed during this run of
     the analysis pipeline against the original summary statistics which have
-    been used to render Figures 2 and 3 in doi.org/10.3389/fpsyg.2021.586553."""
+    been used to render Figures 2 and 3 in doi.org/10.3389/fpsyg.2021.586553.
+
+    If config.REFERENCE_SUMMARY is set, every column is compared with the
+    reference summary file within its tolerance in config.SUMMARY_TOLERANCES
+    (see reference_utils.compare_summaries()), and the columns that deviate
+    are reported. Otherwise, the MD5 hash of the summary file is matched
+    against config.DATA_HASH."""
 
     root = inputs["summary_path"][0]
     filename = inputs["summary_path"][1]
     summary_path = root.joinpath(filename)
 
+    if REFERENCE_SUMMARY is not None:
+        table = reference_utils.compare_summaries(pd.read_csv(summary_path, sep="\t"),
+                                                  pd.read_csv(REFERENCE_SUMMARY, sep="\t"),
+                                                  SUMMARY_TOLERANCES)
+        failed = table.loc[~table["passed"]]
+        assert failed.empty, (f"{len(failed)} column(s) of {summary_path} deviate from {REFERENCE_SUMMARY}: " +
+                              "; ".join(f"{row['column']} by {row['max_abs']:.2e} (relative {row['max_rel']:.2e})"
+                                        f"{', ' + row['detail'] if row['detail'] else ''}"
+                                        for _, row in failed.iterrows()))
+        return
+
     h = hashlib.new("md5")
     with open(summary_path, "rb") as file:
         block = file.read(512)
@@ -36,7 +79,15 @@ def validate_summary_data(subject, inputs, outputs, recompute):
     assert hash == DATA_HASH, f"The hash of {summary_path} ({hash}) doesn't match the hash of the original data ({DATA_HASH})."
 
 
-def plot_figure_2(subject, inputs, outputs, recompute):
+def add_watermark(fig, text):
+    """Overlay text diagonally across fig, e.g., to mark figures that have
+    been rendered from approximate metrics."""
+
+    fig.text(.5, .5, text, fontsize="xx-large", fontweight="bold", color="r", alpha=.3,
+             ha="center", va="center", rotation=30, zorder=10)
+
+
+def plot_figure_2(subject, inputs, outputs, recompute, watermark=None):
 
     root = inputs["summary_path"][0]
     filename = inputs["summary_path"][1]
@@ -144,32 +195,119 @@ def plot_figure_2(subject, inputs, outputs, recompute):
             fontweight="medium")
 
     plt.subplots_adjust(wspace=.5, hspace=.05)
+    if watermark is not None:
+        add_watermark(fig, watermark)
     fig.savefig(save_path, bbox_inches="tight", dpi=300)
 
 
-def plot_figure_3(subject, inputs, outputs, recompute):
+def compute_contrasts(subject, inputs, outputs, recompute):
+    """Compute the mean difference between cond-B (biofeedback) and cond-A (no
+    biofeedback), its bootstrap confidence interval, and its permutation
+    p-value for every column of the summary. The bootstrap resamples of the
+    mean differences are saved at bootstrap_path for plotting their
+    distribution."""
+
+    root = inputs["summary_path"][0]
+    filename = inputs["summary_path"][1]
+    summary_path = root.joinpath(filename)
+
+    root = outputs["save_path"][0]
+    filename = outputs["save_path"][1]
+    save_path = root.joinpath(filename)
+
+    root = outputs["bootstrap_path"][0]
+    filename = outputs["bootstrap_path"][1]
+    bootstrap_path = root.joinpath(filename)
+
+    if save_path.exists() and bootstrap_path.exists() and not recompute:
+        print(f"Not re-computing {save_path}.")
+        return
+
+    df = pd.read_csv(summary_path, sep='\t')
+    metrics = [column for column in df.columns if column not in ["subj", "sess", "cond"]]
+
+    contrasts, resamples = stats_utils.contrast_table(df, metrics, "cond", "cond-A", "cond-B",
+                                                      return_resamples=True,
+                                                      n_resamples=BOOTSTRAP_RESAMPLES,
+                                                      seed=BOOTSTRAP_SEED, n_jobs=BOOTSTRAP_JOBS)
+    contrasts.to_csv(save_path, sep="\t", index=False)
+    print(f"Saved {save_path}")
+    resamples.to_csv(bootstrap_path, sep="\t", index=False)
+    print(f"Saved {bootstrap_path}")
+
+
+def plot_contrast(df, contrasts, resamples, metric, ax, contrast_ax, swarm_ylim=None):
+    """Plot the raw data of both conditions next to the mean difference, its
+    confidence interval, and the half-violin of its bootstrap distribution
+    (Gardner-Altman plot, as drawn by dabest)."""
+
+    sns.swarmplot(data=df, x="cond", y=metric, hue="sess", order=["cond-A", "cond-B"],
+                  palette="tab10", size=6, ax=ax)
+    ax.legend().remove()
+    ax.set_xlabel("")
+    if swarm_ylim is not None:
+        ax.set_ylim(swarm_ylim)
+
+    n_nobiofeedback = df.loc[df["cond"] == "cond-A", metric].count()
+    n_biofeedback = df.loc[df["cond"] == "cond-B", metric].count()
+    ax.set_xticks([0, 1])
+    ax.set_xticklabels([f"no biofeedback\nN={n_nobiofeedback}",
+                        f"biofeedback\nN={n_biofeedback}"])
+
+    contrast = contrasts.loc[contrasts["metric"] == metric].iloc[0]
+    violin = contrast_ax.violinplot(resamples[metric].to_numpy(), positions=[0], widths=1,
+                                    showextrema=False)
+    for body in violin["bodies"]:
+        vertices = body.get_paths()[0].vertices
+        vertices[:, 0] = np.clip(vertices[:, 0], 0, None)    # keep the right half
+        body.set_facecolor("grey")
+        body.set_edgecolor("none")
+        body.set_alpha(.8)
+    contrast_ax.errorbar(0, contrast["mean_diff"],
+                         yerr=[[contrast["mean_diff"] - contrast["ci_low"]],
+                               [contrast["ci_high"] - contrast["mean_diff"]]],
+                         fmt="o", color="k", markersize=6, capsize=0, linewidth=1.5)
+    contrast_ax.axhline(0, color="k", linewidth=.8)
+    contrast_ax.set_xlim(-1, 1)
+    contrast_ax.set_xticks([0])
+    contrast_ax.set_xticklabels(["biofeedback\nminus\nno biofeedback"])
+    contrast_ax.yaxis.tick_right()
+    contrast_ax.yaxis.set_label_position("right")
+    contrast_ax.set_ylabel("mean difference")
+
+
+def plot_figure_3(subject, inputs, outputs, recompute, watermark=None):
 
     root = inputs["summary_path"][0]
     filename = inputs["summary_path"][1]
     summary_path = root.joinpath(filename)
 
+    root = inputs["contrasts_path"][0]
+    filename = inputs["contrasts_path"][1]
+    contrasts_path = root.joinpath(filename)
+
+    root = inputs["bootstrap_path"][0]
+    filename = inputs["bootstrap_path"][1]
+    bootstrap_path = root.joinpath(filename)
+
     root = outputs["save_path"][0]
     filename = outputs["save_path"][1]
     save_path = root.joinpath(filename)
 
     df = pd.read_csv(summary_path, sep='\t')
+    contrasts = pd.read_csv(contrasts_path, sep='\t')    # bootstrapped by compute_contrasts()
+    resamples = pd.read_csv(bootstrap_path, sep='\t')
 
-    fig, (ax0, ax1) = plt.subplots(nrows=2, ncols=1, figsize=(3.3, 7))
+    fig = plt.figure(figsize=(4.4, 7))
+    gs = GridSpec(2, 2, figure=fig, width_ratios=[2, 1])
+    ax0 = fig.add_subplot(gs[0, 0])
+    ax0_contrast = fig.add_subplot(gs[0, 1])
+    ax1 = fig.add_subplot(gs[1, 0])
+    ax1_contrast = fig.add_subplot(gs[1, 1])
 
-    est = dabest.load(df, idx=("cond-A", "cond-B"), x="cond", y="mean_resp_rate")
-    n_nobiofeedback = est.data.loc[est.data["cond"] == "cond-A", "mean_resp_rate"].count()
-    n_biofeedback = est.data.loc[est.data["cond"] == "cond-B", "mean_resp_rate"].count()
-    est.mean_diff.plot(color_col="sess", ax=ax0, custom_palette="tab10",
-                        raw_marker_size=6)
-    ax0.set_xticklabels([f"no biofeedback\nN={n_nobiofeedback}",
-                            f"biofeedback\nN={n_biofeedback}"])
-    ax0.contrast_axes.set_xticklabels(["", "biofeedback\nminus\nno biofeedback"])
-    ax0.contrast_axes.legend().remove()
+    plot_contrast(df, contrasts, resamples, "mean_resp_rate", ax0, ax0_contrast)
+    plot_contrast(df, contrasts, resamples, "mean_original_resp_biofeedback", ax1, ax1_contrast,
+                  swarm_ylim=(-0.05, 1))
 
     session_labels = [str(i) for i in range(1, 11)]
     session_colors = sns.color_palette(n_colors=10)
@@ -186,21 +324,8 @@ def plot_figure_3(subject, inputs, outputs, recompute):
                 handletextpad=0)
 
 
-    est = dabest.load(df, idx=("cond-A", "cond-B"), x="cond", y="mean_original_resp_biofeedback")
-    n_nobiofeedback = est.data.loc[est.data["cond"] == "cond-A", "mean_original_resp_biofeedback"].count()
-    n_biofeedback = est.data.loc[est.data["cond"] == "cond-B", "mean_original_resp_biofeedback"].count()
-    est.mean_diff.plot(color_col="sess", ax=ax1, custom_palette="tab10",
-                        raw_marker_size=6, swarm_ylim=(-0.05, 1))
-    ax1.set_xticklabels([f"no biofeedback\nN={n_nobiofeedback}",
-                            f"biofeedback\nN={n_biofeedback}"])
-    ax1.contrast_axes.set_xticklabels(["", "biofeedback\nminus\nno biofeedback"])
-    ax1.contrast_axes.legend().remove()
-
-
     ax0.set_ylabel("mean breathing rate", fontsize="large", fontweight="bold")
     ax1.set_ylabel("mean biofeedback score", fontsize="large", fontweight="bold")
-    ax0.contrast_axes.set_ylabel("mean difference")
-    ax1.contrast_axes.set_ylabel("mean difference")
 
 
     ax0.text(ax0.get_xbound()[0] - .4, ax0.get_ybound()[-1] + .1, "(A)", fontsize="large",
@@ -208,5 +333,7 @@ def plot_figure_3(subject, inputs, outputs, recompute):
     ax1.text(ax1.get_xbound()[0] - .4, ax1.get_ybound()[-1] + .1, "(B)", fontsize="large",
             fontweight="medium")
 
-    plt.subplots_adjust(wspace=None, hspace=.3)
+    plt.subplots_adjust(wspace=.1, hspace=.4)
+    if watermark is not None:
+        add_watermark(fig, watermark)
     fig.savefig(save_path, bbox_inches="tight", dpi=300)
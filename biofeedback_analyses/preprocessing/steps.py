@@ -6,73 +6,162 @@ author: Jan C. Brammer <jan.c.brammer@gmail.com>
 
 import pandas as pd
 import numpy as np
-from mne.io import read_raw_edf
-from biofeedback_analyses.analysis_utils import event_utils, resp_utils, hrv_utils, biofeedback_utils
+from biofeedback_analyses import config, sessions
+from biofeedback_analyses.analysis_utils import event_utils, resp_utils, hrv_utils, io_utils, sidecar_utils, qc_utils
+from biofeedback_analyses.config import OUT_OF_CORE_DURATION, BLOCK_DURATION, BLOCK_MARGIN, FFT_WORKERS, SFREQ
 
 
-def preprocess_events(subject, inputs, outputs, recompute):
+def get_jobs(paths, subject, outputs, recompute, signal=None):
+    """Pair each input path with the path of its output and drop the pairs
+    whose output already exists (unless recompute is True), as well as the
+    pairs of sessions that are skipped due to the quality screening of
+    signal (see qc_utils.skip_session())."""
 
-    root = inputs["event_path"][0]
-    filename = inputs["event_path"][1]
-    event_paths = root.joinpath(subject).glob(filename)
+    jobs = []
 
-    for event_path in event_paths:
+    for path in paths:
 
         root = outputs["save_path"][0]
-        subj_sess_cond = event_path.name[:23]
+        subj_sess_cond = path.name[:23]
         filename = f"{subj_sess_cond}{outputs['save_path'][1]}"
         save_path = root.joinpath(f"{subject}/{filename}")
 
         computed = save_path.exists()   # Boolean indicating if file already exists.
         if computed and not recompute:    # only recompute if requested
             continue
+        if signal is not None and qc_utils.skip_session(qc_utils.qc_path(save_path.parent, save_path), signal):
+            continue
+
+        jobs.append((path, save_path))
+
+    return jobs
+
+
+def read_tsv(job):
+
+    return pd.read_csv(job[0], sep="\t")
+
+
+def sync_model_path(event_path):
+    """Return the path of the synchronization model saved next to the
+    formatted events at event_path."""
+
+    return event_path.with_name(f"{event_path.name}_sync.json")
+
+
+def read_events_and_sync_model(job):
+    """Read formatted events and their synchronization model. Fit the model
+    if it hasn't been saved (e.g., events that were formatted by an earlier
+    version)."""
+
+    events = pd.read_csv(job[0], sep="\t")
+    model_path = sync_model_path(job[0])
+    if not model_path.exists():
+        print(f"Didn't find synchronization model for {job[0]}, fitting it.")
+        return events, event_utils.fit_sync_model(events)
+
+    return events, event_utils.load_sync_model(model_path)
+
+
+def read_game_window(save_path):
+    """Return the game window from the sidecar of the session's formatted
+    events, or None if it isn't available."""
+
+    for event_path in save_path.parent.glob(f"{save_path.name[:21]}*events"):
+        sidecar = sidecar_utils.load_sidecar(event_path)
+        if sidecar is not None and sidecar["game"] is not None:
+            return sidecar["game"]["beg"], sidecar["game"]["end"]
 
-        events = pd.read_csv(event_path, sep='\t')
-        events = event_utils.format_events(events)
+    return None
+
+
+def read_events_and_sfreq(job):
+    """Read the events of a recordtrigger file and the sampling frequency of
+    the session's recording, which is None if the recording doesn't exist
+    (the recording is then assumed to be at SFREQ)."""
+
+    events = pd.read_csv(job[0], sep="\t")
+    physio_paths = list(job[0].parent.glob(f"{job[0].name[:23]}*recordsignal*"))
+    if len(physio_paths) != 1:
+        return events, None
+
+    return events, io_utils.read_edf_header(physio_paths[0])["sfreq"][0]
+
+
+def open_edf(job):
+    """Parse the EDF header and read the respiration channel at SFREQ unless
+    the recording is processed out-of-core."""
+
+    header = io_utils.read_edf_header(job[0])
+    if header["n_times"][0] > OUT_OF_CORE_DURATION * header["sfreq"][0]:
+        return header, None
+
+    return header, io_utils.read_edf_resampled(job[0], channel=0, header=header,
+                                               dtype=config.SIGNAL_DTYPE)
+
+
+def preprocess_events(subject, inputs, outputs, recompute):
+
+    root = inputs["event_path"][0]
+    filename = inputs["event_path"][1]
+    event_paths = root.joinpath(subject).glob(filename)
+    jobs = get_jobs(event_paths, subject, outputs, recompute)
+
+    for (event_path, save_path), (events, sfreq) in io_utils.prefetch(jobs, read_events_and_sfreq):
+
+        events, sync_model = sessions.format_session_events(events, sfreq)    # fit once, downstream steps load the model
 
         events.to_csv(save_path, sep="\t", index=False)
+        event_utils.save_sync_model(sync_model, sync_model_path(save_path))
+        sidecar_utils.write_sidecar(save_path, events, game=event_utils.get_game_window(events),
+                                    columns=[])
         print(f"Saved {save_path}")
 
 
-def preprocess_ibis(subject, inputs, outputs, recompute):
+def screen_sessions(subject, inputs, outputs, recompute):
+    """Save the quality indices of each session (see qc_utils), computed
+    from its formatted events and raw recording."""
 
     root = inputs["event_path"][0]
     filename = inputs["event_path"][1]
     event_paths = list(root.joinpath(subject).glob(filename))
+    root = inputs["physio_path"][0]
+    filename = inputs["physio_path"][1]
+    physio_paths = list(root.joinpath(subject).glob(filename))
+    jobs = get_jobs(event_paths, subject, outputs, recompute)
 
-    for event_path in event_paths:
+    for (event_path, save_path), (events, sync_model) in io_utils.prefetch(jobs, read_events_and_sync_model):
 
-        root = outputs["save_path"][0]
-        subj_sess_cond = event_path.name[:23]
-        filename = f"{subj_sess_cond}{outputs['save_path'][1]}"
-        save_path = root.joinpath(f"{subject}/{filename}")
+        physio_path = next((path for path in physio_paths if path.name[:23] == event_path.name[:23]), None)
+        qc = qc_utils.screen_session(events, sync_model, physio_path)
+        failed = qc_utils.failed_checks(qc)
 
-        computed = save_path.exists()   # Boolean indicating if file already exists.
-        if computed and not recompute:    # only recompute if requested
-            continue
+        name = event_path.name
+        data = pd.DataFrame([{"subj": name[:7], "sess": name[8:15], "cond": name[16:22], **qc,
+                              "failed": ",".join(failed)}])
+        data.to_csv(save_path, sep="\t", index=False)
+        if failed:
+            print(f"{name[:22]} failed quality screening ({', '.join(failed)}).")
+        print(f"Saved {save_path}")
 
-        events = pd.read_csv(event_path, sep='\t')
 
-        # Multiple IBIs can be associated with the same sample since Polar belt can include multiple IBIs in a single notification.
-        ibis = event_utils.get_eventvalues(events, "InterBeatInterval")
+def preprocess_ibis(subject, inputs, outputs, recompute):
 
-        if ibis.size == 0:
-            print(f"Didn't find InterBeatInterval events for {event_path}.")
-            continue
+    root = inputs["event_path"][0]
+    filename = inputs["event_path"][1]
+    event_paths = list(root.joinpath(subject).glob(filename))
+    jobs = get_jobs(event_paths, subject, outputs, recompute, signal="ibis")
 
-        ibis_corrected = hrv_utils.correct_ibis(ibis)
-        # Associate IBIs with a sample that represents the time of their occurrence (relative to breathing belt recording) rather
-        # than the time of the Polar belt notification.
-        peaks_corrected = hrv_utils.ibis_to_rpeaks(ibis_corrected, events)
+    for (event_path, save_path), (events, sync_model) in io_utils.prefetch(jobs, read_events_and_sync_model):
 
-        # Interpolate such that IBIs are aligned with respiration signal. Starting
-        # at sample 0 (i.e., start of breathing belt recording) and ending at the sample that corresponds to the last recorded IBI.
-        ibis_interpolated = hrv_utils.interpolate_ibis(peaks_corrected,
-                                                       ibis_corrected,
-                                                       range(peaks_corrected[-1]))
+        ibis_interpolated = sessions.compute_ibis(events, sync_model)
+        if ibis_interpolated is None:
+            print(f"Didn't find InterBeatInterval events for {event_path}.")
+            continue
 
-        pd.Series(ibis_interpolated).to_csv(save_path, sep="\t", header=True,
-                                            index=False, float_format="%.4f")
+        data = pd.Series(ibis_interpolated).to_frame()
+        data.to_csv(save_path, sep="\t", header=True, index=False, float_format="%.4f")
+        sidecar_utils.write_sidecar(save_path, data, game=event_utils.get_game_window(events))
         print(f"Saved {save_path}")
 
 
@@ -81,55 +170,75 @@ def preprocess_resp(subject, inputs, outputs, recompute):
     root = inputs["physio_path"][0]
     filename = inputs["physio_path"][1]
     physio_paths = root.joinpath(subject).glob(filename)
+    jobs = get_jobs(physio_paths, subject, outputs, recompute, signal="resp")
 
-    for physio_path in physio_paths:
+    for (physio_path, save_path), (header, resp) in io_utils.prefetch(jobs, open_edf):
 
-        root = outputs["save_path"][0]
-        subj_sess_cond = physio_path.name[:23]
-        filename = f"{subj_sess_cond}{outputs['save_path'][1]}"
-        save_path = root.joinpath(f"{subject}/{filename}")
+        sfreq = SFREQ    # the recording has been resampled
 
-        computed = save_path.exists()   # Boolean indicating if file already exists.
-        if computed and not recompute:    # only recompute if requested
+        if resp is None:    # recording is too long to be read at once
+            preprocess_resp_blockwise(physio_path, header, save_path)
+            print(f"Saved {save_path}")
             continue
 
-        data = read_raw_edf(physio_path, preload=True, verbose="error")
-        resp = np.ravel(data.get_data(picks=0))
-        sfreq = data.info["sfreq"]
-
-        resp_filt = biofeedback_utils.biofeedback_filter(resp, sfreq)
-        inst_amp = resp_utils.instantaneous_amplitude(resp_filt)
+        resp_filt, inst_amp = sessions.compute_resp(resp, sfreq)
 
-        pd.DataFrame({"resp_filt": resp_filt,
-                      "inst_amp": inst_amp}).to_csv(save_path, sep="\t",
-                                                    header=True, index=False,
-                                                    float_format="%.4f")
+        data = pd.DataFrame({"resp_filt": resp_filt, "inst_amp": inst_amp})
+        data.to_csv(save_path, sep="\t", header=True, index=False,
+                    float_format="%.4f")
+        sidecar_utils.write_sidecar(save_path, data, game=read_game_window(save_path))
         print(f"Saved {save_path}")
 
 
+def preprocess_resp_blockwise(physio_path, header, save_path):
+    """Out-of-core version of the computation in preprocess_resp(). The
+    recording is read, filtered, and transformed block by block and each block
+    is appended to save_path as soon as it has been computed. For details see
+    resp_utils.iter_resp_blocks(). The resulting resp_filt deviates from the
+    in-memory one by rounding errors only (about 1e-14), whereas inst_amp
+    deviates throughout the blocks due to the finite margin, by up to about
+    2e-4 of its range on synthetic respiration. About 6 % of the saved values
+    differ by one unit of the last of the four saved decimals (see the
+    "preprocess_resp_blockwise" entry in equivalence.py)."""
+    sfreq = SFREQ
+    blocksize = int(np.rint(BLOCK_DURATION * sfreq))
+    hilbert_margin = int(np.rint(BLOCK_MARGIN * sfreq))
+    n_times = io_utils.n_resampled(header["n_times"][0], header["sfreq"][0], sfreq)
+
+    def read_block(beg, end):
+        return io_utils.read_edf_resampled(physio_path, channel=0, start=beg,
+                                           stop=end, sfreq=sfreq, header=header,
+                                           dtype=config.SIGNAL_DTYPE)
+
+    blocks = resp_utils.iter_resp_blocks(read_block, n_times, sfreq,
+                                         blocksize, hilbert_margin,
+                                         workers=FFT_WORKERS)
+    stats = sidecar_utils.stats_init(["resp_filt", "inst_amp"])
+    for i, (resp_filt, inst_amp) in enumerate(blocks):
+        data = pd.DataFrame({"resp_filt": io_utils.as_signal(resp_filt),
+                             "inst_amp": io_utils.as_signal(inst_amp)})
+        data.to_csv(save_path, sep="\t", header=i == 0, index=False,
+                    float_format="%.4f", mode="w" if i == 0 else "a")
+        sidecar_utils.stats_update(stats, data)
+    sidecar_utils.save_sidecar(save_path, sidecar_utils.stats_finalize(stats, read_game_window(save_path)))
+
+
 def preprocess_hrv_biofeedback(subject, inputs, outputs, recompute):
 
     root = inputs["physio_path"][0]
     filename = inputs["physio_path"][1]
     physio_paths = list(root.joinpath(subject).glob(filename))
+    jobs = get_jobs(physio_paths, subject, outputs, recompute, signal="ibis")
 
-    for physio_path in physio_paths:
-
-        root = outputs["save_path"][0]
-        subj_sess_cond = physio_path.name[:23]
-        filename = f"{subj_sess_cond}{outputs['save_path'][1]}"
-        save_path = root.joinpath(f"{subject}/{filename}")
-
-        computed = save_path.exists()   # Boolean indicating if file already exists.
-        if computed and not recompute:    # only recompute if requested
-            continue
+    for (physio_path, save_path), data in io_utils.prefetch(jobs, read_tsv):
 
-        ibis = np.ravel(pd.read_csv(physio_path, sep='\t'))
-        local_power_hrv = hrv_utils.compute_local_power(ibis)
+        ibis = io_utils.as_signal(np.ravel(data))
+        chunk_size = int(BLOCK_DURATION * SFREQ) if ibis.size > OUT_OF_CORE_DURATION * SFREQ else None
+        local_power_hrv = io_utils.as_signal(hrv_utils.compute_local_power(ibis, chunk_size))
 
-        pd.DataFrame({"local_power_hrv": local_power_hrv}).to_csv(save_path, sep="\t",
-                                                                  header=True, index=False,
-                                                                  float_format="%.4f")
+        data = pd.DataFrame({"local_power_hrv": local_power_hrv})
+        data.to_csv(save_path, sep="\t", header=True, index=False, float_format="%.4f")
+        sidecar_utils.write_sidecar(save_path, data, game=read_game_window(save_path))
         print(f"Saved {save_path}")
 
 
@@ -138,30 +247,15 @@ def preprocess_resp_biofeedback(subject, inputs, outputs, recompute):
     root = inputs["event_path"][0]
     filename = inputs["event_path"][1]
     event_paths = list(root.joinpath(subject).glob(filename))
+    jobs = get_jobs(event_paths, subject, outputs, recompute, signal="biofeedback")
 
-    for event_path in event_paths:
-
-        root = outputs["save_path"][0]
-        subj_sess_cond = event_path.name[:23]
-        filename = f"{subj_sess_cond}{outputs['save_path'][1]}"
-        save_path = root.joinpath(f"{subject}/{filename}")
-
-        computed = save_path.exists()   # Boolean indicating if file already exists.
-        if computed and not recompute:    # only recompute if requested
-            continue
+    for (event_path, save_path), events in io_utils.prefetch(jobs, read_tsv):
 
-        events = pd.read_csv(event_path, sep='\t')
-        biofeedback_values = event_utils.get_eventvalues(events, "Feedback")
-        if biofeedback_values.size == 0:
+        original_biofeedback = sessions.compute_original_resp_biofeedback(events)
+        if original_biofeedback is None:
             print(f"Didn't find Feedback events for {event_path}.")
             continue
-        biofeedback_samples = event_utils.get_eventtimes(events, "Feedback", as_sample=True)
-        # Interpolate such that biofeedback scores are aligned with respiration signal.
-        # Starting at sample 0 and ending at the sample that corresponds to the last recorded biofeedback score.
-        original_biofeedback = biofeedback_utils.interpolate_biofeedback(biofeedback_samples,
-                                                                         biofeedback_values,
-                                                                         range(biofeedback_samples[-1]))
-        pd.DataFrame({"original_resp_biofeedback": original_biofeedback}).to_csv(save_path, sep="\t",
-                                                                                 header=True, index=False,
-                                                                                 float_format="%.4f")
+        data = pd.DataFrame({"original_resp_biofeedback": original_biofeedback})
+        data.to_csv(save_path, sep="\t", header=True, index=False, float_format="%.4f")
+        sidecar_utils.write_sidecar(save_path, data, game=event_utils.get_game_window(events))
         print(f"Saved {save_path}")
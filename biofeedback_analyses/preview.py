@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Preview runs, i.e., approximate summary statistics and figures for day-to-day
+quality control. Rather than the entire game, only PREVIEW_WINDOWS randomly
+placed windows of PREVIEW_WINDOW_DURATION seconds of each session's game are
+read (see io_utils.read_edf_resampled()) and summarized, such that the cost
+of a session is bounded regardless of the duration of its recording. The
+windows are stratified, i.e., one window is drawn from each of
+PREVIEW_WINDOWS equal parts of the game, and seeded per session with
+PREVIEW_SEED. Run with
+
+    python -m biofeedback_analyses.run_analysis --preview
+
+in the directory that contains "raw". The approximate summary, contrasts,
+and Figures 2 and 3 (watermarked as previews) are saved to the "preview"
+directory, which is overwritten by each preview run. If "processed" contains
+the summary of a full run, the error of each previewed metric against it is
+reported and saved to preview/preview_errors.
+"""
+
+import zlib
+import numpy as np
+import pandas as pd
+from itertools import product
+from scipy.signal import welch
+from biofeedback_analyses import config, sessions
+from biofeedback_analyses.analysis_utils import (event_utils, resp_utils, hrv_utils, biofeedback_utils,
+                                                 io_utils, quantile_utils, ragged_utils)
+from biofeedback_analyses.plotting import steps as plotting_steps
+from biofeedback_analyses.config import (SFREQ, SUBJECTS, SESSIONS, PREVIEW_WINDOWS,
+                                         PREVIEW_WINDOW_DURATION, PREVIEW_SEED)
+
+
+MIN_WINDOW_SAMPLES = 64    # windows that are cut shorter than this by the end of a signal are dropped
+
+
+def preview_windows(game, n_windows, window, rng):
+    """Return (beg, end) of n_windows windows of window samples, one drawn at
+    random from each of n_windows equal parts of the game. The entire game is
+    a single window if it is shorter than n_windows windows."""
+    beg, end = game
+    if end - beg <= n_windows * window:
+        return [(beg, end)]
+
+    stratum = (end - beg) // n_windows
+    starts = beg + np.arange(n_windows) * stratum + rng.integers(0, stratum - window + 1, n_windows)
+
+    return [(start, start + window) for start in starts]
+
+
+def clip_windows(windows, stop):
+    """Cut the windows at stop (e.g., the last IBI) and drop those that are
+    shorter than MIN_WINDOW_SAMPLES."""
+    windows = [(beg, min(end, stop)) for beg, end in windows]
+
+    return [(beg, end) for beg, end in windows if end - beg >= MIN_WINDOW_SAMPLES]
+
+
+def compute_preview_resp_stats(resps, sfreq):
+    """compute_resp_stats() of the breaths of all windows together."""
+    rates, amps = [], []
+
+    for resp in resps:
+        resp = np.asarray(resp, dtype=np.float64)
+        _, rate, amp = resp_utils.resp_stats(resp_utils.resp_extrema(resp, sfreq), resp, sfreq)
+        rates.append(rate)
+        amps.append(amp)
+    rate, amp = np.concatenate(rates), np.concatenate(amps)
+
+    return {"median_resp_rate": quantile_utils.median(rate),
+            "median_resp_amp": quantile_utils.median(amp),
+            "mean_resp_rate": np.mean(rate)}
+
+
+def compute_preview_hrv_stats(ibis, sfreq):
+    """compute_hrv_stats() of the IBIs of all windows together. The PSD
+    averages the Welch segments of all windows."""
+    nperseg = min(4096, min(signal.size for signal in ibis))
+    step = nperseg - nperseg // 2
+    psds = []
+    for signal in ibis:
+        freqs, psd = welch(np.asarray(signal, dtype=np.float64), fs=sfreq, nperseg=nperseg)
+        psds.append(psd)
+    n_segments = [(signal.size - nperseg) // step + 1 for signal in ibis]
+    stats = hrv_utils.compute_hrv_band_stats(freqs, np.average(psds, axis=0, weights=n_segments))
+
+    values, offsets = ragged_utils.pack(ibis)
+    diffs, _ = ragged_utils.segment_diff(values, offsets)    # successive differences within windows
+    stats["median_heart_period"] = quantile_utils.median(values)
+    stats["rmssd"] = np.sqrt(np.mean(diffs ** 2))
+
+    return stats
+
+
+def preview_session(physio_path, event_path, n_windows=PREVIEW_WINDOWS,
+                    window=PREVIEW_WINDOW_DURATION, seed=PREVIEW_SEED, subject=None,
+                    session=None):
+    """Approximate the summary statistics of a session from windows of its
+    game (see preview_windows()).
+
+    Only the windows of the respiration are read, and the IBIs and
+    biofeedback scores are only interpolated within the windows.
+
+    Returns
+    -------
+    metrics : dict
+        Named as in the summary file. Empty if the game window can't be
+        determined.
+    """
+    header = io_utils.read_edf_header(physio_path)
+    events, sync_model = sessions.format_session_events(pd.read_csv(event_path, sep="\t"),
+                                                        header["sfreq"][0])
+    game = event_utils.get_game_window(events)
+    if game is None:
+        print(f"Didn't find the game window of {subject} {session}.")
+        return {}
+    rng = np.random.default_rng([seed, zlib.crc32(f"{subject}_{session}".encode())])
+    windows = preview_windows(game, n_windows, int(np.rint(window * SFREQ)), rng)
+
+    resps = [io_utils.read_edf_resampled(physio_path, 0, beg, end, header=header,
+                                         dtype=config.SIGNAL_DTYPE) for beg, end in windows]
+    metrics = compute_preview_resp_stats(resps, SFREQ)
+
+    ibis = event_utils.get_eventvalues(events, "InterBeatInterval")
+    if ibis.size:
+        ibis_corrected = hrv_utils.correct_ibis(ibis)
+        peaks = hrv_utils.ibis_to_rpeaks(ibis_corrected, events, sync_model)
+        ibi_windows = clip_windows(windows, peaks[-1])
+        if ibi_windows:
+            metrics.update(compute_preview_hrv_stats([hrv_utils.interpolate_ibis(peaks, ibis_corrected, np.arange(beg, end))
+                                                      for beg, end in ibi_windows], SFREQ))
+
+    biofeedback_values = event_utils.get_eventvalues(events, "Feedback")
+    if biofeedback_values.size:
+        biofeedback_samples = event_utils.get_eventtimes(events, "Feedback", as_sample=True)
+        biofeedback_windows = clip_windows(windows, biofeedback_samples[-1])
+        if biofeedback_windows:
+            biofeedback = np.concatenate([biofeedback_utils.interpolate_biofeedback(biofeedback_samples, biofeedback_values,
+                                                                                    np.arange(beg, end))
+                                          for beg, end in biofeedback_windows])
+            metrics.update(biofeedback_utils.compute_original_resp_biofeedback_stats(biofeedback))
+
+    return metrics
+
+
+def preview_summary(DATADIR_RAW, n_windows=PREVIEW_WINDOWS, window=PREVIEW_WINDOW_DURATION,
+                    seed=PREVIEW_SEED):
+    """Return the approximate summary of all sessions in DATADIR_RAW, with
+    one row per subject and session as in the summary file (empty for
+    sessions without recordings)."""
+
+    rows = []
+    for subject, session, physio_path, event_path in sessions.iter_raw_sessions(DATADIR_RAW):
+        metrics = preview_session(physio_path, event_path, n_windows, window, seed, subject, session)
+        rows.append({"subj": subject, "sess": session[:7], "cond": session[-6:], **metrics})
+        print(f"Previewed {subject} {session}.")
+
+    grid = pd.DataFrame([{"subj": subject, "sess": session[:7], "cond": session[-6:]}
+                         for subject, session in product(SUBJECTS, SESSIONS)])
+
+    previewed = pd.DataFrame(rows) if rows else pd.DataFrame(columns=["subj", "sess", "cond"])
+
+    return grid.merge(previewed, on=["subj", "sess", "cond"], how="left")
+
+
+def preview_errors(preview, summary, keys=("subj", "sess", "cond")):
+    """Error of each previewed metric against the summary of a full run,
+    over the sessions that have both.
+
+    Returns
+    -------
+    errors : DataFrame
+        One row per metric with the number of sessions ("n_sessions"), the
+        mean error ("bias"), the mean and maximum absolute error
+        ("mean_abs_error", "max_abs_error"), and the median and maximum
+        error relative to the full run ("median_rel_error",
+        "max_rel_error").
+    """
+    keys = list(keys)
+    merged = preview.merge(summary, on=keys, suffixes=("", "_full"))
+    rows = []
+
+    for metric in [column for column in preview.columns if column not in keys and column in summary.columns]:
+        full = merged[f"{metric}_full"].astype(float)
+        error = (merged[metric].astype(float) - full).dropna()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            relative = (error.abs() / full.abs()).dropna()
+        rows.append({"metric": metric, "n_sessions": error.size,
+                     "bias": error.mean(), "mean_abs_error": error.abs().mean(),
+                     "max_abs_error": error.abs().max(),
+                     "median_rel_error": relative.median(), "max_rel_error": relative.max()})
+
+    return pd.DataFrame(rows, columns=["metric", "n_sessions", "bias", "mean_abs_error", "max_abs_error",
+                                       "median_rel_error", "max_rel_error"])
+
+
+def preview_cohort(DATADIR_RAW, DATADIR_PROCESSED, DATADIR_PREVIEW):
+    """Save the approximate summary, contrasts, and watermarked figures of
+    all sessions in DATADIR_RAW to DATADIR_PREVIEW, and report the error of
+    each previewed metric against the summary of the last full run in
+    DATADIR_PROCESSED (if there is one)."""
+
+    DATADIR_PREVIEW.mkdir(exist_ok=True)
+    summary_path = DATADIR_PREVIEW.joinpath("summary_all_subjects")
+    summary = preview_summary(DATADIR_RAW)
+    summary.to_csv(summary_path, sep="\t", index=False)
+    print(f"Saved {summary_path}")
+
+    watermark = f"PREVIEW ({PREVIEW_WINDOWS} x {PREVIEW_WINDOW_DURATION} s per session)"
+    inputs = {"summary_path": [DATADIR_PREVIEW, "summary_all_subjects"],
+              "contrasts_path": [DATADIR_PREVIEW, "contrasts_all_metrics"],
+              "bootstrap_path": [DATADIR_PREVIEW, "contrasts_all_metrics_bootstrap"]}
+    plotting_steps.compute_contrasts(None, inputs, {"save_path": [DATADIR_PREVIEW, "contrasts_all_metrics"],
+                                                    "bootstrap_path": [DATADIR_PREVIEW,
+                                                                       "contrasts_all_metrics_bootstrap"]},
+                                     True)
+    plotting_steps.plot_figure_2(None, inputs, {"save_path": [DATADIR_PREVIEW, "Figure2.png"]}, True,
+                                 watermark=watermark)
+    plotting_steps.plot_figure_3(None, inputs, {"save_path": [DATADIR_PREVIEW, "Figure3.png"]}, True,
+                                 watermark=watermark)
+
+    full_path = DATADIR_PROCESSED.joinpath("summary_all_subjects")
+    full = pd.read_csv(full_path, sep="\t") if full_path.exists() else None
+    if full is None or full.drop(columns=["subj", "sess", "cond"]).isna().all(axis=None):
+        print(f"Didn't find the summary of a full run at {full_path} to estimate the error of the preview against.")
+        return
+    errors = preview_errors(summary, full)
+    errors_path = DATADIR_PREVIEW.joinpath("preview_errors")
+    errors.to_csv(errors_path, sep="\t", index=False)
+    with pd.option_context("display.width", 200, "display.float_format", "{:.3g}".format):
+        print(f"\nError of the preview against {full_path}:")
+        print(errors.to_string(index=False))
+    print(f"Saved {errors_path}")
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Live progress of a run. Every unit of work, i.e., a (task, subject) pair of a
+sequential run or a (task, subject, session) triplet of the work queue, is
+recorded in an SQLite database in the "processed" directory (see
+PROGRESS_FILENAME) when the run is set up, and marked as "running", "done",
+"failed", or "skipped" by whichever process runs it. Since all processes
+(including workers on other hosts) write to the same database, the counters
+are the same for sequential and distributed runs. Units that the planner
+marks as "skip" (their outputs exist) or "missing" (an input doesn't exist)
+are counted as skipped once they have been run.
+
+From the database, the number of units per stage and status, the throughput
+over the last THROUGHPUT_WINDOW seconds, the queue depth (units that are
+pending or running), and the ETA are computed and written to
+
+    processed/progress.prom    Prometheus textfile format, e.g., for the
+                               textfile collector of the node exporter
+    processed/progress.json    status file, e.g., for dashboards or scripts
+
+Both files are replaced atomically, so readers never see a partial file. A
+compact summary is printed after each unit of a sequential run and at each
+poll of the work queue's coordinator. A stage is flagged as stalled if it has
+running units but none of its units started or finished within the last STALL_DURATION
+seconds.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import numpy as np
+import pandas as pd
+from contextlib import closing
+from biofeedback_analyses import planner
+from biofeedback_analyses.config import THROUGHPUT_WINDOW, STALL_DURATION
+
+
+PROGRESS_FILENAME = "progress.sqlite"
+METRICS_FILENAME = "progress.prom"
+STATUS_FILENAME = "progress.json"
+STATUSES = ["pending", "running", "done", "failed", "skipped"]
+
+
+def connect(progress_path):
+
+    con = sqlite3.connect(str(progress_path), timeout=60)
+    con.execute("CREATE TABLE IF NOT EXISTS units (stage INTEGER, task TEXT,"
+                " subject TEXT, session TEXT, planned TEXT,"
+                " status TEXT DEFAULT 'pending', worker TEXT, started REAL,"
+                " finished REAL, seconds REAL)")
+
+    return con
+
+
+def init_progress(progress_path, tasks, by_session=False, append=False):
+    """Record the units of tasks as pending, together with their status in
+    the plan (see planner.plan()).
+
+    Parameters
+    ----------
+    progress_path : Path
+        Progress database.
+    tasks : list of dict
+        Tasks as returned by the pipelines, in the order in which they run.
+    by_session : bool, optional
+        Split tasks with "sessions" into one unit per session, as the work
+        queue does. Otherwise, there is one unit per task and subject, as in
+        run_analysis.run(), which is planned to be skipped if all of its
+        sessions are.
+    append : bool, optional
+        Add the units to those already recorded (e.g., the plotting after the
+        units of the work queue), with stages following theirs. Otherwise,
+        the units already recorded are deleted.
+    """
+    units = planner.plan(tasks)
+    if not by_session:
+        units = (units.groupby(["stage", "task", "subject"], sort=False, dropna=False)["status"]
+                 .agg(lambda status: "skip" if status.isin(["skip", "missing"]).all() else "run")
+                 .reset_index())
+        units["session"] = None
+
+    with closing(connect(progress_path)) as con, con:
+        if append:
+            units["stage"] += con.execute("SELECT COALESCE(MAX(stage) + 1, 0) FROM units").fetchone()[0]
+        else:
+            con.execute("DELETE FROM units")    # a new run starts from scratch
+        con.executemany("INSERT INTO units (stage, task, subject, session, planned)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        [(int(unit.stage), unit.task, None if pd.isna(unit.subject) else unit.subject,
+                          None if pd.isna(unit.session) else unit.session,
+                          "skip" if unit.status in ["skip", "missing"] else unit.status)
+                         for unit in units.itertuples()])
+
+
+def start_unit(progress_path, task, subject, session=None, worker=None):
+    """Mark a unit as running."""
+    if worker is None:
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    with closing(connect(progress_path)) as con, con:
+        con.execute("UPDATE units SET status = 'running', worker = ?, started = ?"
+                    " WHERE task = ? AND subject IS ? AND session IS ?",
+                    (worker, time.time(), task, subject, session))
+
+
+def finish_unit(progress_path, task, subject, session=None, succeeded=True,
+                requeued=False):
+    """Mark a unit as done (or skipped if the planner marked it as such), or
+    as failed. Failed units that have been requeued (see
+    work_queue.finish_unit()) are pending again."""
+    now = time.time()
+    status = "pending" if requeued else "failed"
+
+    with closing(connect(progress_path)) as con, con:
+        con.execute("UPDATE units SET status = CASE WHEN NOT ? THEN ?"
+                    " WHEN planned = 'skip' THEN 'skipped' ELSE 'done' END,"
+                    " finished = ?, seconds = ? - started"
+                    " WHERE task = ? AND subject IS ? AND session IS ?",
+                    (succeeded, status, now, now, task, subject, session))
+
+
+def load_units(progress_path):
+
+    with closing(connect(progress_path)) as con:
+        units = pd.read_sql_query("SELECT * FROM units", con)
+
+    return units
+
+
+def progress_status(units, window=THROUGHPUT_WINDOW, stall_duration=STALL_DURATION,
+                    now=None):
+    """Summarize the progress of a run.
+
+    Parameters
+    ----------
+    units : DataFrame
+        Units as recorded in the progress database (see load_units()).
+    window : float, optional
+        Throughput is the number of units that finished within the last
+        window seconds (or since the first unit started, if that is more
+        recent), per minute.
+    stall_duration : float, optional
+        A stage with running units is stalled if none of its units finished
+        (or started) within the last stall_duration seconds.
+    now : float, optional
+        Time of the status (time.time() by default).
+
+    Returns
+    -------
+    status : dict
+        The number of units per status (including "total" and "queue_depth",
+        i.e., pending or running units), "throughput" (units per minute),
+        "eta_seconds" (None if there is no throughput yet), and the same
+        counts for each of the "stages" (as a list, together with their
+        "stage" index, "task", and whether they are "stalled").
+    """
+    if now is None:
+        now = time.time()
+
+    def counts(units):
+        n = units["status"].value_counts()
+        counts = {status: int(n.get(status, 0)) for status in STATUSES}
+        counts["total"] = len(units)
+        counts["queue_depth"] = counts["pending"] + counts["running"]
+        return counts
+
+    finished = units["finished"].dropna()
+    started = units["started"].dropna()
+    elapsed = min(window, now - started.min()) if started.size else 0
+    recent = int((finished >= now - window).sum())
+    throughput = 60 * recent / elapsed if recent and elapsed > 0 else 0.
+
+    status = {"updated": now, **counts(units), "throughput": throughput,
+              "eta_seconds": None, "stages": []}
+    if throughput > 0:
+        status["eta_seconds"] = 60 * status["queue_depth"] / throughput
+
+    for (stage, task), stage_units in units.groupby(["stage", "task"], sort=True):
+        stage_status = {"stage": int(stage), "task": task, **counts(stage_units)}
+        last_change = np.nanmax(stage_units[["started", "finished"]].to_numpy(dtype=float), initial=-np.inf)
+        stage_status["stalled"] = bool(stage_status["running"] and now - last_change > stall_duration)
+        status["stages"].append(stage_status)
+
+    return status
+
+
+def prometheus_metrics(status):
+    """Format a status (see progress_status()) in the Prometheus textfile
+    format."""
+    lines = ["# HELP biofeedback_units Units of work per stage and status.",
+             "# TYPE biofeedback_units gauge"]
+    for stage in status["stages"]:
+        for name in STATUSES:
+            lines.append(f'biofeedback_units{{stage="{stage["stage"]}",task="{stage["task"]}",status="{name}"}}'
+                         f' {stage[name]}')
+    lines += ["# HELP biofeedback_queue_depth Units of work that are pending or running.",
+              "# TYPE biofeedback_queue_depth gauge"]
+    for stage in status["stages"]:
+        lines.append(f'biofeedback_queue_depth{{stage="{stage["stage"]}",task="{stage["task"]}"}}'
+                     f' {stage["queue_depth"]}')
+    lines += ["# HELP biofeedback_stage_stalled Whether a stage has running units but made no progress recently.",
+              "# TYPE biofeedback_stage_stalled gauge"]
+    for stage in status["stages"]:
+        lines.append(f'biofeedback_stage_stalled{{stage="{stage["stage"]}",task="{stage["task"]}"}}'
+                     f' {int(stage["stalled"])}')
+    lines += ["# HELP biofeedback_throughput_units_per_minute Units of work finished per minute, recently.",
+              "# TYPE biofeedback_throughput_units_per_minute gauge",
+              f"biofeedback_throughput_units_per_minute {status['throughput']:.6g}",
+              "# HELP biofeedback_eta_seconds Estimated time until all units of work are finished.",
+              "# TYPE biofeedback_eta_seconds gauge",
+              f"biofeedback_eta_seconds {'NaN' if status['eta_seconds'] is None else format(status['eta_seconds'], '.6g')}",
+              "# HELP biofeedback_progress_updated_seconds Time of the last update of these metrics.",
+              "# TYPE biofeedback_progress_updated_seconds gauge",
+              f"biofeedback_progress_updated_seconds {status['updated']:.3f}"]
+
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(path, text):
+    """Write text to a temporary file next to path and move it to path, such
+    that readers see either the previous or the new file."""
+    tmp_path = path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def format_duration(seconds):
+
+    if seconds is None:
+        return "--"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def format_progress(status):
+    """One line summary of a status (see progress_status())."""
+    finished = status["done"] + status["failed"] + status["skipped"]
+    line = (f"Progress: {finished}/{status['total']} unit(s) ({status['done']} done, {status['failed']} failed,"
+            f" {status['skipped']} skipped), {status['queue_depth']} queued,"
+            f" {status['throughput']:.1f}/min, ETA {format_duration(status['eta_seconds'])}")
+    active = [stage for stage in status["stages"] if stage["queue_depth"] and stage["queue_depth"] < stage["total"]
+              or stage["running"]]
+    if active:
+        line += " | " + ", ".join(f"{stage['task']} {stage['total'] - stage['queue_depth']}/{stage['total']}"
+                                  + (" STALLED" if stage["stalled"] else "") for stage in active)
+
+    return line
+
+
+def report(progress_path, display=True):
+    """Write the metrics and status files next to the progress database and
+    print the progress."""
+    status = progress_status(load_units(progress_path))
+    write_atomic(progress_path.with_name(METRICS_FILENAME), prometheus_metrics(status))
+    write_atomic(progress_path.with_name(STATUS_FILENAME), json.dumps(status, indent=2) + "\n")
+    if display:
+        print(format_progress(status))
+
+    return status
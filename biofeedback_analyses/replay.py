@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Closed-loop replay of a biofeedback session. The raw respiration is streamed
+chunk by chunk through the filter, envelope, and score computation of
+biofeedback_utils.stream_biofeedback_scores(), optionally paced at a multiple
+of real time. The emitted scores are compared with the recorded Feedback
+events, and the latency of every update as well as the maximum throughput
+are reported.
+
+The envelope, i.e., the maximum of the absolute filtered respiration over the
+trailing REPLAY_WINDOW, is an approximation of the scoring of the game, whose
+exact computation isn't part of the recordings. Unless a target is given, the
+target of the score is estimated from the earliest REPLAY_FIT_FRACTION of the
+Feedback events, and the agreement is reported on the remaining (held-out)
+events, such that it reflects how well the approximation predicts the game's
+scores rather than how well it fits them. Run with
+
+    python -m biofeedback_analyses.replay raw/subj-01/subj-01_sess-02_cond-B_recordsignal.edf raw/subj-01/subj-01_sess-02_cond-B_recordtrigger.tsv
+"""
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from biofeedback_analyses.analysis_utils import event_utils, biofeedback_utils, io_utils
+from biofeedback_analyses.config import REPLAY_WINDOW, REPLAY_CHUNK, REPLAY_FIT_FRACTION
+
+
+def load_session(physio_path, event_path):
+    """Return the raw respiration, its sampling frequency, and the samples and
+    values of the recorded Feedback events."""
+    header = io_utils.read_edf_header(physio_path)
+    resp = io_utils.read_edf_channel(physio_path, channel=0, header=header)
+    sfreq = header["sfreq"][0]
+
+    events = event_utils.format_events(pd.read_csv(event_path, sep="\t"))
+    feedback_samples = event_utils.get_eventtimes(events, "Feedback", as_sample=True)
+    feedback_values = event_utils.get_eventvalues(events, "Feedback").astype(float)
+    in_recording = (feedback_samples >= 0) & (feedback_samples < resp.size)
+    if not in_recording.any():
+        print(f"Didn't find Feedback events during the recording for {event_path}.")
+
+    return resp, sfreq, feedback_samples[in_recording], feedback_values[in_recording]
+
+
+def replay(resp, sfreq, target, chunk_size=REPLAY_CHUNK, speedup=None,
+           window=REPLAY_WINDOW):
+    """Stream a recording through the biofeedback computation.
+
+    Parameters
+    ----------
+    resp : ndarray
+        Raw respiration.
+    sfreq : float
+        Sampling frequency of the respiration.
+    target : float
+        See biofeedback_utils.compute_biofeedback_score().
+    chunk_size : int, optional
+        Number of samples per update.
+    speedup : float, optional
+        Chunks are released to the computation at the time at which their
+        last sample would have been recorded, at `speedup` times real time.
+        If None, chunks are released as fast as they can be processed.
+    window : float, optional
+        See biofeedback_utils.stream_biofeedback_scores().
+
+    Returns
+    -------
+    scores : ndarray
+        Score of every sample.
+    latencies : ndarray
+        Seconds between the release of each chunk and the emission of its
+        scores. Includes the time that a chunk waits for preceding chunks if
+        the computation falls behind.
+    """
+    stream = biofeedback_utils.stream_biofeedback_scores(sfreq, target, window)
+    next(stream)
+
+    n_chunks = int(np.ceil(resp.size / chunk_size))
+    scores = np.empty(resp.size)
+    latencies = np.empty(n_chunks)
+
+    t_start = time.perf_counter()
+    for i in range(n_chunks):
+        beg = i * chunk_size
+        end = min(beg + chunk_size, resp.size)
+
+        t_release = time.perf_counter()
+        if speedup is not None:
+            t_release = t_start + end / sfreq / speedup
+            t_wait = t_release - time.perf_counter()
+            if t_wait > 0:
+                time.sleep(t_wait)
+
+        scores[beg:end] = stream.send(resp[beg:end])
+        latencies[i] = time.perf_counter() - t_release
+
+    return scores, latencies
+
+
+def compare_with_feedback(scores, feedback_samples, feedback_values):
+    """Return agreement statistics of the emitted and the recorded scores at
+    the samples of the Feedback events."""
+    emitted = scores[feedback_samples]
+    deviation = np.abs(emitted - feedback_values)
+
+    agreement = {"n_events": feedback_values.size,
+                 "mean_abs_deviation": np.mean(deviation),
+                 "max_abs_deviation": np.max(deviation),
+                 "correlation": np.corrcoef(emitted, feedback_values)[0, 1] if emitted.size > 1 else np.nan}
+
+    return agreement
+
+
+def replay_session(physio_path, event_path, chunk_size=REPLAY_CHUNK,
+                   speedup=None, target=None, window=REPLAY_WINDOW,
+                   fit_fraction=REPLAY_FIT_FRACTION):
+    """Replay a session and print the agreement with the recorded Feedback
+    events, the latency percentiles, and the maximum throughput. If target is
+    None, it is estimated from the earliest fit_fraction of the Feedback
+    events and the agreement is computed on the remaining events only. With
+    a single Feedback event, the target is estimated from that event and the
+    agreement isn't held out."""
+    resp, sfreq, feedback_samples, feedback_values = load_session(physio_path, event_path)
+    if feedback_samples.size == 0:
+        return
+
+    envelope = biofeedback_utils.biofeedback_envelope(resp, sfreq, window)
+    held_out = target is None and feedback_samples.size > 1
+    if target is None:
+        n_fit = feedback_samples.size    # too few events to hold any out
+        if held_out:
+            n_fit = int(np.clip(np.rint(fit_fraction * feedback_samples.size), 1, feedback_samples.size - 1))
+        target = biofeedback_utils.estimate_biofeedback_target(envelope[feedback_samples[:n_fit]],
+                                                               feedback_values[:n_fit])
+        print(f"Estimated target {target:.4g} from the first {n_fit} of {feedback_values.size} Feedback events.")
+        if held_out:
+            feedback_samples, feedback_values = feedback_samples[n_fit:], feedback_values[n_fit:]
+        else:
+            print("Too few Feedback events to hold any out, the agreement is computed on the fitted event.")
+
+    # Maximum throughput: chunks are released as fast as they are processed.
+    scores, latencies = replay(resp, sfreq, target, chunk_size, None, window)
+    throughput = resp.size / latencies.sum()
+    offline = biofeedback_utils.compute_biofeedback_score(envelope, target)
+    assert np.allclose(scores, offline), "Streamed scores differ from the offline computation."
+
+    if speedup is not None:
+        scores, latencies = replay(resp, sfreq, target, chunk_size, speedup, window)
+    budget = chunk_size / sfreq / (speedup or 1)    # time until the next chunk arrives
+
+    agreement = compare_with_feedback(scores, feedback_samples, feedback_values)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"Agreement with {agreement['n_events']} {'held-out ' if held_out else ''}Feedback events:"
+          f" mean absolute deviation"
+          f" {agreement['mean_abs_deviation']:.3f}, maximum absolute deviation"
+          f" {agreement['max_abs_deviation']:.3f}, correlation {agreement['correlation']:.3f}.")
+    print(f"Latency per update of {chunk_size} sample(s) at {speedup or 'maximum'} x real time:"
+          f" median {p50 * 1e6:.1f} us, 95th percentile {p95 * 1e6:.1f} us, 99th percentile"
+          f" {p99 * 1e6:.1f} us, maximum {latencies.max() * 1e6:.1f} us (budget {budget * 1e6:.0f} us).")
+    print(f"Maximum throughput: {throughput:.0f} samples/s, i.e., {throughput / sfreq:.0f} x real time.")
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Replay the biofeedback computation on a recorded session.")
+    parser.add_argument("physio_path", help="EDF file of the session.")
+    parser.add_argument("event_path", help="Trigger file of the session, containing the Feedback events.")
+    parser.add_argument("--chunk", type=int, default=REPLAY_CHUNK, metavar="SAMPLES",
+                        help="Number of samples per update.")
+    parser.add_argument("--speedup", type=float, default=None, metavar="FACTOR",
+                        help="Pace the replay at FACTOR times real time. Unpaced by default.")
+    parser.add_argument("--target", type=float, default=None,
+                        help="Target of the biofeedback score. Estimated from the earliest Feedback events by"
+                             " default, in which case the agreement is reported on the remaining events.")
+    parser.add_argument("--window", type=float, default=REPLAY_WINDOW, metavar="SECONDS",
+                        help="Duration of the envelope window.")
+    args = parser.parse_args()
+
+    replay_session(args.physio_path, args.event_path, args.chunk, args.speedup,
+                   args.target, args.window)
+
+
+if __name__ == "__main__":
+    main()
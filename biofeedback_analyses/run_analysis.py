@@ -4,10 +4,12 @@
 author: Jan C. Brammer <jan.c.brammer@gmail.com>
 """
 
+import argparse
 import pandas as pd
 from itertools import product
 from pathlib import Path
-from biofeedback_analyses.config import SUBJECTS, SESSIONS
+from biofeedback_analyses import work_queue, planner, preview, progress
+from biofeedback_analyses.config import SUBJECTS, SESSIONS, TIMINGS_FILENAME
 from biofeedback_analyses.preprocessing.pipeline import pipeline as preprocessing_pipeline
 from biofeedback_analyses.summary_stats.pipeline import pipeline as summary_stats_pipeline
 from biofeedback_analyses.plotting.pipeline import pipeline as plotting_pipeline
@@ -61,27 +63,119 @@ def setup_summary(DATADIR_PROCESSED):
     print(f"Instantiated summary file at {save_path}.")
 
 
-def run(pipeline):
+def run(pipeline, timings_path=None, progress_path=None):
+    """Run the tasks of a pipeline for all of their subjects. Record the
+    runtime and memory of each call at timings_path (see planner) unless
+    timings_path is None, and the progress of the run at progress_path (see
+    progress.init_progress()) unless progress_path is None."""
 
     for task in pipeline:
 
         for subject in task["subjects"]:
 
-            task["func"](subject,
-                         task["inputs"],
-                         task["outputs"],
-                         task["recompute"])
+            if progress_path is not None:
+                progress.start_unit(progress_path, task["func"].__name__, subject)
+            try:
+                if timings_path is not None:
+                    planner.timed_call(task, subject, task["inputs"], task["outputs"],
+                                       timings_path)
+                else:
+                    task["func"](subject,
+                                 task["inputs"],
+                                 task["outputs"],
+                                 task["recompute"])
+            except Exception:
+                if progress_path is not None:
+                    progress.finish_unit(progress_path, task["func"].__name__, subject, succeeded=False)
+                    progress.report(progress_path)
+                raise
+            if progress_path is not None:
+                progress.finish_unit(progress_path, task["func"].__name__, subject)
+                progress.report(progress_path)
+
+
+def dry_run(n_workers=1):
+    """Print the units that a run in the current working directory would
+    consist of, without running (or creating) anything."""
+
+    WORKDIR = Path.cwd()
+    DATADIR_RAW = WORKDIR.joinpath("raw")
+    DATADIR_PROCESSED = WORKDIR.joinpath("processed")
+
+    tasks = (preprocessing_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED) +
+             summary_stats_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED) +
+             plotting_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED))
+    units = planner.plan(tasks)
+    units = planner.estimate(units, planner.load_timings(WORKDIR.joinpath(TIMINGS_FILENAME)))
+    planner.print_plan(units, n_workers)
+
+
+def get_directories():
+    """Return the existing data directories, e.g., for joining a run that has
+    been set up by another process."""
+
+    WORKDIR = Path.cwd()
+
+    DATADIR_RAW = WORKDIR.joinpath("raw")
+    DATADIR_PROCESSED = WORKDIR.joinpath("processed")
+    for datadir in [DATADIR_RAW, DATADIR_PROCESSED]:
+        if not datadir.is_dir():
+            raise FileNotFoundError(f"Couldn't find \"{datadir.name}\" data directory.")
+
+    return DATADIR_RAW, DATADIR_PROCESSED
 
 
 def main():
     """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Reproduce Figures 2 and 3 of doi.org/10.3389/fpsyg.2021.586553.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--workers", type=int, metavar="N",
+                      help="Distribute preprocessing and summary statistics over a work queue in the"
+                           " \"processed\" directory and start N local workers. Workers on other hosts"
+                           " can join with --worker.")
+    mode.add_argument("--worker", action="store_true",
+                      help="Join the work queue of a distributed run as worker.")
+    mode.add_argument("--preview", action="store_true",
+                      help="Quickly render approximate figures from a few random windows of each session into"
+                           " the \"preview\" directory, and report the error of each metric against the last"
+                           " full run in \"processed\".")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="List the units of work that would run or be skipped, flag missing or ambiguous"
+                             " inputs, and estimate runtime and memory from past runs. Combine with --workers"
+                             " to estimate the wall time of a distributed run.")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        dry_run(args.workers or 1)
+        return
+
+    if args.preview:
+        preview.preview_cohort(Path.cwd().joinpath("raw"), Path.cwd().joinpath("processed"),
+                               Path.cwd().joinpath("preview"))
+        return
+
+    if args.worker:
+        DATADIR_RAW, DATADIR_PROCESSED = get_directories()
+        work_queue.work(DATADIR_RAW, DATADIR_PROCESSED)
+        return
+
     print("Setting up directories.")
     DATADIR_RAW, DATADIR_PROCESSED = setup_directories()
     setup_summary(DATADIR_PROCESSED)
     print("Running data processing pipeline.")
-    run(preprocessing_pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED))
-    run(summary_stats_pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED))
-    run(plotting_pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED))
+    timings_path = Path.cwd().joinpath(TIMINGS_FILENAME)
+    progress_path = DATADIR_PROCESSED.joinpath(progress.PROGRESS_FILENAME)
+    if args.workers is None:
+        progress.init_progress(progress_path,
+                               preprocessing_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED) +
+                               summary_stats_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED) +
+                               plotting_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED))
+        run(preprocessing_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED), timings_path, progress_path)
+        run(summary_stats_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED), timings_path, progress_path)
+    else:
+        work_queue.coordinate(DATADIR_RAW, DATADIR_PROCESSED, args.workers,
+                              plotting_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED))
+    run(plotting_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED), timings_path, progress_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+In-memory processing of sessions, e.g., for notebooks and services that
+analyze one session at a time:
+
+    from biofeedback_analyses.sessions import process_session
+    metrics = process_session("subj-01_sess-01_cond-A_recordsignal.edf", events)
+
+A session is a dict with the raw respiration, the formatted events, and the
+preprocessed signals, which is passed from preprocess_session() to
+summarize_session() without writing the processed files. The generators
+preprocess_sessions() and summarize_sessions() chain these stages over many
+sessions, and save_sessions() is an optional sink that writes the same
+processed files as the preprocessing pipeline:
+
+    items = iter_raw_sessions(DATADIR_RAW)
+    sessions = save_sessions(preprocess_sessions(items), DATADIR_PROCESSED)
+    df_summary = summary_table(summarize_sessions(sessions))
+
+The preprocessing steps use the same per-session computations. By default,
+the preprocessed signals are rounded to the precision of the processed files
+(decimals=4), such that they are identical to the processed files, and so
+are the metrics. Note that metrics in the summary file of a file-based run
+can differ in the last digit, since the summary is parsed and re-written by
+each summary step.
+"""
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from biofeedback_analyses.analysis_utils import (event_utils, resp_utils, hrv_utils,
+                                                 biofeedback_utils, io_utils, sidecar_utils)
+from biofeedback_analyses import config
+from biofeedback_analyses.config import SUBJECTS, SESSIONS, FFT_WORKERS
+
+
+def format_session_events(events, sfreq=None):
+    """Convert the events of a recordtrigger file to seconds, fit their
+    synchronization model, and format them. Formatted events (with a
+    "physiosample" column) are returned as they are. If the recording's
+    sampling frequency sfreq differs from config.SFREQ, the events are
+    converted to samples at config.SFREQ, to which the recording is
+    resampled."""
+    if "physiosample" in events.columns:
+        return events, event_utils.fit_sync_model(events)
+
+    if sfreq is not None and sfreq != config.SFREQ:
+        events = event_utils.rescale_sync_samples(events, config.SFREQ / sfreq)
+    events = event_utils.isotimes_to_relativetimes(events)
+    sync_model = event_utils.fit_sync_model(events)    # fit once, downstream computations use the model
+    events = event_utils.format_events(events, sync_model)
+
+    return events, sync_model
+
+
+def compute_ibis(events, sync_model):
+    """IBIs interpolated at every sample from the start of the recording until
+    the last IBI. None if there are no InterBeatInterval events."""
+
+    # Multiple IBIs can be associated with the same sample since Polar belt can include multiple IBIs in a single notification.
+    ibis = event_utils.get_eventvalues(events, "InterBeatInterval")
+    if ibis.size == 0:
+        return None
+
+    ibis_corrected = hrv_utils.correct_ibis(ibis)
+    # Associate IBIs with a sample that represents the time of their occurrence (relative to breathing belt recording) rather
+    # than the time of the Polar belt notification.
+    peaks_corrected = hrv_utils.ibis_to_rpeaks(ibis_corrected, events, sync_model)
+
+    # Interpolate such that IBIs are aligned with respiration signal. Starting
+    # at sample 0 (i.e., start of breathing belt recording) and ending at the sample that corresponds to the last recorded IBI.
+    ibis_interpolated = hrv_utils.interpolate_ibis(peaks_corrected,
+                                                   ibis_corrected,
+                                                   range(peaks_corrected[-1]))
+
+    return io_utils.as_signal(ibis_interpolated)
+
+
+def compute_resp(resp, sfreq):
+    """Filtered respiration and its instantaneous amplitude."""
+
+    resp_filt = io_utils.as_signal(biofeedback_utils.biofeedback_filter(resp, sfreq))
+    inst_amp = io_utils.as_signal(resp_utils.instantaneous_amplitude(resp_filt, workers=FFT_WORKERS))
+
+    return resp_filt, inst_amp
+
+
+def compute_original_resp_biofeedback(events):
+    """Biofeedback scores interpolated at every sample from the start of the
+    recording until the last score. None if there are no Feedback events."""
+
+    biofeedback_values = event_utils.get_eventvalues(events, "Feedback")
+    if biofeedback_values.size == 0:
+        return None
+    biofeedback_samples = event_utils.get_eventtimes(events, "Feedback", as_sample=True)
+    # Interpolate such that biofeedback scores are aligned with respiration signal.
+    # Starting at sample 0 and ending at the sample that corresponds to the last recorded biofeedback score.
+    original_biofeedback = biofeedback_utils.interpolate_biofeedback(biofeedback_samples,
+                                                                     biofeedback_values,
+                                                                     range(biofeedback_samples[-1]))
+
+    return io_utils.as_signal(original_biofeedback)
+
+
+def read_raw_session(physio, events, sfreq=None):
+    """Return the raw respiration and its (original) sampling frequency, as
+    well as the events, reading physio (EDF) and events (recordtrigger TSV) if
+    they are paths."""
+    if isinstance(physio, (str, Path)):
+        header = io_utils.read_edf_header(physio)
+        physio = io_utils.read_edf_channel(physio, channel=0, header=header,
+                                           dtype=config.SIGNAL_DTYPE)
+        sfreq = header["sfreq"][0]
+    if sfreq is None:
+        raise ValueError("The sampling frequency is required if the respiration is an array.")
+    if isinstance(events, (str, Path)):
+        events = pd.read_csv(events, sep="\t")
+
+    return io_utils.as_signal(physio), sfreq, events
+
+
+def preprocess_session(physio, events, sfreq=None, decimals=4, subject=None,
+                       session=None):
+    """Preprocess a session in memory.
+
+    Parameters
+    ----------
+    physio : str, Path, or array
+        EDF file of the session, or its raw respiration.
+    events : str, Path, or DataFrame
+        Events of the session, as in the recordtrigger file.
+    sfreq : float, optional
+        Sampling frequency of the respiration. Required if physio is an
+        array. The respiration is resampled to config.SFREQ.
+    decimals : int, optional
+        The preprocessed signals are rounded to decimals, as in the processed
+        files. Not rounded if None.
+    subject, session : str, optional
+        E.g., "subj-01" and "sess-01_cond-A".
+
+    Returns
+    -------
+    session : dict
+        With the "subject", "session", "sfreq" (config.SFREQ), the raw "resp"
+        (resampled to config.SFREQ), the formatted
+        "events", the "sync_model", the "game" window ((beg, end) in samples,
+        None if it can't be determined), and the preprocessed "resp_filt",
+        "inst_amp", "ibis", and "original_resp_biofeedback" (None if the
+        events don't contain IBIs or Feedback).
+    """
+    resp, sfreq, events = read_raw_session(physio, events, sfreq)
+    events, sync_model = format_session_events(events, sfreq)
+    resp = io_utils.as_signal(io_utils.resample(resp, sfreq, config.SFREQ))    # all processing is at the analysis rate
+    sfreq = config.SFREQ
+    resp_filt, inst_amp = compute_resp(resp, sfreq)
+
+    signals = {"resp_filt": resp_filt, "inst_amp": inst_amp,
+               "ibis": compute_ibis(events, sync_model),
+               "original_resp_biofeedback": compute_original_resp_biofeedback(events)}
+    if decimals is not None:
+        signals = {key: None if signal is None else np.round(signal, decimals)    # as written with float_format="%.4f"
+                   for key, signal in signals.items()}
+
+    preprocessed = {"subject": subject, "session": session, "sfreq": sfreq,
+                    "resp": resp, "events": events, "sync_model": sync_model,
+                    "game": event_utils.get_game_window(events)}
+    preprocessed.update(signals)
+
+    return preprocessed
+
+
+def summarize_session(session):
+    """Return the summary statistics of a preprocessed session during the
+    game, as in the summary pipeline. Empty if the game window can't be
+    determined."""
+
+    metrics = {}
+    if session["game"] is None:
+        print(f"Didn't find the game window of {session['subject']} {session['session']}.")
+        return metrics
+    beg, end = session["game"]
+
+    metrics.update(resp_utils.compute_resp_stats(session["resp"][beg:end], session["sfreq"]))
+    if session["ibis"] is not None:
+        metrics.update(hrv_utils.compute_hrv_stats(session["ibis"][beg:end], session["sfreq"]))
+    if session["original_resp_biofeedback"] is not None:
+        metrics.update(biofeedback_utils.compute_original_resp_biofeedback_stats(session["original_resp_biofeedback"][beg:end]))
+
+    return metrics
+
+
+def process_session(physio, events, sfreq=None, decimals=4):
+    """Preprocess and summarize a session in memory, see preprocess_session()
+    and summarize_session(). Returns the metrics as a dict."""
+
+    return summarize_session(preprocess_session(physio, events, sfreq, decimals))
+
+
+def iter_raw_sessions(DATADIR_RAW, subjects=SUBJECTS, sessions=SESSIONS):
+    """Yield (subject, session, physio_path, event_path) of the sessions in
+    DATADIR_RAW that have exactly one recordsignal and recordtrigger file."""
+
+    for subject in subjects:
+        for session in sessions:
+            physio_paths = list(DATADIR_RAW.joinpath(subject).glob(f"*{session}*recordsignal*"))
+            event_paths = list(DATADIR_RAW.joinpath(subject).glob(f"*{session}*recordtrigger*"))
+            if len(physio_paths) != 1 or len(event_paths) != 1:
+                continue
+            yield subject, session, physio_paths[0], event_paths[0]
+
+
+def preprocess_sessions(items, decimals=4):
+    """Yield preprocessed sessions from (subject, session, physio, events)
+    items (see iter_raw_sessions()). The raw data of the next sessions is read
+    in the background (see io_utils.prefetch())."""
+
+    def load(item):
+        return read_raw_session(*item[2:])
+
+    for (subject, session, _, _), (resp, sfreq, events) in io_utils.prefetch(items, load):
+        yield preprocess_session(resp, events, sfreq, decimals, subject, session)
+
+
+def summarize_sessions(sessions):
+    """Yield (session, metrics) of preprocessed sessions."""
+
+    for session in sessions:
+        yield session, summarize_session(session)
+
+
+def save_sessions(sessions, DATADIR_PROCESSED):
+    """Write the processed files (and their sidecars) of each session, as the
+    preprocessing pipeline does, and pass the sessions on."""
+
+    for session in sessions:
+
+        prefix = f"{session['subject']}_{session['session']}_"
+        directory = DATADIR_PROCESSED.joinpath(session["subject"])
+        directory.mkdir(parents=True, exist_ok=True)
+        game = session["game"]
+
+        event_path = directory.joinpath(f"{prefix}events")
+        session["events"].to_csv(event_path, sep="\t", index=False)
+        event_utils.save_sync_model(session["sync_model"], event_path.with_name(f"{event_path.name}_sync.json"))
+        sidecar_utils.write_sidecar(event_path, session["events"], game=game, columns=[])
+
+        files = {"resp": pd.DataFrame({"resp_filt": session["resp_filt"], "inst_amp": session["inst_amp"]}),
+                 "ibis": None if session["ibis"] is None else pd.Series(session["ibis"]).to_frame(),
+                 "resp_biofeedback": (None if session["original_resp_biofeedback"] is None else
+                                      pd.DataFrame({"original_resp_biofeedback": session["original_resp_biofeedback"]}))}
+        for suffix, data in files.items():
+            if data is None:
+                continue
+            save_path = directory.joinpath(f"{prefix}{suffix}")
+            data.to_csv(save_path, sep="\t", header=True, index=False, float_format="%.4f")
+            sidecar_utils.write_sidecar(save_path, data, game=game)
+            print(f"Saved {save_path}")
+
+        yield session
+
+
+def summary_table(results):
+    """Collect (session, metrics) into a DataFrame with one row per session,
+    keyed by "subj", "sess", and "cond" as the summary file."""
+
+    rows = [{"subj": session["subject"], "sess": session["session"][:7],
+             "cond": session["session"][-6:], **metrics} for session, metrics in results]
+
+    return pd.DataFrame(rows)
@@ -12,12 +12,13 @@ from biofeedback_analyses.summary_stats.steps import (summary_resp,
                                                       summary_coherence)
 
 
-def pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED):
+def pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED):
 
     return [
 
         {"func": summary_resp,
          "subjects": SUBJECTS,
+         "sessions": SESSIONS,
          "inputs": {"event_path": [DATADIR_PROCESSED, "*events"],
                     "physio_path": [DATADIR_RAW, "*recordsignal*"]},
          "outputs": {"save_path": [DATADIR_PROCESSED, "summary_all_subjects"]},
@@ -32,6 +33,7 @@ def pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED):
 
         {"func": summary_heart,
          "subjects": SUBJECTS,
+         "sessions": SESSIONS,
          "inputs": {"event_path": [DATADIR_PROCESSED, "*events"],
                     "physio_path": [DATADIR_PROCESSED, "*ibis"]},
          "outputs": {"save_path": [DATADIR_PROCESSED, "summary_all_subjects"]},
@@ -39,6 +41,7 @@ def pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED):
 
         # {"func": summary_coherence,
         #  "subjects": SUBJECTS,
+        #  "sessions": SESSIONS,
         #  "inputs": {"resp_path": [DATADIR_RAW, "*recordsignal*"],
         #             "ibis_path": [DATADIR_PROCESSED, "*ibis"],
         #             "event_path": [DATADIR_PROCESSED, "*events"]},
@@ -47,6 +50,7 @@ def pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED):
 
         # {"func": summary_hrv_biofeedback,
         #  "subjects": SUBJECTS,
+        #  "sessions": SESSIONS,
         #  "inputs": {"event_path": [DATADIR_PROCESSED, "*events"],
         #             "physio_path": [DATADIR_PROCESSED, "*hrv_biofeedback"]},
         #  "outputs": {"save_path": [DATADIR_PROCESSED, "summary_all_subjects"]},
@@ -54,6 +58,7 @@ def pipeline(SUBJECTS, DATADIR_RAW, DATADIR_PROCESSED):
 
         {"func": summary_resp_biofeedback,
          "subjects": SUBJECTS,
+         "sessions": SESSIONS,
          "inputs": {"event_path": [DATADIR_PROCESSED, "*events"],
                     "physio_path": [DATADIR_PROCESSED, "*resp_biofeedback"]},
          "outputs": {"save_path": [DATADIR_PROCESSED, "summary_all_subjects"]},
@@ -6,8 +6,9 @@ author: Jan C. Brammer <jan.c.brammer@gmail.com>
 
 import numpy as np
 import pandas as pd
-from mne.io import read_raw_edf
-from biofeedback_analyses.analysis_utils import resp_utils, hrv_utils, event_utils, biofeedback_utils
+from functools import partial
+from biofeedback_analyses.analysis_utils import resp_utils, hrv_utils, event_utils, biofeedback_utils, io_utils, ragged_utils, qc_utils
+from biofeedback_analyses import config
 from biofeedback_analyses.config import SFREQ
 
 
@@ -46,6 +47,137 @@ def get_game_beg_end(path, df):
     return beg, end
 
 
+def find_matching_path(path, paths):
+    """Return the path among paths that belongs to the same session as path, or
+    None if there isn't exactly one."""
+
+    path_idx = [i for i, j in enumerate(paths) if str(j.name)[:21] == str(path.name)[:21]]
+    if len(path_idx) != 1:
+        return None
+
+    return paths[path_idx[0]]
+
+
+def get_uncomputed_paths(paths, df, columns, recompute):
+    """Return the paths whose row in the summary needs to be (re-) computed."""
+
+    uncomputed_paths = []
+
+    for path in paths:
+
+        row_idx = get_row_idx(path, df)
+        computed = df.loc[row_idx, columns].isna().values.sum() != len(columns)   # skip if all columns contain NaN (make sure to reserve NaN as place-holder for non-computed results)
+        if computed and not recompute:
+            print(f"Not re-computing {path}.")
+            continue
+
+        uncomputed_paths.append(path)
+
+    return uncomputed_paths
+
+
+def screen_paths(paths, directory, signal):
+    """Drop the paths of sessions that are skipped due to the quality
+    screening of signal (see qc_utils.skip_session()), given the directory
+    of the sessions' QC files."""
+
+    return [path for path in paths
+            if not qc_utils.skip_session(qc_utils.qc_path(directory, path), signal)]
+
+
+def read_game_beg_end(path, event_paths):
+    """Read the events matching path and return the first and last sample of
+    the game. Return None if either can't be determined."""
+
+    event_path = find_matching_path(path, event_paths)
+    if event_path is None:
+        print(f"Didn't find matching events for {path.name}.")
+        return None
+    events = pd.read_csv(event_path, sep='\t')
+    try:
+        beg, end = get_game_beg_end(event_path, events)
+    except IOError:
+        return None
+
+    return beg, end
+
+
+def read_edf_game(path, event_paths):
+    """Read the respiration channel of the EDF at path during the game."""
+
+    game = read_game_beg_end(path, event_paths)
+    if game is None:
+        return None
+    beg, end = game
+
+    resp_game = io_utils.read_edf_resampled(path, channel=0, start=beg, stop=end,
+                                            dtype=config.SIGNAL_DTYPE)    # only read the game window, at SFREQ
+
+    return resp_game
+
+
+def read_tsv_game(path, event_paths, column=None):
+    """Read a column of the TSV at path during the game. Read the only column
+    if column is None."""
+
+    game = read_game_beg_end(path, event_paths)
+    if game is None:
+        return None
+    beg, end = game
+
+    data = pd.read_csv(path, sep="\t", dtype=config.SIGNAL_DTYPE)
+    signal = np.ravel(data if column is None else data[column])
+
+    return signal[beg:end]
+
+
+def read_coherence_game(resp_path, event_paths, ibis_paths):
+    """Read respiration and IBIs matching resp_path during the game."""
+
+    game = read_game_beg_end(resp_path, event_paths)
+    if game is None:
+        return None
+    beg, end = game
+
+    ibis_path = find_matching_path(resp_path, ibis_paths)
+    if ibis_path is None:
+        print(f"Didn't find matching events for {resp_path.name}.")
+        return None
+    ibis = np.ravel(pd.read_csv(ibis_path, sep='\t', dtype=config.SIGNAL_DTYPE))
+    ibis_game = ibis[beg:end]
+
+    resp_game = io_utils.read_edf_resampled(resp_path, channel=0, start=beg, stop=end,
+                                            dtype=config.SIGNAL_DTYPE)    # only read the game window, at SFREQ
+
+    return resp_game, ibis_game
+
+
+def collect_games(paths, load, df):
+    """Load the games of all paths (see io_utils.prefetch()) and return the
+    paths whose game could be loaded, their rows in the summary, and their
+    games."""
+
+    game_paths, row_idcs, games = [], [], []
+
+    for path, game in io_utils.prefetch(paths, load):
+
+        if game is None:
+            continue
+
+        game_paths.append(path)
+        row_idcs.append(get_row_idx(path, df))
+        games.append(game)
+
+    return game_paths, np.concatenate(row_idcs) if row_idcs else np.empty(0, dtype=int), games
+
+
+def update_summary(df, row_idcs, stats):
+    """Write whole columns of segmented stats (one value per row)."""
+
+    for key, values in stats.items():
+        df.loc[row_idcs, key] = values
+
+
 def summary_resp(subject, inputs, outputs, recompute):
 
     root = outputs["save_path"][0]
@@ -65,33 +197,19 @@ def summary_resp(subject, inputs, outputs, recompute):
         print(f"No files found for {subject}.")
         return
 
-    for i, physio_path in enumerate(physio_paths):
+    columns = ["median_resp_amp", "median_resp_rate", "mean_resp_rate"]
+    physio_paths = get_uncomputed_paths(physio_paths, df_summary, columns, recompute)
+    physio_paths = screen_paths(physio_paths, inputs["event_path"][0].joinpath(subject), "resp")
+    if not physio_paths:    # make sure to save updates only when values have been (re-) computed
+        return
+    load = partial(read_edf_game, event_paths=event_paths)
 
-        row_idx = get_row_idx(physio_path, df_summary)
-        columns = ["median_resp_amp", "median_resp_rate", "mean_resp_rate"]
-        computed = df_summary.loc[row_idx, columns].isna().values.sum() != len(columns)   # skip if all columns contain NaN (make sure to reserve NaN as place-holder for non-computed results)
-        if computed and not recompute:
-            print(f"Not re-computing {physio_path}.")
-            if i < len(physio_paths) - 1:    # make sure to save updates only when values have been (re-) computed
-                continue
-            else:
-                return
-
-        # Find corresponding event_path
-        event_path_idx = [i for i, j in enumerate(event_paths) if str(j.name)[:21] == str(physio_path.name)[:21]]
-        if len(event_path_idx) != 1:
-            print(f"Didn't find matching events for {physio_path.name}.")
-            continue
-        event_path = event_paths[event_path_idx[0]]
-        events = pd.read_csv(event_path, sep='\t')
-        try:
-            beg, end = get_game_beg_end(event_path, events)
-        except IOError:
+    for physio_path, resp_game in io_utils.prefetch(physio_paths, load):
+
+        if resp_game is None:
             continue
 
-        data_raw = read_raw_edf(physio_path, preload=True, verbose="error")
-        resp = np.ravel(data_raw.get_data(picks=[0]))
-        resp_game = resp[beg:end]
+        row_idx = get_row_idx(physio_path, df_summary)
         resp_stats = resp_utils.compute_resp_stats(resp_game, SFREQ)
 
         for key, value in resp_stats.items():
@@ -124,47 +242,28 @@ def summary_bursts(subject, inputs, outputs, recompute):
     burst_threshold_high = 1.5 * burst_threshold_low
     burst_min_duration = int(np.rint(10 * SFREQ))
 
-    for i, physio_path in enumerate(physio_paths):
-
-        row_idx = get_row_idx(physio_path, df_summary)
-        columns = ["normalized_median_resp_power", "n_bursts",
-                   "mean_duration_bursts", "std_duration_bursts", "percent_bursts"]
-        computed = df_summary.loc[row_idx, columns].isna().values.sum() != len(columns)   # skip if all columns contain NaN (make sure to reserve NaN as place-holder for non-computed results)
-        if computed and not recompute:
-            print(f"Not re-computing {physio_path}.")
-            if i < len(physio_paths) - 1:    # make sure to save updates only when values have been (re-) computed
-                continue
-            else:
-                return
-
-        # Find corresponding event_path
-        event_path_idx = [i for i, j in enumerate(event_paths) if str(j.name)[:21] == str(physio_path.name)[:21]]
-        if len(event_path_idx) != 1:
-            print(f"Didn't find matching events for {physio_path.name}.")
-            continue
-        event_path = event_paths[event_path_idx[0]]
-        events = pd.read_csv(event_path, sep='\t')
-        try:
-            beg, end = get_game_beg_end(event_path, events)
-        except IOError:
-            continue
-
-        data = pd.read_csv(physio_path, sep="\t")
-        inst_amp = np.ravel(data["inst_amp"])
-        inst_amp_game = inst_amp[beg:end]
-
-        bursts = resp_utils.bursts_dual_threshold(inst_amp_game, burst_threshold_low,
-                                                  burst_threshold_high,
-                                                  min_duration=burst_min_duration)
-
-        burst_stats = resp_utils.compute_burst_stats(bursts, SFREQ)
-        for key, value in burst_stats.items():
-            df_summary.loc[row_idx, key] = value
-
-        biofeedback_stats = resp_utils.compute_resp_power_stats(inst_amp_game,
-                                                                normalize_by=burst_threshold_low)
-        for key, value in biofeedback_stats.items():
-            df_summary.loc[row_idx, key] = value
+    columns = ["normalized_median_resp_power", "n_bursts",
+               "mean_duration_bursts", "std_duration_bursts", "percent_bursts"]
+    physio_paths = get_uncomputed_paths(physio_paths, df_summary, columns, recompute)
+    physio_paths = screen_paths(physio_paths, inputs["event_path"][0].joinpath(subject), "resp")
+    if not physio_paths:    # make sure to save updates only when values have been (re-) computed
+        return
+    load = partial(read_tsv_game, event_paths=event_paths, column="inst_amp")
+    game_paths, row_idcs, inst_amp_games = collect_games(physio_paths, load, df_summary)
+
+    bursts = [resp_utils.bursts_dual_threshold(inst_amp_game, burst_threshold_low,
+                                               burst_threshold_high,
+                                               min_duration=burst_min_duration)
+              for inst_amp_game in inst_amp_games]
+    bursts, offsets = ragged_utils.pack(bursts)
+    update_summary(df_summary, row_idcs,
+                   resp_utils.compute_burst_stats_segmented(bursts, offsets, SFREQ))
+
+    inst_amp, offsets = ragged_utils.pack(inst_amp_games)
+    update_summary(df_summary, row_idcs,
+                   resp_utils.compute_resp_power_stats_segmented(inst_amp, offsets,
+                                                                 normalize_by=burst_threshold_low))
+    for physio_path in game_paths:
         print(f"Updated {save_path} with {physio_path}.")
 
     df_summary.to_csv(save_path, sep="\t", index=False)
@@ -189,39 +288,24 @@ def summary_heart(subject, inputs, outputs, recompute):
         print(f"No files found for {subject}.")
         return
 
-    for i, physio_path in enumerate(physio_paths):
-
-        row_idx = get_row_idx(physio_path, df_summary)
-        columns = ["hrv_lf", "hrv_hf", "hrv_vlf", "hrv_lf_hf_ratio",
-                   "hrv_lf_nu", "hrv_hf_nu", "median_heart_period", "rmssd"]
-        computed = df_summary.loc[row_idx, columns].isna().values.sum() != len(columns)   # skip if all columns contain NaN (make sure to reserve NaN as place-holder for non-computed results)
-        if computed and not recompute:
-            print(f"Not re-computing {physio_path}.")
-            if i < len(physio_paths) - 1:    # make sure to save updates only when values have been (re-) computed
-                continue
-            else:
-                return
-
-        # Find corresponding event_path
-        event_path_idx = [i for i, j in enumerate(event_paths) if str(j.name)[:21] == str(physio_path.name)[:21]]
-        if len(event_path_idx) != 1:
-            print(f"Didn't find matching events for {physio_path.name}.")
-            continue
-        event_path = event_paths[event_path_idx[0]]
-        events = pd.read_csv(event_path, sep='\t')
-        try:
-            beg, end = get_game_beg_end(event_path, events)
-        except IOError:
-            continue
-
-        data = pd.read_csv(physio_path, sep="\t")
-        ibis = np.ravel(data)
-        ibis_game = ibis[beg:end]
-
-        hrv_stats = hrv_utils.compute_hrv_stats(ibis_game, SFREQ)
+    columns = ["hrv_lf", "hrv_hf", "hrv_vlf", "hrv_lf_hf_ratio",
+               "hrv_lf_nu", "hrv_hf_nu", "median_heart_period", "rmssd"]
+    physio_paths = get_uncomputed_paths(physio_paths, df_summary, columns, recompute)
+    physio_paths = screen_paths(physio_paths, inputs["event_path"][0].joinpath(subject), "ibis")
+    if not physio_paths:    # make sure to save updates only when values have been (re-) computed
+        return
+    load = partial(read_tsv_game, event_paths=event_paths)
+    game_paths, row_idcs, ibis_games = collect_games(physio_paths, load, df_summary)
 
+    for row_idx, ibis_game in zip(row_idcs, ibis_games):    # spectral estimates are computed per session
+        hrv_stats = hrv_utils.compute_hrv_spectral_stats(ibis_game, SFREQ)
         for key, value in hrv_stats.items():
             df_summary.loc[row_idx, key] = value
+
+    ibis, offsets = ragged_utils.pack(ibis_games)
+    update_summary(df_summary, row_idcs,
+                   hrv_utils.compute_time_domain_hrv_stats_segmented(ibis, offsets))
+    for physio_path in game_paths:
         print(f"Updated {save_path} with {physio_path}.")
 
     df_summary.to_csv(save_path, sep="\t", index=False)
@@ -246,43 +330,21 @@ def summary_coherence(subject, inputs, outputs, recompute):
     filename = inputs["event_path"][1]
     event_paths = list(root.joinpath(subject).glob(f"{subject}{filename}"))
 
-    for i, resp_path in enumerate(resp_paths):
+    columns = ["coherence_lf", "coherence_hf"]
+    resp_paths = get_uncomputed_paths(resp_paths, df_summary, columns, recompute)
+    resp_paths = screen_paths(resp_paths, inputs["event_path"][0].joinpath(subject), "resp")
+    resp_paths = screen_paths(resp_paths, inputs["event_path"][0].joinpath(subject), "ibis")
+    if not resp_paths:    # make sure to save updates only when values have been (re-) computed
+        return
+    load = partial(read_coherence_game, event_paths=event_paths, ibis_paths=ibis_paths)
 
-        row_idx = get_row_idx(resp_path, df_summary)
-        columns = ["coherence_lf", "coherence_hf"]
-        computed = df_summary.loc[row_idx, columns].isna().values.sum() != len(columns)   # skip if all columns contain NaN (make sure to reserve NaN as place-holder for non-computed results)
-        if computed and not recompute:
-            print(f"Not re-computing {resp_path}.")
-            if i < len(resp_paths) - 1:    # make sure to save updates only when values have been (re-) computed
-                continue
-            else:
-                return
-
-        # Find corresponding event_path
-        event_path_idx = [i for i, j in enumerate(event_paths) if str(j.name)[:21] == str(resp_path.name)[:21]]
-        if len(event_path_idx) != 1:
-            print(f"Didn't find matching events for {resp_path.name}.")
-            continue
-        event_path = event_paths[event_path_idx[0]]
-        events = pd.read_csv(event_path, sep='\t')
-        try:
-            beg, end = get_game_beg_end(event_path, events)
-        except IOError:
-            continue
+    for resp_path, game in io_utils.prefetch(resp_paths, load):
 
-        # Find corresponding ibis_path
-        ibis_path_idx = [i for i, j in enumerate(ibis_paths) if str(j.name)[:21] == str(resp_path.name)[:21]]
-        if len(ibis_path_idx) != 1:
-            print(f"Didn't find matching events for {resp_path.name}.")
+        if game is None:
             continue
-        ibis_path = ibis_paths[ibis_path_idx[0]]
-        ibis = np.ravel(pd.read_csv(ibis_path, sep='\t'))
-        ibis_game = ibis[beg:end]
-
-        data = read_raw_edf(resp_path, preload=True, verbose="error")
-        resp = np.ravel(data.get_data(picks=0))
-        resp_game = resp[beg:end]
+        resp_game, ibis_game = game
 
+        row_idx = get_row_idx(resp_path, df_summary)
         coherence_stats = hrv_utils.compute_coherence(resp_game, ibis_game, SFREQ)
 
         for key, value in coherence_stats.items():
@@ -311,38 +373,18 @@ def summary_hrv_biofeedback(subject, inputs, outputs, recompute):
         print(f"No files found for {subject}.")
         return
 
-    for i, physio_path in enumerate(physio_paths):
-
-        row_idx = get_row_idx(physio_path, df_summary)
-        columns = ["mean_local_power_hrv", "median_local_power_hrv"]
-        computed = df_summary.loc[row_idx, columns].isna().values.sum() != len(columns)   # skip if all columns contain NaN (make sure to reserve NaN as place-holder for non-computed results)
-        if computed and not recompute:
-            print(f"Not re-computing {physio_path}.")
-            if i < len(physio_paths) - 1:    # make sure to save updates only when values have been (re-) computed
-                continue
-            else:
-                return
-
-        # Find corresponding event_path
-        event_path_idx = [i for i, j in enumerate(event_paths) if str(j.name)[:21] == str(physio_path.name)[:21]]
-        if len(event_path_idx) != 1:
-            print(f"Didn't find matching events for {physio_path.name}.")
-            continue
-        event_path = event_paths[event_path_idx[0]]
-        events = pd.read_csv(event_path, sep='\t')
-        try:
-            beg, end = get_game_beg_end(event_path, events)
-        except IOError:
-            continue
-
-        data = pd.read_csv(physio_path, sep="\t")
-        local_power_hrv = np.ravel(data["local_power_hrv"])
-        local_power_hrv_game = local_power_hrv[beg:end]
-
-        local_power_hrv_stats = hrv_utils.compute_local_power_hrv_stats(local_power_hrv_game)
+    columns = ["mean_local_power_hrv", "median_local_power_hrv"]
+    physio_paths = get_uncomputed_paths(physio_paths, df_summary, columns, recompute)
+    physio_paths = screen_paths(physio_paths, inputs["event_path"][0].joinpath(subject), "ibis")
+    if not physio_paths:    # make sure to save updates only when values have been (re-) computed
+        return
+    load = partial(read_tsv_game, event_paths=event_paths, column="local_power_hrv")
+    game_paths, row_idcs, local_power_hrv_games = collect_games(physio_paths, load, df_summary)
 
-        for key, value in local_power_hrv_stats.items():
-            df_summary.loc[row_idx, key] = value
+    local_power_hrv, offsets = ragged_utils.pack(local_power_hrv_games)
+    update_summary(df_summary, row_idcs,
+                   hrv_utils.compute_local_power_hrv_stats_segmented(local_power_hrv, offsets))
+    for physio_path in game_paths:
         print(f"Updated {save_path} with {physio_path}.")
 
     df_summary.to_csv(save_path, sep="\t", index=False)
@@ -367,38 +409,19 @@ def summary_resp_biofeedback(subject, inputs, outputs, recompute):
         print(f"No files found for {subject}.")
         return
 
-    for i, physio_path in enumerate(physio_paths):
-
-        row_idx = get_row_idx(physio_path, df_summary)
-        columns = ["mean_original_resp_biofeedback", "median_original_resp_biofeedback"]
-        computed = df_summary.loc[row_idx, columns].isna().values.sum() != len(columns)   # skip if all columns contain NaN (make sure to reserve NaN as place-holder for non-computed results)
-        if computed and not recompute:
-            print(f"Not re-computing {physio_path}.")
-            if i < len(physio_paths) - 1:    # make sure to save updates only when values have been (re-) computed
-                continue
-            else:
-                return
-
-        # Find corresponding event_path
-        event_path_idx = [i for i, j in enumerate(event_paths) if str(j.name)[:21] == str(physio_path.name)[:21]]
-        if len(event_path_idx) != 1:
-            print(f"Didn't find matching events for {physio_path.name}.")
-            continue
-        event_path = event_paths[event_path_idx[0]]
-        events = pd.read_csv(event_path, sep='\t')
-        try:
-            beg, end = get_game_beg_end(event_path, events)
-        except IOError:
-            continue
-
-        data = pd.read_csv(physio_path, sep="\t")
-        original_resp_biofeedback = np.ravel(data["original_resp_biofeedback"])
-        original_resp_biofeedback_game = original_resp_biofeedback[beg:end]
-
-        original_resp_biofeedback_stats = biofeedback_utils.compute_original_resp_biofeedback_stats(original_resp_biofeedback_game)
-
-        for key, value in original_resp_biofeedback_stats.items():
-            df_summary.loc[row_idx, key] = value
+    columns = ["mean_original_resp_biofeedback", "median_original_resp_biofeedback"]
+    physio_paths = get_uncomputed_paths(physio_paths, df_summary, columns, recompute)
+    physio_paths = screen_paths(physio_paths, inputs["event_path"][0].joinpath(subject), "biofeedback")
+    if not physio_paths:    # make sure to save updates only when values have been (re-) computed
+        return
+    load = partial(read_tsv_game, event_paths=event_paths, column="original_resp_biofeedback")
+    game_paths, row_idcs, original_resp_biofeedback_games = collect_games(physio_paths, load, df_summary)
+
+    original_resp_biofeedback, offsets = ragged_utils.pack(original_resp_biofeedback_games)
+    update_summary(df_summary, row_idcs,
+                   biofeedback_utils.compute_original_resp_biofeedback_stats_segmented(original_resp_biofeedback,
+                                                                                       offsets))
+    for physio_path in game_paths:
         print(f"Updated {save_path} with {physio_path}.")
 
     df_summary.to_csv(save_path, sep="\t", index=False)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Time-resolved features of the game window of each session, i.e., breathing
+rate and amplitude, HRV, and biofeedback score in sliding windows (see
+analysis_utils.window_utils), rather than one number per session as in the
+summary file. Run with
+
+    python -m biofeedback_analyses.windows --window 300 --hop 30
+
+in the directory that contains "raw" and "processed". The sessions are
+preprocessed in memory (see sessions.py) and the features of each session are
+saved to processed/<subject>/<subject>_<session>_windows, with one row per
+window.
+
+Instantaneous breathing rate and amplitude are computed once for the whole
+game window and then summarized per window, so breaths at the edges of a
+window are not cut off. Windows extend until the end of the game; features of
+windows that extend beyond the last IBI or biofeedback score are NaN.
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from biofeedback_analyses import sessions
+from biofeedback_analyses.analysis_utils import window_utils, hrv_utils, resp_utils
+from biofeedback_analyses.config import WINDOW_DURATION, WINDOW_HOP, WINDOW_NPERSEG, FFT_WORKERS
+
+
+def pad_windows(features, n_windows):
+    """Pad per-window features of a signal that ends before the game with
+    NaN."""
+
+    return {key: np.pad(np.asarray(values, dtype=float), (0, n_windows - len(values)),
+                        constant_values=np.nan) for key, values in features.items()}
+
+
+def compute_window_features(session, window=WINDOW_DURATION, hop=WINDOW_HOP,
+                            nperseg=WINDOW_NPERSEG):
+    """Compute the features of all sliding windows of the game of a
+    preprocessed session (see sessions.preprocess_session()).
+
+    Parameters
+    ----------
+    session : dict
+        Preprocessed session.
+    window, hop : float, optional
+        Duration of the windows and interval between their starts in seconds.
+    nperseg : int, optional
+        Length of the Welch segments of the HRV band powers in samples.
+
+    Returns
+    -------
+    features : DataFrame
+        One row per window, with its "beg" and "end" sample (relative to the
+        start of the recording), its "time" (center in seconds relative to
+        the start of the game), and the features named as in the summary
+        file. Empty if the game window can't be determined.
+    """
+    if session["game"] is None:
+        print(f"Didn't find the game window of {session['subject']} {session['session']}.")
+        return pd.DataFrame()
+    beg, end = session["game"]
+    sfreq = session["sfreq"]
+    window = int(np.rint(window * sfreq))
+    hop = int(np.rint(hop * sfreq))
+
+    starts = window_utils.window_starts(end - beg, window, hop)
+    n_windows = starts.size
+    features = {"beg": beg + starts, "end": beg + starts + window,
+                "time": (starts + window / 2) / sfreq}
+
+    resp = np.asarray(session["resp"][beg:end], dtype=np.float64)
+    if n_windows:
+        _, rate, amp = resp_utils.resp_stats(resp_utils.resp_extrema(resp, sfreq), resp, sfreq)
+        features.update({"median_resp_rate": window_utils.window_median(rate, window, hop),
+                         "median_resp_amp": window_utils.window_median(amp, window, hop),
+                         "mean_resp_rate": window_utils.window_mean(rate, window, hop)})
+
+    ibis = session["ibis"]
+    if ibis is not None:
+        ibis = ibis[beg:end]
+        freqs, psds = window_utils.window_welch(ibis, window, hop, sfreq, nperseg,
+                                                workers=FFT_WORKERS)
+        hrv = hrv_utils.compute_hrv_band_stats(freqs, psds)
+        hrv.update({"median_heart_period": window_utils.window_median(ibis, window, hop),
+                    "rmssd": window_utils.window_rmssd(ibis, window, hop)})
+        features.update(pad_windows(hrv, n_windows))
+
+    biofeedback = session["original_resp_biofeedback"]
+    if biofeedback is not None:
+        biofeedback = biofeedback[beg:end]
+        features.update(pad_windows({"median_original_resp_biofeedback": window_utils.window_median(biofeedback, window, hop),
+                                     "mean_original_resp_biofeedback": window_utils.window_mean(biofeedback, window, hop)},
+                                    n_windows))
+
+    return pd.DataFrame(features)
+
+
+def window_cohort(DATADIR_RAW, DATADIR_PROCESSED, window=WINDOW_DURATION,
+                  hop=WINDOW_HOP):
+    """Save the features of the sliding windows of every session in
+    DATADIR_RAW to DATADIR_PROCESSED."""
+
+    for session in sessions.preprocess_sessions(sessions.iter_raw_sessions(DATADIR_RAW)):
+
+        features = compute_window_features(session, window, hop)
+        directory = DATADIR_PROCESSED.joinpath(session["subject"])
+        directory.mkdir(parents=True, exist_ok=True)
+        save_path = directory.joinpath(f"{session['subject']}_{session['session']}_windows")
+        features.to_csv(save_path, sep="\t", index=False)
+        print(f"Saved {len(features)} window(s) to {save_path}")
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Compute features of sliding windows of the game of each session.")
+    parser.add_argument("--window", type=float, default=WINDOW_DURATION, metavar="SECONDS",
+                        help="Duration of the windows.")
+    parser.add_argument("--hop", type=float, default=WINDOW_HOP, metavar="SECONDS",
+                        help="Interval between the starts of consecutive windows.")
+    args = parser.parse_args()
+
+    window_cohort(Path.cwd().joinpath("raw"), Path.cwd().joinpath("processed"),
+                  args.window, args.hop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+author: Jan C. Brammer <jan.c.brammer@gmail.com>
+
+Distributed execution of the preprocessing and summary pipelines.
+
+The coordinator splits the tasks into units of work, i.e., (task, subject,
+session) triplets, and stores them in an SQLite database in the "processed"
+directory. Worker processes, possibly on different hosts that share the
+filesystem, claim units with a lease that they renew with a heartbeat while
+the unit is running. Leases that expire (e.g., because a worker crashed) are
+requeued, or marked as failed once they have been attempted MAX_ATTEMPTS
+times (e.g., units that keep killing their worker). A worker that lost the
+lease on its unit discards the unit's result. Units of a task only become available once all units of the
+preceding tasks have been completed, since tasks depend on each other's
+outputs. Summary units run on a copy of the summary file and save only the
+cells they changed to a separate shard. Once all units have been completed,
+the coordinator writes the shards into the summary file in the same order
+(and with the same reading and writing of the file) as a sequential run, such
+that the summary is identical to the one of a sequential run.
+
+Note that SQLite relies on the file locking of the shared filesystem, which
+must therefore support POSIX advisory locks (e.g., NFSv4).
+"""
+
+import os
+import time
+import shutil
+import socket
+import sqlite3
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+from itertools import groupby
+from contextlib import closing
+from biofeedback_analyses import planner, progress
+from biofeedback_analyses.config import (SUBJECTS, SESSIONS, LEASE_DURATION,
+                                         HEARTBEAT_INTERVAL, POLL_INTERVAL,
+                                         MAX_ATTEMPTS, TIMINGS_FILENAME)
+from biofeedback_analyses.preprocessing.pipeline import pipeline as preprocessing_pipeline
+from biofeedback_analyses.summary_stats.pipeline import pipeline as summary_stats_pipeline
+from biofeedback_analyses.summary_stats import steps as summary_stats_steps
+
+
+SUMMARY_KEYS = ["subj", "sess", "cond"]
+
+def queue_tasks(DATADIR_RAW, DATADIR_PROCESSED):
+    """Return the tasks that are executed by the workers, in order."""
+    return (preprocessing_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED) +
+            summary_stats_pipeline(SUBJECTS, SESSIONS, DATADIR_RAW, DATADIR_PROCESSED))
+
+
+def restrict_to_session(inputs, session):
+    """Narrow the glob patterns of a task's inputs down to a single session.
+
+    Parameters
+    ----------
+    inputs : dict
+        The "inputs" of a task, mapping input names to [root, pattern].
+    session : str
+        Session and condition, e.g., "sess-01_cond-A".
+
+    Returns
+    -------
+    session_inputs : dict
+        Copy of `inputs` whose patterns only match files of `session`.
+    """
+    session_inputs = {}
+    for key, (root, pattern) in inputs.items():
+        session_inputs[key] = [root, f"*{session}{pattern}"]
+
+    return session_inputs
+
+
+def connect(queue_path):
+
+    con = sqlite3.connect(str(queue_path), timeout=60,
+                          isolation_level=None)    # transactions are managed explicitly
+
+    return con
+
+
+def init_queue(queue_path, tasks):
+    """Create the queue and insert one unit per task, subject and session.
+    Tasks without "sessions" (e.g., tasks that aggregate over all sessions of
+    a subject) are split by subject only."""
+    with closing(connect(queue_path)) as con:
+        con.execute("CREATE TABLE units (unit_id INTEGER PRIMARY KEY,"
+                    " stage INTEGER, task TEXT, subject TEXT, session TEXT,"
+                    " status TEXT DEFAULT 'pending', worker TEXT,"
+                    " lease_expires REAL, attempts INTEGER DEFAULT 0)")
+        con.execute("BEGIN")
+        for stage, task in enumerate(tasks):
+            for subject in task["subjects"]:
+                for session in task.get("sessions", [None]):
+                    con.execute("INSERT INTO units (stage, task, subject, session)"
+                                " VALUES (?, ?, ?, ?)",
+                                (stage, task["func"].__name__, subject, session))
+        con.execute("COMMIT")
+
+
+def claim_unit(queue_path, worker, lease_duration=LEASE_DURATION,
+               progress_path=None):
+    """Requeue units with expired leases (or mark them as failed if they have
+    been attempted MAX_ATTEMPTS times) and lease the next pending unit of the
+    earliest unfinished stage to `worker`. The expired units are updated in
+    the progress database at progress_path unless it is None.
+
+    Returns
+    -------
+    unit : dict or None
+        The leased unit. None if no unit can currently be claimed, either
+        because all units are finished or because the remaining units have to
+        wait for the completion of units of a preceding stage.
+    """
+    now = time.time()
+
+    with closing(connect(queue_path)) as con:
+        con.execute("BEGIN IMMEDIATE")    # serialize claims across processes and hosts
+        expired = con.execute("SELECT task, subject, session, attempts < ? FROM units"
+                              " WHERE status = 'running' AND lease_expires < ?",
+                              (MAX_ATTEMPTS, now)).fetchall()
+        con.execute("UPDATE units SET status = CASE WHEN attempts < ?"
+                    " THEN 'pending' ELSE 'failed' END, worker = NULL,"
+                    " lease_expires = NULL WHERE status = 'running' AND lease_expires < ?",
+                    (MAX_ATTEMPTS, now))
+        row = con.execute("SELECT unit_id, stage, task, subject, session FROM units"
+                          " WHERE status = 'pending' AND stage = (SELECT MIN(stage)"
+                          " FROM units WHERE status IN ('pending', 'running'))"
+                          " ORDER BY unit_id LIMIT 1").fetchone()
+        if row is not None:
+            con.execute("UPDATE units SET status = 'running', worker = ?,"
+                        " lease_expires = ?, attempts = attempts + 1"
+                        " WHERE unit_id = ?", (worker, now + lease_duration, row[0]))
+        con.execute("COMMIT")
+
+    requeued = sum(requeue for *_, requeue in expired)
+    if requeued:
+        print(f"Requeued {requeued} unit(s) with expired lease.")
+    if len(expired) > requeued:
+        print(f"{len(expired) - requeued} unit(s) with expired lease failed after {MAX_ATTEMPTS} attempts.")
+    if progress_path is not None:
+        for task, subject, session, requeue in expired:
+            progress.finish_unit(progress_path, task, subject, session, succeeded=False,
+                                 requeued=bool(requeue))
+    if row is None:
+        return None
+
+    return dict(zip(["unit_id", "stage", "task", "subject", "session"], row))
+
+
+def heartbeat(queue_path, unit_id, worker, lease_duration=LEASE_DURATION):
+    """Renew the lease on a unit. Return False if the lease has been lost."""
+    with closing(connect(queue_path)) as con:
+        renewed = con.execute("UPDATE units SET lease_expires = ?"
+                              " WHERE unit_id = ? AND worker = ? AND status = 'running'",
+                              (time.time() + lease_duration, unit_id, worker)).rowcount
+
+    return renewed == 1
+
+
+def finish_unit(queue_path, unit_id, worker, succeeded):
+    """Mark a unit as done. Failed units are requeued until they have been
+    attempted MAX_ATTEMPTS times. Returns the new status of the unit, or None
+    if `worker` no longer holds the unit (i.e., its lease expired)."""
+    with closing(connect(queue_path)) as con:
+        if succeeded:
+            updated = con.execute("UPDATE units SET status = 'done', lease_expires = NULL"
+                                  " WHERE unit_id = ? AND worker = ? AND status = 'running'",
+                                  (unit_id, worker)).rowcount
+        else:
+            updated = con.execute("UPDATE units SET status = CASE WHEN attempts < ?"
+                                  " THEN 'pending' ELSE 'failed' END, worker = NULL,"
+                                  " lease_expires = NULL WHERE unit_id = ? AND worker = ?"
+                                  " AND status = 'running'",
+                                  (MAX_ATTEMPTS, unit_id, worker)).rowcount
+        if not updated:
+            return None
+        status, = con.execute("SELECT status FROM units WHERE unit_id = ?", (unit_id,)).fetchone()
+
+    return status
+
+
+def queue_status(queue_path):
+    """Return the number of units per status."""
+    with closing(connect(queue_path)) as con:
+        counts = dict(con.execute("SELECT status, COUNT(*) FROM units GROUP BY status"))
+
+    return counts
+
+
+def queue_finished(queue_path):
+
+    counts = queue_status(queue_path)
+
+    return counts.get("pending", 0) + counts.get("running", 0) == 0
+
+
+def writes_summary(task):
+
+    return task["func"].__module__ == summary_stats_steps.__name__
+
+
+def shard_path(DATADIR_PROCESSED, unit):
+
+    return DATADIR_PROCESSED.joinpath("queue_shards",
+                                      f"{unit['stage']:03d}_{unit['task']}_{unit['subject']}_{unit['session']}")
+
+
+def changed_cells(df_before, df_after):
+    """Return the cells of the summary that a summary step changed.
+
+    Parameters
+    ----------
+    df_before : DataFrame
+        Summary as read by the step.
+    df_after : DataFrame
+        Summary as saved by the step, read with float_precision="round_trip"
+        such that the values are exactly the ones computed by the step.
+
+    Returns
+    -------
+    cells : DataFrame
+        One row per cell with the "subj", "sess", and "cond" of its row, its
+        "column", and its "value", in the order of the columns in df_after.
+        Columns that the step added are listed once without keys (i.e., they
+        are created), and then with every row that the step changed.
+    """
+    before = df_before.set_index(SUMMARY_KEYS)
+    after = df_after.set_index(SUMMARY_KEYS)
+    new_columns = after.columns.difference(before.columns, sort=False)
+    existing = after[before.columns]
+    changed = (existing != before) & ~(existing.isna() & before.isna())
+    touched = changed.any(axis=1) | after[new_columns].notna().any(axis=1)
+
+    cells = []
+    for column in after.columns:
+        if column in new_columns:
+            cells.append((np.nan, np.nan, np.nan, column, np.nan))
+            rows = after.index[touched]
+        else:
+            rows = after.index[changed[column]]
+        cells += [(*row, column, after.at[row, column]) for row in rows]
+
+    return pd.DataFrame(cells, columns=[*SUMMARY_KEYS, "column", "value"])
+
+
+def apply_cells(df, cells):
+    """Write cells (see changed_cells()) into the summary df in place, in the
+    same way as the summary steps do."""
+
+    for cell in cells.itertuples(index=False):
+        if pd.isna(cell.subj):
+            if cell.column not in df.columns:
+                df[cell.column] = np.nan
+            continue
+        row_idx = np.where((df["subj"] == cell.subj) & (df["sess"] == cell.sess) &
+                           (df["cond"] == cell.cond))[0]
+        df.loc[row_idx, cell.column] = cell.value
+
+
+def run_unit(task, unit, DATADIR_PROCESSED, holds_lease=None):
+    """Run a task for a single subject (and session) and record its timing.
+    Summary tasks run on a copy of the summary file rather than on the shared
+    summary file. If the task saved the copy, the cells that it changed are
+    saved to the unit's shard (see changed_cells()), unless holds_lease() is
+    False, i.e., the unit has been requeued in the meantime."""
+    inputs = task["inputs"]
+    if unit["session"] is not None:
+        inputs = restrict_to_session(inputs, unit["session"])
+
+    outputs = task["outputs"]
+    if writes_summary(task):
+        root, filename = outputs["save_path"]
+        summary_path = root.joinpath(filename)
+        shard = shard_path(DATADIR_PROCESSED, unit)
+        copy_path = shard.with_name(f".{shard.name}.{socket.gethostname()}.{os.getpid()}.summary")
+        shutil.copyfile(summary_path, copy_path)
+        os.utime(copy_path, ns=(0, 0))    # tells whether the task saved the summary
+        outputs = {"save_path": [copy_path.parent, copy_path.name]}
+
+    planner.timed_call(task, unit["subject"], inputs, outputs,
+                       DATADIR_PROCESSED.parent.joinpath(TIMINGS_FILENAME), unit["session"])
+
+    if writes_summary(task):
+        if copy_path.stat().st_mtime_ns and (holds_lease is None or holds_lease()):
+            cells = changed_cells(pd.read_csv(summary_path, sep="\t"),
+                                  pd.read_csv(copy_path, sep="\t", float_precision="round_trip"))
+            tmp_path = copy_path.with_suffix(".shard")
+            cells.to_csv(tmp_path, sep="\t", index=False)
+            os.replace(tmp_path, shard)
+        copy_path.unlink()
+
+
+def work(DATADIR_RAW, DATADIR_PROCESSED, worker=None):
+    """Claim and run units until the queue is finished."""
+    if worker is None:
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+    queue_path = DATADIR_PROCESSED.joinpath("queue.sqlite")
+    progress_path = DATADIR_PROCESSED.joinpath(progress.PROGRESS_FILENAME)
+    tasks = queue_tasks(DATADIR_RAW, DATADIR_PROCESSED)
+
+    while True:
+
+        unit = claim_unit(queue_path, worker, progress_path=progress_path)
+        if unit is None:
+            if queue_finished(queue_path):
+                print(f"Worker {worker} found no remaining units.")
+                return
+            time.sleep(POLL_INTERVAL)    # wait for units of preceding stage
+            continue
+
+        task = tasks[unit["stage"]]
+        assert task["func"].__name__ == unit["task"], f"Worker {worker} runs a different pipeline than the coordinator."
+
+        stop_heartbeat = threading.Event()
+        lease_lost = threading.Event()
+
+        def beat():
+            while not stop_heartbeat.wait(HEARTBEAT_INTERVAL):
+                if not heartbeat(queue_path, unit["unit_id"], worker):
+                    print(f"Worker {worker} lost lease on unit {unit['unit_id']}.")
+                    lease_lost.set()
+                    return
+
+        def holds_lease():
+            return not lease_lost.is_set() and heartbeat(queue_path, unit["unit_id"], worker)
+
+        heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        heartbeat_thread.start()
+        progress.start_unit(progress_path, unit["task"], unit["subject"], unit["session"], worker)
+        try:
+            run_unit(task, unit, DATADIR_PROCESSED, holds_lease)
+            succeeded = True
+        except Exception as e:
+            print(f"Worker {worker} failed on {unit['task']} for {unit['subject']} {unit['session']}: {e!r}")
+            succeeded = False
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+        status = finish_unit(queue_path, unit["unit_id"], worker, succeeded)
+        if status is None:    # the unit has been requeued, its progress is recorded by whoever holds it now
+            print(f"Worker {worker} discarded unit {unit['unit_id']}, its lease has been lost.")
+            continue
+        progress.finish_unit(progress_path, unit["task"], unit["subject"], unit["session"],
+                             succeeded, requeued=status == "pending")
+
+
+def merge_summary_shards(queue_path, DATADIR_PROCESSED):
+    """Write the cells changed by the summary units into the summary file.
+    As during a sequential run (see run_analysis.run()), the summary file is
+    read, updated with the cells of all sessions of a subject, and saved once
+    per summary task and subject whose units saved the summary, in the order
+    of the tasks and subjects. Hence, the summary file is identical to the
+    one of a sequential run, including the order of the columns and the
+    digits of the values."""
+    save_path = DATADIR_PROCESSED.joinpath("summary_all_subjects")
+    with closing(connect(queue_path)) as con:
+        units = [dict(zip(["stage", "task", "subject", "session"], row))
+                 for row in con.execute("SELECT stage, task, subject, session FROM units ORDER BY unit_id")]
+
+    for _, subject_units in groupby(units, key=lambda unit: (unit["stage"], unit["subject"])):
+
+        shards = [shard_path(DATADIR_PROCESSED, unit) for unit in subject_units]
+        shards = [shard for shard in shards if shard.exists()]
+        if not shards:    # the task didn't save the summary for this subject
+            continue
+        df_summary = pd.read_csv(save_path, sep="\t")
+        for shard in shards:
+            apply_cells(df_summary, pd.read_csv(shard, sep="\t", float_precision="round_trip"))
+        df_summary.to_csv(save_path, sep="\t", index=False)
+
+    print(f"Merged summary shards into {save_path}.")
+
+
+def coordinate(DATADIR_RAW, DATADIR_PROCESSED, n_workers, later_tasks=()):
+    """Set up the queue, start `n_workers` local workers, wait for all units
+    (including those claimed by workers on other hosts) to finish, and merge
+    the summary shards. The units of later_tasks, which run after the queue
+    (e.g., the plotting), are recorded in the progress database as well."""
+    queue_path = DATADIR_PROCESSED.joinpath("queue.sqlite")
+    progress_path = DATADIR_PROCESSED.joinpath(progress.PROGRESS_FILENAME)
+    DATADIR_PROCESSED.joinpath("queue_shards").mkdir()
+    tasks = queue_tasks(DATADIR_RAW, DATADIR_PROCESSED)
+    progress.init_progress(progress_path, tasks, by_session=True)
+    if later_tasks:
+        progress.init_progress(progress_path, later_tasks, append=True)
+    init_queue(queue_path, tasks)
+    print(f"Instantiated work queue at {queue_path}.")
+
+    context = multiprocessing.get_context("spawn")    # start workers from a fresh interpreter, as on other hosts
+    workers = [context.Process(target=work, args=(DATADIR_RAW, DATADIR_PROCESSED))
+               for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+
+    while not queue_finished(queue_path):
+        if workers and not any(worker.is_alive() for worker in workers):
+            raise RuntimeError("All local workers exited before the work queue was finished.")
+        progress.report(progress_path)
+        time.sleep(POLL_INTERVAL)
+    for worker in workers:
+        worker.join()
+    progress.report(progress_path)
+
+    counts = queue_status(queue_path)
+    if counts.get("failed", 0):
+        print(f"{counts['failed']} unit(s) failed after {MAX_ATTEMPTS} attempts.")
+    merge_summary_shards(queue_path, DATADIR_PROCESSED)